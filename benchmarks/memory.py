@@ -0,0 +1,168 @@
+"""
+Usage:
+  memory.py [--runs=<n>] [--flows=<n>] [--contacts=<n>] [--steps=<n>]
+            [--page-size=<n>] [--concurrent-pages=<n>]
+
+Measure the memory taken by DownloadTask.download() downloading a synthetic
+dataset of flow runs from a fake RapidPro client with and without interning
+their repeated strings (see: rapidpropull.interning).  The client decodes
+each page from its own JSON text (so that, like in a real download, every
+occurrence of a string is a separate instance until interned) and returns
+all pages at once unless the download requests them page by page (the only
+downloads interned by rapidpro-pull - e.g. when given more than one
+concurrent page, the default here).  Each variant is measured in a new
+Python interpreter and both the peak and the retained (after the download;
+Linux only) resident set sizes are reported.
+
+Options:
+  --runs=<n>                         the number of runs [default: 1000000]
+  --flows=<n>                        the number of distinct flows
+                                     [default: 20]
+  --contacts=<n>                     the number of distinct contacts
+                                     [default: 100000]
+  --steps=<n>                        the number of steps of each run
+                                     [default: 3]
+  --page-size=<n>                    the number of runs per page
+                                     [default: 250]
+  --concurrent-pages=<n>             passed on to rapidpro-pull [default: 2]
+"""
+from __future__ import print_function
+import gc
+import json
+import os
+import resource
+import subprocess
+import sys
+import uuid
+
+import docopt
+
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2016, Tomasz J. Kotarba. All rights reserved.'
+__maintainer__ = 'Tomasz J. Kotarba'
+__email__ = 'tomasz@kotarba.net'
+
+OPTIONS = ('--runs', '--flows', '--contacts', '--steps', '--page-size',
+           '--concurrent-pages')
+
+
+def make_page_text(first_run, runs, flows, contacts, steps):
+    """Return the JSON text of a page of runs (as in RapidPro API v1)."""
+    page = []
+    for run in range(first_run, first_run + runs):
+        flow = flows[run % len(flows)]
+        page.append({
+            'run': run,
+            'flow_uuid': flow,
+            'contact': contacts[run % len(contacts)],
+            'steps': [{'node': '{}-{}'.format(flow[:-3], i),
+                       'text': None, 'value': None, 'type': 'A',
+                       'arrived_on': '2016-01-01T00:00:00.000Z',
+                       'left_on': '2016-01-01T00:01:00.000Z'}
+                      for i in range(steps)],
+            'values': [],
+            'created_on': '2016-01-01T00:00:00.000Z',
+            'modified_on': '2016-01-01T00:01:00.000Z',
+            'expires_on': None,
+            'expired_on': None,
+            'completed': True})
+    return json.dumps(page)
+
+
+def measure(arguments, interned):
+    """
+    Return the peak and the retained resident set sizes (in bytes; the
+    latter is None if unknown) of a new interpreter downloading the runs
+    (interning them if interned is True).
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    argv = [sys.executable, os.path.abspath(__file__), '--child'] + \
+        [str(arguments[k]) for k in OPTIONS] + \
+        (['interned'] if interned else [])
+    environment = dict(os.environ, PYTHONPATH=root)
+    output = subprocess.check_output(argv, cwd=root, env=environment)
+    peak, retained = [int(x) for x in output.split()]
+    return peak, retained if retained >= 0 else None
+
+
+def download(runs, flows, contacts, steps, page_size, concurrent_pages,
+             interned):
+    """
+    Download the runs with DownloadTask.download() (keeping them) and return
+    the peak and the retained (-1 if unknown) resident set sizes (in bytes).
+    """
+    import mock
+    import temba_client.clients
+    import temba_client.v1.types
+    import rapidpropull.cli
+    import rapidpropull.download
+    flows = [str(uuid.uuid4()) for _ in range(flows)]
+    contacts = [str(uuid.uuid4()) for _ in range(contacts)]
+    last_page = (runs + page_size - 1) // page_size
+
+    def get_page(page_number):
+        first_run = (page_number - 1) * page_size
+        text = make_page_text(first_run, min(page_size, runs - first_run),
+                              flows, contacts, steps)
+        return temba_client.v1.types.Run.deserialize_list(json.loads(text))
+
+    def get_runs(pager=None, **kwargs):
+        if pager is None:
+            # all pages at once (like TembaClient without a pager)
+            all_runs = []
+            for page_number in range(1, last_page + 1):
+                all_runs.extend(get_page(page_number))
+            return all_runs
+        page_number = pager.next_url or pager.start_page
+        pager.update({'count': runs, 'next': page_number + 1
+                      if page_number < last_page else None})
+        return get_page(page_number)
+
+    with mock.patch('temba_client.v1.TembaClient') as client_class:
+        client_class.return_value.pager.side_effect = \
+            temba_client.clients.Pager
+        client_class.return_value.get_runs.side_effect = get_runs
+        download_task = rapidpropull.download.DownloadTask(
+            rapidpropull.cli.ArgumentProcessor([
+                '--flow-runs', '--api-token=token',
+                '--concurrent-pages={}'.format(concurrent_pages)]))
+        if interned:
+            download_task.download()
+        else:
+            with mock.patch('rapidpropull.interning.Interner.intern_objects'):
+                download_task.download()
+    gc.collect()
+    scale = 1 if sys.platform == 'darwin' else 1024  # bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    try:
+        with open('/proc/self/statm') as statm:
+            retained = int(statm.read().split()[1]) * \
+                resource.getpagesize()
+    except IOError:
+        retained = -1
+    return peak, retained
+
+
+def main():
+    if sys.argv[1:2] == ['--child']:
+        print(*download(*[int(a) for a in sys.argv[2:2 + len(OPTIONS)]],
+                        interned=sys.argv[2 + len(OPTIONS):] == ['interned']))
+        return
+    arguments = docopt.docopt(__doc__)
+    runs = int(arguments['--runs'])
+    results = {}
+    for interned in (False, True):
+        results[interned] = measure(arguments, interned)
+        for name, size in zip(('peak', 'retained'), results[interned]):
+            if size is not None:
+                print('{} {}: {:.1f} MB ({:.0f} bytes per run)'.format(
+                    'interned' if interned else 'plain', name,
+                    size / 2.0 ** 20, float(size) / runs))
+    for i, name in enumerate(('peak', 'retained')):
+        if results[False][i] is not None:
+            print('{} reduction: {:.1f}%'.format(name, 100.0 * (
+                results[False][i] - results[True][i]) / results[False][i]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+Usage:
+  startup.py [--runs=<n>] [--budget=<milliseconds>]
+
+Measure the cold-start time of rapidpro-pull (starting a new Python
+interpreter, importing rapidpropull.cli and processing arguments) and exit with
+status 1 if the median exceeds the budget.
+
+Options:
+  --runs=<n>                         the number of measured runs [default: 20]
+  --budget=<milliseconds>            the maximum median start-up time
+                                     [default: 200]
+"""
+from __future__ import print_function
+import os
+import subprocess
+import sys
+import time
+
+import docopt
+
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2016, Tomasz J. Kotarba. All rights reserved.'
+__maintainer__ = 'Tomasz J. Kotarba'
+__email__ = 'tomasz@kotarba.net'
+
+# Prints help (the same start-up path as any other invocation up to the point
+# of contacting RapidPro) without touching the network.
+STARTUP = 'import rapidpropull.cli; rapidpropull.cli.main(["--help"])'
+
+
+def measure(runs):
+    """Return a sorted list of start-up times (in milliseconds)."""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(runs):
+            start = time.time()
+            subprocess.call([sys.executable, '-c', STARTUP], cwd=root,
+                            stdout=devnull)
+            times.append((time.time() - start) * 1000)
+    return sorted(times)
+
+
+def main():
+    arguments = docopt.docopt(__doc__)
+    times = measure(int(arguments['--runs']))
+    median = times[len(times) // 2]
+    budget = float(arguments['--budget'])
+    print('start-up time: min {:.1f} ms, median {:.1f} ms, max {:.1f} ms'
+          ' (budget {:.1f} ms)'.format(times[0], median, times[-1], budget))
+    if median > budget:
+        print('Start-up time over budget.', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
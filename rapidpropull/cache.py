@@ -1,9 +1,14 @@
-import json
+import collections
+import threading
+from multiprocessing.pool import ThreadPool
 
 import sqlalchemy
 import sqlalchemy.types
+import temba_client.utils
 import temba_client.v1.types
 
+import rapidpropull.codec
+
 __author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
 __copyright__ = 'Copyright (c) 2016, Tomasz J. Kotarba. All rights reserved.'
 __maintainer__ = 'Tomasz J. Kotarba'
@@ -19,28 +24,98 @@ class RapidProCache(object):
     INVALID_TYPE = 'Invalid type "{}".  The object must be an instance of' \
                    ' Run, Flow or Contact.'
     INVALID_ENDPOINT_SELECTOR = 'Invalid endpoint selector "{}".'
+    DEFAULT_BATCH_SIZE = 500
+    # The maximum number of primary keys in a single "IN (...)" lookup (kept
+    # well below the limit of bound parameters of SQLite).
+    DEFAULT_LOOKUP_CHUNK_SIZE = 500
+    DEFAULT_MEMORY_ENTRIES = 10000
+    # The fields of objects also stored in their own (indexed) columns of
+    # each table so that objects can be queried without decoding their JSON.
+    EXTRACTED_COLUMNS = {
+        'flowrun': ('created_on', 'modified_on', 'completed'),
+        'flow': ('created_on',),
+        'contact': ('modified_on',)
+    }
 
-    def __init__(self, cache_url):
+    def __init__(self, cache_url, batch_size=DEFAULT_BATCH_SIZE,
+                 lookup_chunk_size=DEFAULT_LOOKUP_CHUNK_SIZE,
+                 lookup_workers=1, memory_entries=DEFAULT_MEMORY_ENTRIES,
+                 memory_bytes=None, passthrough=False):
         """
         Initialise a RapidPro cache object and prepare it to interact with a
-        database specified with cache_url.
+        database specified with cache_url.  Objects are inserted into the
+        database in batches of up to batch_size objects.  Cached objects are
+        looked up in chunks of up to lookup_chunk_size IDs - using up to
+        lookup_workers concurrent database connections (unless the database
+        is an in-memory SQLite database which cannot be shared by connections).
+        The numbers of hits and misses of lookups (which may run on multiple
+        threads) are counted in statistics.
+        Up to memory_entries recently used objects (taking up to memory_bytes
+        bytes of JSON if given) are also kept in memory (see: LRUCache) and
+        shared by all lookups - they must not be modified by clients.
+        If passthrough is True, cached objects are returned as CachedJSON
+        instead of being deserialised.
         """
+        self.batch_size = batch_size
+        self.lookup_chunk_size = lookup_chunk_size
+        self.lookup_workers = lookup_workers
+        self.statistics = collections.Counter()
+        # guards the statistics updated by concurrent lookups
+        self._lock = threading.Lock()
+        self.memory = LRUCache(memory_entries, memory_bytes)
+        self.passthrough = passthrough
         self.database = self._initialise_database(cache_url)
         self._flowruns = self.database.tables['flowrun']
         self._flows = self.database.tables['flow']
         self._contacts = self.database.tables['contact']
+        self._sync_state = self.database.tables['sync_state']
+        self._checkpoints = self.database.tables['checkpoint']
+        self._types = collections.OrderedDict([
+            (self._flowruns, temba_client.v1.types.Run),
+            (self._flows, temba_client.v1.types.Flow),
+            (self._contacts, temba_client.v1.types.Contact)
+        ])
 
-    def insert_objects(self, objects):
+    def insert_objects(self, objects, checkpoint=None):
         """
         Insert RapidPro objects (given as a list or a dictionary of lists) into
         the database.  The list elements must be instances of Contact, Flow or
         Run (see: rapidpro-python).
+        Objects already in cache are never overwritten.
+        All objects are inserted in a single transaction (with one query for
+        existing objects and one multi-row insert per batch).  Only the objects
+        not in cache yet are serialised into database records.  If a
+        checkpoint is given (as a dictionary of arguments of save_checkpoint),
+        it is saved in the same transaction.
+        Copies of newly inserted objects are also remembered in memory once the
+        transaction has been committed.
         """
         if not isinstance(objects, dict):
             objects = {'objects': objects}
+        # flows and contacts go first as flow runs refer to them
+        objects_by_table = collections.OrderedDict(
+            (t, []) for t in (self._flows, self._contacts, self._flowruns))
         for k in objects:
             for o in objects[k]:
-                self._insert_object(o)
+                objects_by_table[self._get_table(o)].append(o)
+        inserted = {t: [] for t in objects_by_table}
+        with self.database.bind.begin() as connection:
+            for table, table_objects in objects_by_table.items():
+                for i in range(0, len(table_objects), self.batch_size):
+                    inserted[table].extend(self._insert_new_objects(
+                        connection, table,
+                        table_objects[i:i + self.batch_size]))
+            if checkpoint is not None:
+                self._save_checkpoint(connection, **checkpoint)
+        if self.memory.max_entries == 0:
+            return
+        for table in inserted:
+            pk_name = self._get_primary_key(table).name
+            for record in inserted[table]:
+                # a copy so that later changes to the object do not affect it
+                self.memory.put((table.name, record[pk_name]),
+                                self._make_object(table, record),
+                                len(record['json']))
 
     def get_objects(self, endpoint_selector, uuids):
         """
@@ -48,26 +123,17 @@ class RapidProCache(object):
         and 1) a set of UUIDs for all of the requested objects not in cache.
         Raise exception if unknown endpoint selector supplied.
         """
-        pk_name = 'uuid'
         if endpoint_selector == '--flow-runs':
-            deserialiser = temba_client.v1.types.Run.deserialize
-            table_name = 'flowrun'
-            pk_name = 'run'
+            table = self._flowruns
         elif endpoint_selector == '--flows':
-            deserialiser = temba_client.v1.types.Flow.deserialize
-            table_name = 'flow'
+            table = self._flows
         elif endpoint_selector == '--contacts':
-            deserialiser = temba_client.v1.types.Contact.deserialize
-            table_name = 'contact'
+            table = self._contacts
         else:
             raise ValueError(self.INVALID_ENDPOINT_SELECTOR.format(
                 endpoint_selector))
-        table = self.database.tables[table_name]
-        records = self.database.bind.execute(
-            table.select().where(table.c[pk_name].in_(uuids))).fetchall()
-        cached_uuids = {getattr(r, pk_name) for r in records}
-        cached = [deserialiser(json.loads(r.json)) for r in records]
-        return cached, uuids.difference(cached_uuids)
+        cached = self._look_up(table, uuids)
+        return list(cached.values()), uuids.difference(cached)
 
     def substitute_cached_for_downloaded(self, objects):
         """
@@ -75,113 +141,489 @@ class RapidProCache(object):
         (see: rapidpro-python), check if an object with the same ID is already
         stored in cache and, if this is the case, replace the object in the list
         with its cached counterpart.
+        Cached objects are looked up in memory first and then with one query
+        per chunk of IDs of objects of the same type (instead of one query per
+        object).
         """
-        for i in range(len(objects)):
-            o = objects[i]
-            if isinstance(o, temba_client.v1.types.Run):
-                cached = self.get_flow_run(o.id)
-            elif isinstance(o, temba_client.v1.types.Flow):
-                cached = self.get_flow(o.uuid)
-            elif isinstance(o, temba_client.v1.types.Contact):
-                cached = self.get_contact(o.uuid)
+        positions = {t: collections.defaultdict(list) for t in self._types}
+        for i, o in enumerate(objects):
+            table = self._get_table(o)
+            if table is self._flowruns:
+                positions[table][o.id].append(i)
             else:
-                raise TypeError(self.INVALID_TYPE.format(type(o)))
-            if cached:
-                objects[i] = cached
+                positions[table][o.uuid].append(i)
+        for table, table_positions in positions.items():
+            if not table_positions:
+                continue
+            for key, cached in self._look_up(table, table_positions).items():
+                for i in table_positions[key]:
+                    objects[i] = cached
+
+    def get_statistics(self):
+        """
+        Return a dictionary of statistics of database and in-memory lookups
+        (hits and misses).
+        """
+        with self._lock:
+            statistics = dict(self.statistics)
+        statistics.update(self.memory.get_statistics())
+        return statistics
+
+    def _look_up(self, table, keys):
+        """
+        Return a dictionary mapping those of the primary keys of a table found
+        in memory or in the database to their cached objects.
+        Objects found in the database are remembered in memory.
+        """
+        found = {}
+        missing = []
+        for key in keys:
+            o = self.memory.get((table.name, key))
+            if o is None:
+                missing.append(key)
+            else:
+                found[key] = o
+        if missing:
+            pk = self._get_primary_key(table)
+            in_database = 0
+            for record in self._select_records(table, missing):
+                o = self._make_object(table, record)
+                self.memory.put((table.name, record[pk]), o, len(record.json))
+                found[record[pk]] = o
+                in_database += 1
+            self._count_lookups(table, len(missing), in_database)
+        return found
+
+    def _make_object(self, table, record):
+        """
+        Return the object stored in a record of a table - as a LazyObject
+        (deserialised on first access to its attributes other than those
+        stored in their own columns) or as CachedJSON in the passthrough
+        mode.
+        """
+        if table is self._flowruns:
+            attributes = {'id': record['run'], 'flow': record['flow_uuid'],
+                          'contact': record['contact_uuid']}
+        else:
+            attributes = {'uuid': record['uuid']}
+        if not self.passthrough:
+            return rapidpropull.codec.LAZY_TYPES[self._types[table]](
+                record['json'], **attributes)
+        fields = {name: record[name]
+                  for name in self.EXTRACTED_COLUMNS[table.name]}
+        return rapidpropull.codec.CachedJSON(
+            self._types[table], record['json'], fields, **attributes)
+
+    def _select_records(self, table, keys):
+        """
+        Return a generator yielding all records from a table which primary
+        keys are in the iterable keys (queried in chunks of up to
+        lookup_chunk_size keys, concurrently if more than one lookup worker
+        allowed).
+        """
+        pk = self._get_primary_key(table)
+        keys = list(keys)
+        selects = [
+            table.select().where(pk.in_(keys[i:i + self.lookup_chunk_size]))
+            for i in range(0, len(keys), self.lookup_chunk_size)]
+        workers = min(self.lookup_workers, len(selects))
+        if workers > 1 and not self.is_in_memory():
+            pool = ThreadPool(workers)
+            try:
+                chunks = pool.map(self._fetch_all, selects)
+            finally:
+                pool.terminate()
+        else:
+            chunks = (self._fetch_all(select) for select in selects)
+        for chunk in chunks:
+            for record in chunk:
+                yield record
+
+    def _fetch_all(self, select):
+        return self.database.bind.execute(select).fetchall()
+
+    def is_in_memory(self):
+        """
+        Return True if the cache is an in-memory SQLite database (which is
+        only visible to the thread which created it).
+        """
+        url = self.database.bind.url
+        return url.drivername.startswith('sqlite') and \
+            url.database in (None, '', ':memory:')
+
+    def _count_lookups(self, table, requested, found):
+        with self._lock:
+            self.statistics['{} cache hits'.format(table.name)] += found
+            self.statistics['{} cache misses'.format(table.name)] += \
+                requested - found
 
     def get_flow_run(self, run_id):
         """
         Return an instance of Run (see: rapidpro-python) from cache if a flow
         run identified with run_id found in cache.
         """
-        select = self._flowruns.select().where(self._flowruns.c.run == run_id)
-        fr = self.database.bind.execute(select).fetchone()
-        if fr is not None:
-            return temba_client.v1.types.Run.deserialize(json.loads(fr.json))
-        else:
-            return None
+        return self._look_up(self._flowruns, [run_id]).get(run_id)
 
     def get_flow(self, flow_uuid):
         """
         Return an instance of Flow (see: rapidpro-python) from cache if a flow
         identified with flow_uuid found in cache.
         """
-        select = self._flows.select().where(self._flows.c.uuid == flow_uuid)
-        flow = self.database.bind.execute(select).fetchone()
-        if flow is not None:
-            return temba_client.v1.types.Flow.deserialize(json.loads(flow.json))
-        else:
-            return None
+        return self._look_up(self._flows, [flow_uuid]).get(flow_uuid)
 
     def get_contact(self, contact_uuid):
         """
         Return an instance of Contact (see: rapidpro-python) from cache if a
         contact identified with contact_uuid found in cache.
         """
-        select = self._contacts.select().where(
-            self._contacts.c.uuid == contact_uuid)
-        contact = self.database.bind.execute(select).fetchone()
-        if contact is not None:
-            return temba_client.v1.types.Contact.deserialize(
-                json.loads(contact.json))
+        return self._look_up(self._contacts, [contact_uuid]).get(contact_uuid)
+
+    def get_high_water_mark(self, endpoint_selector, server):
+        """
+        Return the most recent modification (or creation in case of flows) date
+        and time recorded for objects downloaded from an endpoint (given as an
+        endpoint selector) of a RapidPro server.  Return None if nothing has
+        been recorded yet.
+        """
+        self._validate_endpoint_selector(endpoint_selector)
+        select = self._sync_state.select().where(sqlalchemy.and_(
+            self._sync_state.c.endpoint == endpoint_selector,
+            self._sync_state.c.server == server))
+        state = self.database.bind.execute(select).fetchone()
+        if state is not None:
+            return temba_client.utils.parse_iso8601(state.high_water_mark)
         else:
             return None
 
-    @staticmethod
-    def _initialise_database(database_url):
+    def update_high_water_mark(self, endpoint_selector, server, timestamp):
+        """
+        Record timestamp (a datetime) as the most recent modification (or
+        creation in case of flows) date and time of objects downloaded from an
+        endpoint of a RapidPro server unless a more recent one has already been
+        recorded.
+        """
+        current = self.get_high_water_mark(endpoint_selector, server)
+        record = {
+            'endpoint': endpoint_selector,
+            'server': server,
+            'high_water_mark': temba_client.utils.format_iso8601(timestamp)
+        }
+        if current is None:
+            self.database.bind.execute(self._sync_state.insert(), record)
+        elif current < timestamp:
+            self.database.bind.execute(
+                self._sync_state.update().where(sqlalchemy.and_(
+                    self._sync_state.c.endpoint == endpoint_selector,
+                    self._sync_state.c.server == server)),
+                record)
+
+    def get_checkpoint(self, endpoint_selector, server, query):
+        """
+        Return a tuple consisting of 0) the number of the next page to be
+        downloaded to complete an interrupted download identified with an
+        endpoint selector, a RapidPro server and a query (an opaque string
+        identifying the request) and 1) the upper bound recorded with it (None
+        if not recorded).  Return None if there is no such interrupted
+        download.
+        """
+        select = self._checkpoints.select().where(sqlalchemy.and_(
+            self._checkpoints.c.endpoint == endpoint_selector,
+            self._checkpoints.c.server == server,
+            self._checkpoints.c.query == query))
+        checkpoint = self.database.bind.execute(select).fetchone()
+        if checkpoint is not None:
+            return checkpoint.next_page, checkpoint.upper_bound
+        else:
+            return None
+
+    def save_checkpoint(self, endpoint_selector, server, query, next_page,
+                        upper_bound=None):
+        """
+        Record the number of the next page to be downloaded by a download
+        identified with an endpoint selector, a RapidPro server and a query
+        (and an upper bound of the modification times of its objects as an
+        ISO 8601 string if given).  Remove the checkpoint if next_page is None
+        (i.e. the download is complete).
+        """
+        with self.database.bind.begin() as connection:
+            self._save_checkpoint(connection, endpoint_selector, server, query,
+                                  next_page, upper_bound)
+
+    def _save_checkpoint(self, connection, endpoint_selector, server, query,
+                         next_page, upper_bound=None):
+        self._validate_endpoint_selector(endpoint_selector)
+        connection.execute(self._checkpoints.delete().where(sqlalchemy.and_(
+            self._checkpoints.c.endpoint == endpoint_selector,
+            self._checkpoints.c.server == server,
+            self._checkpoints.c.query == query)))
+        if next_page is not None:
+            connection.execute(self._checkpoints.insert(), {
+                'endpoint': endpoint_selector,
+                'server': server,
+                'query': query,
+                'next_page': next_page,
+                'upper_bound': upper_bound
+            })
+
+    def _validate_endpoint_selector(self, endpoint_selector):
+        if endpoint_selector not in ('--flow-runs', '--flows', '--contacts'):
+            raise ValueError(self.INVALID_ENDPOINT_SELECTOR.format(
+                endpoint_selector))
+
+    @classmethod
+    def _initialise_database(cls, database_url):
         engine = sqlalchemy.create_engine(database_url)
         metadata = sqlalchemy.MetaData(bind=engine)
         # Using Text for storing JSON data since sqlalchemy.types.JSON is not
-        # supported on all database platforms yet.
+        # supported on all database platforms yet.  The EXTRACTED_COLUMNS
+        # store dates and times as ISO 8601 strings (like sync_state).
         sqlalchemy.Table(
             'flow', metadata,
             sqlalchemy.Column('uuid', sqlalchemy.String(36), primary_key=True),
-            sqlalchemy.Column('json', sqlalchemy.Text)
+            sqlalchemy.Column('json', sqlalchemy.Text),
+            sqlalchemy.Column('created_on', sqlalchemy.String(32), index=True)
         )
         sqlalchemy.Table(
             'contact', metadata,
             sqlalchemy.Column('uuid', sqlalchemy.String(36), primary_key=True),
-            sqlalchemy.Column('json', sqlalchemy.Text)
+            sqlalchemy.Column('json', sqlalchemy.Text),
+            sqlalchemy.Column('modified_on', sqlalchemy.String(32),
+                              index=True)
         )
         sqlalchemy.Table(
             'flowrun', metadata,
             sqlalchemy.Column('run', sqlalchemy.Integer, primary_key=True),
             sqlalchemy.Column('json', sqlalchemy.Text),
-            sqlalchemy.Column('flow_uuid', sqlalchemy.ForeignKey('flow.uuid')),
+            sqlalchemy.Column('flow_uuid', sqlalchemy.ForeignKey('flow.uuid'),
+                              index=True),
             sqlalchemy.Column('contact_uuid',
-                              sqlalchemy.ForeignKey('contact.uuid'))
+                              sqlalchemy.ForeignKey('contact.uuid'),
+                              index=True),
+            sqlalchemy.Column('created_on', sqlalchemy.String(32), index=True),
+            sqlalchemy.Column('modified_on', sqlalchemy.String(32),
+                              index=True),
+            sqlalchemy.Column('completed', sqlalchemy.Boolean(
+                create_constraint=False), index=True)
+        )
+        # The most recent modification (or creation) date and time of objects
+        # downloaded so far from each endpoint of each RapidPro server.
+        sqlalchemy.Table(
+            'sync_state', metadata,
+            sqlalchemy.Column('endpoint', sqlalchemy.String(16),
+                              primary_key=True),
+            sqlalchemy.Column('server', sqlalchemy.String(255),
+                              primary_key=True),
+            sqlalchemy.Column('high_water_mark', sqlalchemy.String(32))
+        )
+        # The next page of each interrupted download (identified by a digest of
+        # its query) and the modification time its objects are requested before
+        # (pinned when the download started so that the pages do not shift).
+        sqlalchemy.Table(
+            'checkpoint', metadata,
+            sqlalchemy.Column('endpoint', sqlalchemy.String(16),
+                              primary_key=True),
+            sqlalchemy.Column('server', sqlalchemy.String(255),
+                              primary_key=True),
+            sqlalchemy.Column('query', sqlalchemy.String(40),
+                              primary_key=True),
+            sqlalchemy.Column('next_page', sqlalchemy.Integer),
+            sqlalchemy.Column('upper_bound', sqlalchemy.String(32))
         )
         metadata.create_all()
+        cls._migrate_database(metadata)
         return metadata
 
-    def _insert_object(self, rapidpro_object):
-        if isinstance(rapidpro_object, temba_client.v1.types.Run):
-            exists = self._flowruns.select(sqlalchemy.exists().where(
-                self._flowruns.c.run == rapidpro_object.id))
-            insert = self._flowruns.insert()
+    @classmethod
+    def _migrate_database(cls, metadata):
+        """
+        Bring tables created by earlier versions up to date: add the columns
+        and indexes they lack and fill in the added EXTRACTED_COLUMNS from the
+        JSON of the objects already stored (in batches of DEFAULT_BATCH_SIZE).
+        Columns added to the checkpoint table are left empty.
+        """
+        engine = metadata.bind
+        inspector = sqlalchemy.inspect(engine)
+        preparer = engine.dialect.identifier_preparer
+        for table_name in list(cls.EXTRACTED_COLUMNS) + ['checkpoint']:
+            table = metadata.tables[table_name]
+            existing = {c['name'] for c in inspector.get_columns(table_name)}
+            added = [c for c in table.columns if c.name not in existing]
+            with engine.begin() as connection:
+                for column in added:
+                    connection.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                        preparer.format_table(table),
+                        preparer.format_column(column),
+                        column.type.compile(dialect=engine.dialect)))
+                if added and table_name in cls.EXTRACTED_COLUMNS:
+                    cls._fill_extracted_columns(connection, table)
+            indexes = {i['name'] for i in inspector.get_indexes(table_name)}
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(engine)
+
+    @classmethod
+    def _fill_extracted_columns(cls, connection, table):
+        """Fill in the EXTRACTED_COLUMNS of all records of a table."""
+        pk = cls._get_primary_key(table)
+        update = table.update().where(pk == sqlalchemy.bindparam('key_'))
+        last_key = None
+        while True:
+            select = sqlalchemy.select([pk, table.c.json]).order_by(pk) \
+                .limit(cls.DEFAULT_BATCH_SIZE)
+            if last_key is not None:
+                select = select.where(pk > last_key)
+            rows = connection.execute(select).fetchall()
+            if not rows:
+                return
+            values = []
+            for key, text in rows:
+                record = cls._extract_columns(
+                    table.name, rapidpropull.codec.loads(text))
+                record['key_'] = key
+                values.append(record)
+            connection.execute(update, values)
+            last_key = rows[-1][0]
+
+    def _get_record(self, table, rapidpro_object):
+        """
+        Return a database record representing a RapidPro object stored in a
+        table.  The JSON text of CachedJSON and LazyObject is stored as it is
+        (decoded only if the values of the EXTRACTED_COLUMNS are not known
+        otherwise).
+        """
+        if isinstance(rapidpro_object, (rapidpropull.codec.CachedJSON,
+                                        rapidpropull.codec.LazyObject)):
+            text = rapidpro_object.to_json()
+            item = getattr(rapidpro_object, 'fields', None)
+            if item is None:
+                item = rapidpropull.codec.loads(text)
+        else:
+            item = rapidpro_object.serialize()
+            text = rapidpropull.codec.dumps(item)
+        if table is self._flowruns:
             record = {
                 'run': rapidpro_object.id,
-                'json': json.dumps(rapidpro_object.serialize()),
+                'json': text,
                 'contact_uuid': rapidpro_object.contact,
                 'flow_uuid': rapidpro_object.flow
             }
-        elif isinstance(rapidpro_object, temba_client.v1.types.Flow):
-            exists = self._flows.select(sqlalchemy.exists().where(
-                self._flows.c.uuid == rapidpro_object.uuid))
-            insert = self._flows.insert()
-            record = {
-                'uuid': rapidpro_object.uuid,
-                'json': json.dumps(rapidpro_object.serialize()),
-            }
-        elif isinstance(rapidpro_object, temba_client.v1.types.Contact):
-            exists = self._contacts.select(sqlalchemy.exists().where(
-                self._contacts.c.uuid == rapidpro_object.uuid))
-            insert = self._contacts.insert()
+        else:
             record = {
                 'uuid': rapidpro_object.uuid,
-                'json': json.dumps(rapidpro_object.serialize()),
+                'json': text,
             }
+        record.update(self._extract_columns(table.name, item))
+        return record
+
+    @classmethod
+    def _extract_columns(cls, table_name, item):
+        """
+        Return a dictionary with the values of the EXTRACTED_COLUMNS of a
+        table taken from the JSON structure of an object (dates and times are
+        kept as ISO 8601 strings, which sort chronologically).
+        """
+        return {name: item.get(name)
+                for name in cls.EXTRACTED_COLUMNS[table_name]}
+
+    def _get_table(self, rapidpro_object):
+        """
+        Return the table a RapidPro object (an instance of Contact, Flow, Run
+        or CachedJSON) belongs to.
+        """
+        if isinstance(rapidpro_object, rapidpropull.codec.CachedJSON):
+            object_type = rapidpro_object.type
+            for table in self._types:
+                if self._types[table] is object_type:
+                    return table
         else:
-            raise TypeError(self.INVALID_TYPE.format(type(rapidpro_object)))
-        if not self.database.bind.execute(exists).scalar():
-            self.database.bind.execute(insert, record)
+            for table in self._types:
+                if isinstance(rapidpro_object, self._types[table]):
+                    return table
+        raise TypeError(self.INVALID_TYPE.format(type(rapidpro_object)))
+
+    @staticmethod
+    def _get_primary_key(table):
+        return list(table.primary_key.columns)[0]
+
+    def _insert_new_objects(self, connection, table, objects):
+        """
+        Insert records of those of the objects which are neither in the table
+        already nor preceded by an object with the same primary key.  Return a
+        list of the inserted records.
+        """
+        pk = self._get_primary_key(table)
+        keys = [o.id if table is self._flowruns else o.uuid for o in objects]
+        existing = {row[0] for row in connection.execute(
+            sqlalchemy.select([pk]).where(pk.in_(set(keys))))}
+        new_records = []
+        for key, o in zip(keys, objects):
+            if key not in existing:
+                existing.add(key)
+                new_records.append(self._get_record(table, o))
+        if new_records:
+            connection.execute(table.insert(), new_records)
+        return new_records
+
+
+class LRUCache(object):
+    """
+    A bounded in-memory mapping which discards the least recently used entries
+    once it holds more than max_entries entries or entries of more than
+    max_bytes bytes in total (as estimated by the sizes given when the entries
+    were stored).  A limit of None means no limit.  Safe to use by multiple
+    threads.
+    """
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """
+        Return the value stored under key (marking it as the most recently
+        used) or default if there is no such value.
+        """
+        with self._lock:
+            try:
+                value, size = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries[key] = (value, size)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, size=0):
+        """
+        Store value under key as the most recently used entry and discard the
+        least recently used entries exceeding the limits.
+        """
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while self._entries and (
+                    (self.max_entries is not None and
+                     len(self._entries) > self.max_entries) or
+                    (self.max_bytes is not None and
+                     self._bytes > self.max_bytes)):
+                _, (_, discarded_size) = self._entries.popitem(last=False)
+                self._bytes -= discarded_size
+
+    def get_statistics(self):
+        """Return a dictionary with the numbers of hits and misses."""
+        statistics = {'memory cache hits': self.hits,
+                      'memory cache misses': self.misses}
+        if self.hits + self.misses:
+            statistics['memory cache hit rate'] = '{:.1%}'.format(
+                float(self.hits) / (self.hits + self.misses))
+        return statistics
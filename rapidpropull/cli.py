@@ -3,15 +3,57 @@ Usage:
   rapidpro-pull --flow-runs --api-token=<api-token> [--address=<address>]
                             [--before=<before> --after=<after>]
                             [--with-contacts --with-flows]
-                            [--cache=<database-url>]
+                            [--cache=<database-url>] [--stream] [--compact]
+                            [--parallel=<n>] [--concurrent-pages=<n>]
+                            [--prefetch=<n>] [--decode-workers=<n>]
+                            [--decode-chunk-size=<n>]
+                            [--incremental [--overlap=<seconds>]] [--resume]
+                            [--cache-batch-size=<n>]
+                            [--cache-lookup-chunk-size=<n>]
+                            [--cache-workers=<n>]
+                            [--cache-memory-entries=<n>]
+                            [--cache-memory-bytes=<n>] [--passthrough]
+                            [--format=<format>] [--statistics]
+                            [--output=<path> [--rotate-size=<bytes>]]
+                            [--json-backend=<backend>]
+                            [--http-pool-size=<n>] [--no-keep-alive] [--no-gzip]
+                            [--max-rate=<n>] [--max-retries=<n>]
   rapidpro-pull --flows --api-token=<api-token> [--address=<address>]
                             [--before=<before> --after=<after>]
                             [--uuid=<uuid> ...]
-                            [--cache=<database-url>]
+                            [--cache=<database-url>] [--stream] [--compact]
+                            [--parallel=<n>] [--concurrent-pages=<n>]
+                            [--prefetch=<n>] [--decode-workers=<n>]
+                            [--decode-chunk-size=<n>]
+                            [--incremental [--overlap=<seconds>]] [--resume]
+                            [--cache-batch-size=<n>]
+                            [--cache-lookup-chunk-size=<n>]
+                            [--cache-workers=<n>]
+                            [--cache-memory-entries=<n>]
+                            [--cache-memory-bytes=<n>] [--passthrough]
+                            [--format=<format>] [--statistics]
+                            [--output=<path> [--rotate-size=<bytes>]]
+                            [--json-backend=<backend>]
+                            [--http-pool-size=<n>] [--no-keep-alive] [--no-gzip]
+                            [--max-rate=<n>] [--max-retries=<n>]
   rapidpro-pull --contacts --api-token=<api-token> [--address=<address>]
                             [--before=<before> --after=<after>]
                             [--uuid=<uuid> ...]
-                            [--cache=<database-url>]
+                            [--cache=<database-url>] [--stream] [--compact]
+                            [--parallel=<n>] [--concurrent-pages=<n>]
+                            [--prefetch=<n>] [--decode-workers=<n>]
+                            [--decode-chunk-size=<n>]
+                            [--incremental [--overlap=<seconds>]] [--resume]
+                            [--cache-batch-size=<n>]
+                            [--cache-lookup-chunk-size=<n>]
+                            [--cache-workers=<n>]
+                            [--cache-memory-entries=<n>]
+                            [--cache-memory-bytes=<n>] [--passthrough]
+                            [--format=<format>] [--statistics]
+                            [--output=<path> [--rotate-size=<bytes>]]
+                            [--json-backend=<backend>]
+                            [--http-pool-size=<n>] [--no-keep-alive] [--no-gzip]
+                            [--max-rate=<n>] [--max-retries=<n>]
   rapidpro-pull --help
 
 Options:
@@ -35,16 +77,105 @@ Options:
                                      objects in cache; retrieve objects from
                                      cache instead of downloading from RapidPro
                                      when possible)
+  --cache-batch-size=<n>             store objects in cache in batches of up to
+                                     n objects (500 by default)
+  --cache-lookup-chunk-size=<n>      look objects up in cache in chunks of up
+                                     to n IDs (500 by default)
+  --cache-workers=<n>                look chunks up over up to n concurrent
+                                     database connections (1 by default)
+  --cache-memory-entries=<n>         keep up to n recently used cached objects
+                                     in memory (10000 by default; 0 disables)
+  --cache-memory-bytes=<n>           keep cached objects taking up to n bytes
+                                     of JSON in memory (no limit by default)
+  --passthrough                      print objects found in cache as stored
+                                     instead of converting them to RapidPro
+                                     objects and back (requires --cache)
+
+  --stream                           download, cache and print data page by
+                                     page instead of keeping all downloaded
+                                     objects in memory (associated objects
+                                     are kept in temporary files until the
+                                     last page)
+  --compact                          keep downloaded objects in memory as
+                                     compact JSON records instead of RapidPro
+                                     objects until they are printed (not
+                                     allowed with --stream or --resume)
+
+  --parallel=<n>                     split the time window given with --after
+                                     and --before into n parts and download
+                                     them concurrently; download associated
+                                     flows and contacts in up to n concurrent
+                                     requests [default: 1]
+  --concurrent-pages=<n>             request up to n pages of objects at a
+                                     time once the number of pages is known
+                                     from the first page [default: 1]
+  --prefetch=<n>                     download, process and cache pages in
+                                     stages running on separate threads with
+                                     up to n pages queued between stages (0
+                                     processes one page at a time)
+                                     [default: 1]
+  --decode-workers=<n>               deserialise downloaded objects on a pool
+                                     of n processes (1 deserialises them in
+                                     the main process) [default: 1]
+  --decode-chunk-size=<n>            send objects to decoding processes in
+                                     chunks of n objects [default: 50]
+
+  --incremental                      download only objects newer than those
+                                     downloaded by the previous incremental
+                                     download from the same RapidPro server
+                                     (requires --cache; overridden by --after;
+                                     not recorded by downloads filtered by
+                                     UUID)
+  --overlap=<seconds>                start an incremental download this many
+                                     seconds before the most recent object
+                                     downloaded previously [default: 60]
+
+  --resume                           continue an interrupted download with the
+                                     same options from its last page stored in
+                                     cache (requires --cache; implies --stream;
+                                     objects downloaded before the interruption
+                                     are only stored in cache; pages not stored
+                                     yet are downloaded again)
+
+  --format=<format>                  print objects as a JSON document (json)
+                                     or as newline-delimited JSON with one
+                                     object per line (ndjson) [default: json]
+  --output=<path>                    write to a file instead of stdout
+                                     (compressed if path ends with .gz, .bz2
+                                     or .xz)
+  --rotate-size=<bytes>              split output into numbered files (e.g.
+                                     runs-0001.ndjson.gz) of about this many
+                                     bytes before compression (ndjson only)
+  --json-backend=<backend>           encode and decode JSON with orjson,
+                                     rapidjson, ujson or json (the standard
+                                     library); auto picks the first one of
+                                     them installed [default: auto]
+
+  --http-pool-size=<n>               keep up to n connections to RapidPro open
+                                     for reuse by all requests (10 by default)
+  --no-keep-alive                    close the connection after each request
+  --no-gzip                          do not ask RapidPro to compress responses
+  --max-rate=<n>                     send at most n requests per second (no
+                                     limit by default; concurrent requests are
+                                     reduced automatically when RapidPro
+                                     responds that its rate limit is exceeded)
+  --max-retries=<n>                  retry requests failed due to rate limits,
+                                     server overload or connection errors up
+                                     to n times (5 by default)
+
+  --statistics                       print statistics (e.g. cache hits and
+                                     misses) to stderr after the download
 """
 from __future__ import print_function
 import sys
-import json
 
 import temba_client.v1
 import temba_client.exceptions
 import docopt
 
+import rapidpropull.codec
 import rapidpropull.download
+import rapidpropull.output
 
 __author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
 __copyright__ = 'Copyright (c) 2016, Tomasz J. Kotarba. All rights reserved.'
@@ -67,6 +198,12 @@ class ArgumentProcessor(object):
         '--flows',
         '--contacts'
     ]
+    INVALID_INTEGER = 'Invalid value of {} "{}".  An integer not less than {}' \
+                      ' is required.'
+    OPTION_REQUIRES_CACHE = '{} requires --cache.'
+    INVALID_FORMAT = 'Invalid value of --format "{}".  One of: {} is required.'
+    ROTATION_REQUIRES_NDJSON = '--rotate-size requires --format=ndjson.'
+    COMPACT_NOT_STREAMED = '--compact cannot be used with --stream or --resume.'
 
     def __init__(self, argv=None):
         """
@@ -130,6 +267,188 @@ class ArgumentProcessor(object):
         """Return a URL to a database to be used as cache (if provided)."""
         return self.arguments['--cache']
 
+    def get_parallel(self):
+        """
+        Return the number of concurrent requests the user allowed to be sent to
+        RapidPro (1 by default).
+        """
+        return self._get_integer('--parallel', minimum=1)
+
+    def get_concurrent_pages(self):
+        """
+        Return the number of pages of objects the user allowed to be
+        requested at a time (1 by default).
+        """
+        return self._get_integer('--concurrent-pages', minimum=1)
+
+    def get_prefetch(self):
+        """
+        Return the number of pages the user allowed to be queued between the
+        stages of a download (0 if stages should not overlap).
+        """
+        return self._get_integer('--prefetch', minimum=0)
+
+    def get_decode_workers(self):
+        """
+        Return the number of processes the user allowed to be used to
+        deserialise downloaded objects (1 by default).
+        """
+        return self._get_integer('--decode-workers', minimum=1)
+
+    def get_decode_chunk_size(self):
+        """
+        Return the number of objects the user wants deserialised at a time by
+        each decoding process (50 by default).
+        """
+        return self._get_integer('--decode-chunk-size', minimum=1)
+
+    def get_cache_kwargs(self):
+        """
+        Return a dictionary of optional arguments the user has provided to
+        tune the cache (see: RapidProCache).
+        """
+        kwargs = {}
+        if self.arguments['--cache-batch-size'] is not None:
+            kwargs['batch_size'] = self._get_integer('--cache-batch-size',
+                                                     minimum=1)
+        if self.arguments['--cache-lookup-chunk-size'] is not None:
+            kwargs['lookup_chunk_size'] = self._get_integer(
+                '--cache-lookup-chunk-size', minimum=1)
+        if self.arguments['--cache-workers'] is not None:
+            kwargs['lookup_workers'] = self._get_integer('--cache-workers',
+                                                         minimum=1)
+        if self.arguments['--cache-memory-entries'] is not None:
+            kwargs['memory_entries'] = self._get_integer(
+                '--cache-memory-entries', minimum=0)
+        if self.arguments['--cache-memory-bytes'] is not None:
+            kwargs['memory_bytes'] = self._get_integer('--cache-memory-bytes',
+                                                       minimum=0)
+        if self._get_cache_dependent_flag('--passthrough'):
+            kwargs['passthrough'] = True
+        return kwargs
+
+    def get_session_kwargs(self):
+        """
+        Return a dictionary of optional arguments the user has provided to
+        tune the HTTP session used to send requests (see: PooledSession and
+        Throttle).
+        """
+        kwargs = {}
+        if self.arguments['--http-pool-size'] is not None:
+            kwargs['pool_size'] = self._get_integer('--http-pool-size',
+                                                    minimum=1)
+        if self.arguments['--no-keep-alive']:
+            kwargs['keep_alive'] = False
+        if self.arguments['--no-gzip']:
+            kwargs['gzip'] = False
+        if self.arguments['--max-rate'] is not None:
+            kwargs['max_rate'] = self._get_integer('--max-rate', minimum=1)
+        if self.arguments['--max-retries'] is not None:
+            kwargs['max_retries'] = self._get_integer('--max-retries',
+                                                      minimum=0)
+        return kwargs
+
+    def get_streaming(self):
+        """Return True if the user requested page by page processing."""
+        return self.arguments['--stream']
+
+    def get_compact(self):
+        """
+        Return True if the user requested downloaded objects to be kept in
+        memory as compact records.  Objects are only kept in memory without
+        --stream (or --resume) so --compact is not allowed with either.
+        """
+        if self.arguments['--compact'] and (self.arguments['--stream'] or
+                                            self.arguments['--resume']):
+            raise docopt.DocoptExit(self.COMPACT_NOT_STREAMED)
+        return self.arguments['--compact']
+
+    def get_output_format(self):
+        """Return the output format requested by the user (json or ndjson)."""
+        output_format = self.arguments['--format']
+        if output_format not in rapidpropull.output.WRITERS:
+            raise docopt.DocoptExit(self.INVALID_FORMAT.format(
+                output_format,
+                ', '.join(sorted(rapidpropull.output.WRITERS))))
+        return output_format
+
+    def get_output_path(self):
+        """
+        Return the path of a file the output should be written to (or None if
+        it should be written to stdout).
+        """
+        path = self.arguments['--output']
+        if path is not None:
+            try:
+                rapidpropull.output.get_opener(path)
+            except ValueError as e:
+                raise docopt.DocoptExit(str(e))
+        return path
+
+    def get_rotate_size(self):
+        """
+        Return the number of bytes after which the output should be continued
+        in the next numbered file (or None if the output should not be split).
+        """
+        if self.arguments['--rotate-size'] is None:
+            return None
+        if self.get_output_format() != 'ndjson':
+            raise docopt.DocoptExit(self.ROTATION_REQUIRES_NDJSON)
+        return self._get_integer('--rotate-size', minimum=1)
+
+    def get_json_backend(self):
+        """
+        Return the name of the JSON backend requested by the user (or 'auto').
+        """
+        name = self.arguments['--json-backend']
+        backends = rapidpropull.codec.BACKENDS
+        if name != 'auto' and name not in backends:
+            raise docopt.DocoptExit(
+                rapidpropull.codec.UNAVAILABLE_BACKEND.format(
+                    name, ', '.join(backends)))
+        return name
+
+    def get_statistics(self):
+        """Return True if the user requested statistics of the download."""
+        return self.arguments['--statistics']
+
+    def get_incremental(self):
+        """
+        Return True if the user requested an incremental download (i.e. one
+        starting where the previous incremental download finished).
+        """
+        return self._get_cache_dependent_flag('--incremental')
+
+    def get_overlap(self):
+        """
+        Return the number of seconds an incremental download should overlap
+        with the previous one.
+        """
+        return self._get_integer('--overlap', minimum=0)
+
+    def get_resume(self):
+        """
+        Return True if the user requested to continue an interrupted download
+        from its last checkpoint stored in cache.
+        """
+        return self._get_cache_dependent_flag('--resume')
+
+    def _get_integer(self, option, minimum):
+        value = self.arguments[option]
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            value = None
+        if value is None or value < minimum:
+            raise docopt.DocoptExit(self.INVALID_INTEGER.format(
+                option, self.arguments[option], minimum))
+        return value
+
+    def _get_cache_dependent_flag(self, option):
+        if self.arguments[option] and self.get_cache_url() is None:
+            raise docopt.DocoptExit(self.OPTION_REQUIRES_CACHE.format(option))
+        return self.arguments[option]
+
 
 def main(argv=None):
     """
@@ -137,14 +456,61 @@ def main(argv=None):
     command.
     """
     arguments = ArgumentProcessor(argv)
+    rapidpropull.codec.set_backend(arguments.get_json_backend())
     downloader = rapidpropull.download.DownloadTask(arguments)
+    streaming = arguments.get_streaming() or arguments.get_resume()
+    selectors_of_associations = \
+        arguments.get_selectors_of_requested_associations()
+    writer_class = rapidpropull.output.WRITERS[arguments.get_output_format()]
+    output_path = arguments.get_output_path()
+    if output_path is None:
+        output = sys.stdout
+    else:
+        output = rapidpropull.output.OutputFile(output_path,
+                                                arguments.get_rotate_size())
     try:
-        downloader.download()
+        if streaming:
+            _print_pages(downloader.download_pages(), writer_class,
+                         selectors_of_associations, output)
+        else:
+            downloader.download()
     except temba_client.exceptions.TembaConnectionError:
         print('Unable to connect to host', file=sys.stderr)
         sys.exit(1)
     except temba_client.exceptions.TembaTokenError:
         print('Authentication with provided token failed', file=sys.stderr)
         sys.exit(1)
+    except temba_client.exceptions.TembaRateExceededError:
+        print('Rate limit of the host exceeded (out of retries)',
+              file=sys.stderr)
+        sys.exit(1)
     else:
-        print(json.dumps(downloader.get_downloaded_json_structure()))
+        if not streaming:
+            _print_pages([downloader.get_downloaded_records()],
+                         writer_class, selectors_of_associations, output)
+        if arguments.get_statistics():
+            _print_statistics(downloader.get_statistics())
+    finally:
+        if output_path is not None:
+            output.close()
+
+
+def _print_statistics(statistics):
+    """Print statistics of a download to stderr (one per line, sorted)."""
+    for name in sorted(statistics):
+        print('{}: {}'.format(name, statistics[name]), file=sys.stderr)
+
+
+def _print_pages(pages, writer_class, selectors_of_associations, output):
+    """
+    Print pages (e.g. yielded by DownloadTask.download_pages()) to output (a
+    text stream) as they arrive using a writer of the requested output format
+    (see: JSONWriter).  Nothing more is printed if downloading a page fails.
+    """
+    writer = writer_class(output, selectors_of_associations)
+    try:
+        for page in pages:
+            writer.write_page(page)
+        writer.finish()
+    finally:
+        writer.close()
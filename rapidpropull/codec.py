@@ -0,0 +1,208 @@
+import collections
+import json
+
+import temba_client.v1.types
+
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2016, Tomasz J. Kotarba. All rights reserved.'
+__maintainer__ = 'Tomasz J. Kotarba'
+__email__ = 'tomasz@kotarba.net'
+
+UNAVAILABLE_BACKEND = 'JSON backend "{}" is not available.  Available: {}.'
+
+# (dumps, loads) of each of the installed backends in the order of preference
+# (used by the cache and the output instead of calling json directly).
+BACKENDS = collections.OrderedDict()
+try:
+    # noinspection PyPackageRequirements
+    import orjson
+    BACKENDS['orjson'] = (lambda o: orjson.dumps(o).decode('utf-8'),
+                          orjson.loads)
+except ImportError:
+    pass
+try:
+    # noinspection PyPackageRequirements
+    import rapidjson
+    BACKENDS['rapidjson'] = (rapidjson.dumps, rapidjson.loads)
+except ImportError:
+    pass
+try:
+    # noinspection PyPackageRequirements
+    import ujson
+    BACKENDS['ujson'] = (ujson.dumps, ujson.loads)
+except ImportError:
+    pass
+BACKENDS['json'] = (json.dumps, json.loads)
+
+backend = None
+dumps = None
+loads = None
+
+
+def set_backend(name='auto'):
+    """
+    Use the named backend (one of BACKEND_NAMES) to encode and decode JSON or
+    the fastest of the installed backends if name is 'auto'.  Raise ValueError
+    if the backend is not installed.
+    """
+    global backend, dumps, loads
+    if name == 'auto':
+        name = next(iter(BACKENDS))
+    if name not in BACKENDS:
+        raise ValueError(UNAVAILABLE_BACKEND.format(
+            name, ', '.join(BACKENDS)))
+    backend = name
+    dumps, loads = BACKENDS[name]
+
+
+set_backend()
+
+# The fields of objects which CachedJSON keeps alongside their JSON text (as
+# in JSON, e.g. dates and times as ISO 8601 strings) so that the cache can
+# store them in their own columns without decoding the text again.
+EXTRACTED_FIELDS = ('created_on', 'modified_on', 'completed')
+
+
+class CachedJSON(object):
+    """
+    A RapidPro object carried as its JSON text - e.g. as stored in cache (i.e.
+    without the cost of deserialising and serialising it again) or as a
+    compact record taking a fraction of the memory of the object.  Only the
+    attributes needed to identify the object and its associations are
+    available (id, flow and contact for flow runs; uuid for flows and
+    contacts).  The type is the class of the object (Contact, Flow or Run).
+    The fields are a dictionary of those of the EXTRACTED_FIELDS of the object
+    which are known without decoding its JSON text (None if unknown).
+    """
+    __slots__ = ('type', 'json', 'fields', 'id', 'uuid', 'flow', 'contact')
+
+    def __init__(self, object_type, json_text, fields=None, **attributes):
+        self.type = object_type
+        self.json = json_text
+        self.fields = fields
+        for name, value in attributes.items():
+            setattr(self, name, value)
+
+    @classmethod
+    def from_object(cls, rapidpro_object):
+        """
+        Return a RapidPro object (an instance of Contact, Flow or Run) as
+        CachedJSON (or the object unchanged if it already is CachedJSON).
+        """
+        if isinstance(rapidpro_object, cls):
+            return rapidpro_object
+        elif isinstance(rapidpro_object, LazyObject):
+            object_type = rapidpro_object.TYPE
+            text = rapidpro_object.to_json()
+            fields = None
+        else:
+            object_type = type(rapidpro_object)
+            item = rapidpro_object.serialize()
+            text = dumps(item)
+            fields = {k: item[k] for k in EXTRACTED_FIELDS if k in item}
+        if issubclass(object_type, temba_client.v1.types.Run):
+            return cls(object_type, text, fields, id=rapidpro_object.id,
+                       flow=rapidpro_object.flow,
+                       contact=rapidpro_object.contact)
+        return cls(object_type, text, fields, uuid=rapidpro_object.uuid)
+
+    def serialize(self):
+        """Return the JSON structure of the object (see: TembaObject)."""
+        return loads(self.json)
+
+    def to_json(self):
+        """Return the JSON text of the object."""
+        return self.json
+
+    def deserialize(self):
+        """Return the object as an instance of its type."""
+        return self.type.deserialize(loads(self.json))
+
+
+class LazyObject(object):
+    """
+    A RapidPro object (an instance of a subclass of TYPE) made from its JSON
+    text without deserialising it - e.g. when read from cache.  The
+    EAGER_ATTRIBUTES (needed to identify the object and its associations) are
+    given when the object is made.  The other attributes are decoded from the
+    JSON text on first access so that objects which are only passed through
+    (identified, associated and written out) are never decoded.
+    """
+    TYPE = None
+    EAGER_ATTRIBUTES = ()
+
+    def __init__(self, json_text, **attributes):
+        self.__dict__.update(attributes)
+        self._json = json_text
+        self._decoded = False
+
+    @classmethod
+    def _get_fields(cls):
+        return cls.TYPE._get_fields()
+
+    @classmethod
+    def deserialize(cls, item):
+        return cls.TYPE.deserialize(item)
+
+    def is_decoded(self):
+        """Return True if the JSON text of the object has been decoded."""
+        return self._decoded
+
+    def serialize(self):
+        """Return the JSON structure of the object (see: TembaObject)."""
+        if not self._decoded:
+            return loads(self._json)
+        return super(LazyObject, self).serialize()
+
+    def to_json(self):
+        """
+        Return the JSON text of the object (the text it was made from unless
+        it has been decoded and so might have been modified).
+        """
+        if not self._decoded:
+            return self._json
+        return dumps(self.serialize())
+
+    def _decode(self):
+        if self._decoded:
+            return
+        decoded = self.TYPE.deserialize(loads(self._json))
+        for name in self._get_fields():
+            if name not in self.EAGER_ATTRIBUTES:
+                self.__dict__[name] = getattr(decoded, name)
+        self._decoded = True
+
+
+def _make_lazy_attribute(name):
+    """Return a property decoding a LazyObject on first access to name."""
+    def get(self):
+        self._decode()
+        return self.__dict__[name]
+
+    def set_value(self, value):
+        self._decode()
+        self.__dict__[name] = value
+    return property(get, set_value)
+
+
+class LazyRun(LazyObject, temba_client.v1.types.Run):
+    TYPE = temba_client.v1.types.Run
+    EAGER_ATTRIBUTES = ('id', 'flow', 'contact')
+
+
+class LazyFlow(LazyObject, temba_client.v1.types.Flow):
+    TYPE = temba_client.v1.types.Flow
+    EAGER_ATTRIBUTES = ('uuid',)
+
+
+class LazyContact(LazyObject, temba_client.v1.types.Contact):
+    TYPE = temba_client.v1.types.Contact
+    EAGER_ATTRIBUTES = ('uuid',)
+
+
+# The lazy counterparts of the types of RapidPro objects.
+LAZY_TYPES = {t.TYPE: t for t in (LazyRun, LazyFlow, LazyContact)}
+for _lazy_type in LAZY_TYPES.values():
+    for _name in _lazy_type.TYPE._get_fields():
+        if _name not in _lazy_type.EAGER_ATTRIBUTES:
+            setattr(_lazy_type, _name, _make_lazy_attribute(_name))
@@ -1,6 +1,30 @@
+import collections
+import datetime
+import functools
+import hashlib
+import importlib
+import json
+import math
+import multiprocessing
+import threading
+from multiprocessing.pool import ThreadPool
+try:
+    # PY3
+    # noinspection PyCompatibility
+    import queue
+except ImportError:
+    # PY2
+    # noinspection PyPep8Naming
+    import Queue as queue
+
 import temba_client.v1
+import temba_client.v1.types
+import temba_client.utils
 
-import rapidpropull.cache
+import rapidpropull.codec
+import rapidpropull.interning
+import rapidpropull.pipeline
+import rapidpropull.session
 
 __author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
 __copyright__ = 'Copyright (c) 2016, Tomasz J. Kotarba. All rights reserved.'
@@ -14,21 +38,75 @@ class DownloadTask(object):
     them.  The downloaded data can be represented as RapidPro objects (see:
     rapidpro-python) or serialised to JSON.
     """
+    # Sub-windows of a time window downloaded in parallel overlap slightly in
+    # case RapidPro treats either of the window boundaries as exclusive.
+    SHARD_OVERLAP = datetime.timedelta(milliseconds=1)
+    # The attribute used to track the most recent of the downloaded objects.
+    TIMESTAMP_ATTRIBUTES = {
+        '--flow-runs': 'modified_on',
+        '--flows': 'created_on',
+        '--contacts': 'modified_on'
+    }
+    # The maximum number of UUIDs in a single request for objects associated
+    # with flow runs (keeps the query string well below common URL limits).
+    ASSOCIATION_BATCH_SIZE = 100
+    # The format (ISO 8601 in UTC) of the upper bound of the modification
+    # times of objects downloaded page by page (see: _get_shard_pages).
+    UPPER_BOUND_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+    # The API endpoint, the type of objects and the query parameters (by the
+    # arguments of the TembaClient method) of each endpoint selector used to
+    # request objects without deserialising them (see: _request_and_decode).
+    # They mirror the private parameter mapping of TembaClient (which is why
+    # rapidpro-python is pinned to a minor version; tested against it).
+    RAW_ENDPOINTS = {
+        '--flow-runs': ('runs', temba_client.v1.types.Run,
+                        {'before': 'before', 'after': 'after'}),
+        '--flows': ('flows', temba_client.v1.types.Flow,
+                    {'uuids': 'uuid', 'before': 'before', 'after': 'after'}),
+        '--contacts': ('contacts', temba_client.v1.types.Contact,
+                       {'uuids': 'uuid', 'before': 'before', 'after': 'after'})
+    }
+
     def __init__(self, processed_arguments):
-        """Create a download task for the specified ArgumentProcessor."""
+        """
+        Create a download task for the specified ArgumentProcessor.  All
+        requests sent to RapidPro while the task downloads are sent with a
+        pooled session (see: PooledSession) shared by all endpoints.
+        """
+        self.address = processed_arguments.get_address()
         self.client = temba_client.v1.TembaClient(
-            processed_arguments.get_address(),
-            processed_arguments.get_api_token())
+            self.address, processed_arguments.get_api_token())
+        self.session = rapidpropull.session.PooledSession(
+            **processed_arguments.get_session_kwargs())
         self.endpoint_selector = processed_arguments.get_endpoint_selector()
         self.endpoint_kwargs = processed_arguments.get_endpoint_kwargs()
         self.selectors_of_requested_associations =\
             processed_arguments.get_selectors_of_requested_associations()
+        self.parallel = processed_arguments.get_parallel()
+        self.concurrent_pages = processed_arguments.get_concurrent_pages()
+        self.prefetch = processed_arguments.get_prefetch()
+        self.decode_workers = processed_arguments.get_decode_workers()
+        self.decode_chunk_size = processed_arguments.get_decode_chunk_size()
+        self.compact = processed_arguments.get_compact()
+        self.incremental = processed_arguments.get_incremental()
+        self.overlap = processed_arguments.get_overlap()
+        self.resume = processed_arguments.get_resume()
+        self.passthrough = False
         cache_url = processed_arguments.get_cache_url()
         if cache_url is None:
             self.cache = None
         else:
-            self.cache = rapidpropull.cache.RapidProCache(cache_url)
+            cache_kwargs = processed_arguments.get_cache_kwargs()
+            self.passthrough = cache_kwargs.get('passthrough', False)
+            # imported only when needed as SQLAlchemy takes long to import
+            cache_module = importlib.import_module('rapidpropull.cache')
+            self.cache = cache_module.RapidProCache(cache_url, **cache_kwargs)
         self._downloaded_data = None
+        self._high_water_mark = None
+        self._pipeline = None
+        self._decoding_pool = None
+        self._interner = None
+        self._lock = threading.Lock()
 
     def download(self):
         """
@@ -50,25 +128,181 @@ class DownloadTask(object):
         Example for --with-flows:
             {'runs': [run1, ...],
              'flows': [flow1, ...]}
+
+        If --parallel was used together with --after and --before, the time
+        window is split into sub-windows downloaded concurrently and the results
+        are merged (with duplicates removed).
+
+        If --incremental was used, only objects newer than those downloaded by
+        the previous incremental download are requested (unless --after was
+        used explicitly).  A download filtered with --uuid does not record the
+        most recent of its objects (see: _is_high_water_mark_tracked).
+
+        If --concurrent-pages was used, objects are requested page by page
+        with up to that many pages requested at a time (see:
+        _request_pages).
+
+        If --decode-workers was used, objects are deserialised on a pool of
+        that many processes (see: _request_and_decode).
+
+        If objects are requested page by page (see: _is_interned), equal
+        strings repeated by the downloaded flow runs (e.g. the UUIDs of flows
+        and contacts) are made to share one instance (see: Interner) as soon
+        as each page arrives - before associated objects are requested.
+
+        If --compact was used, the objects are stored as compact records
+        (CachedJSON) and only converted back to RapidPro objects by
+        get_downloaded_objects().  Objects are then requested page by page
+        and each page is converted as soon as it arrives so that only about
+        a page of objects is held as RapidPro objects at a time.
         """
-        endpoint_data = self._get_endpoint()(**self.endpoint_kwargs)
-        if self.cache:
-            self.cache.substitute_cached_for_downloaded(endpoint_data)
-        if not self.selectors_of_requested_associations:
-            self._downloaded_data = endpoint_data
+        with rapidpropull.session.installed(self.session):
+            self._start_decoding()
+            if self._is_interned():
+                # shared by all pages as all downloaded objects are kept
+                self._interner = rapidpropull.interning.Interner()
+            try:
+                self._download()
+            finally:
+                self._interner = None
+                self._stop_decoding()
+
+    def _download(self):
+        endpoint = self._get_endpoint()
+        self._start_incremental_download()
+        shards = self._get_sharded_endpoint_kwargs()
+        if len(shards) == 1:
+            endpoint_data = self._download_shard(endpoint,
+                                                 self.endpoint_kwargs)
         else:
-            self._download_associated_data(endpoint_data)
+            pool = ThreadPool(len(shards))
+            try:
+                results = pool.map(
+                    lambda kwargs: self._download_shard(endpoint, kwargs),
+                    shards)
+            finally:
+                pool.terminate()
+            seen = set()
+            endpoint_data = []
+            for result in results:
+                endpoint_data.extend(self._get_unseen_objects(result, seen))
+        self._downloaded_data = self._process_endpoint_data(endpoint_data)
+        if self.compact:
+            # objects substituted from cache and associated objects
+            _compact(self._downloaded_data)
+        self._finish_incremental_download()
+
+    def download_pages(self):
+        """
+        Execute the download task page by page - i.e. request matching objects
+        from RapidPro one page at a time and return a generator yielding each
+        page as soon as it has been processed (see: download).
+
+        Each page is a list of objects or a dictionary of lists (in case
+        --with-flows or --with-contacts were used) in the same format as the
+        one used by download().  Every page is substituted from and stored in
+        cache (if used) before being yielded.  Associated objects are yielded
+        only once - together with the first page of flow runs which refers to
+        them.  Only the last yielded page is retained by the download task.
+        The high-water mark of an incremental download is only updated after
+        all pages have been processed.
+
+        If cache is used, each page is stored in cache together with a
+        checkpoint recording the next page to be downloaded.  If --resume was
+        used, an interrupted download with the same parameters is continued
+        from its last checkpoint (earlier pages are only available in cache).
+        The pages downloaded but not stored yet when the download was
+        interrupted are downloaded again - i.e. up to --concurrent-pages pages
+        being requested and --prefetch pages queued before each stage (see:
+        _get_shard_pages).
+
+        Pages go through a pipeline (see: Pipeline) of stages running on
+        separate threads: fetch (download), substitute (from cache), associate
+        (download associated objects) and store (in cache).  Up to --prefetch
+        pages are queued between stages so that downloading, processing and
+        caching of consecutive pages overlap.  If --prefetch was 0 (or cache
+        is an in-memory database), pages go through the stages one at a time.
+        There is no separate deserialisation stage as the RapidPro client
+        returns pages already deserialised (use --decode-workers to take it
+        off the fetch stage) and no output stage as the caller consuming the
+        pages (e.g. writing them out) already runs concurrently with the
+        stages.
+        """
+        with rapidpropull.session.installed(self.session):
+            # started before any thread so that no lock is held in forked
+            # workers
+            self._start_decoding()
+            try:
+                for page in self._download_pages():
+                    yield page
+            finally:
+                self._stop_decoding()
+
+    def _download_pages(self):
+        already_associated = {}
+        self._start_incremental_download()
+        stages = []
+        if self.incremental or self.cache:
+            stages.append(rapidpropull.pipeline.Stage(
+                'substitute', self._substitute_page))
+        if self.selectors_of_requested_associations:
+            stages.append(rapidpropull.pipeline.Stage(
+                'associate',
+                lambda page: self._associate_page(page, already_associated)))
         if self.cache:
-            self.cache.insert_objects(self._downloaded_data)
+            stages.append(rapidpropull.pipeline.Stage(
+                'store', self._store_page))
+        queue_size = self.prefetch
+        if self.cache and self.cache.is_in_memory():
+            # the stages would not see the database on their threads
+            queue_size = 0
+        self._pipeline = rapidpropull.pipeline.Pipeline(
+            self._get_endpoint_pages(), stages, queue_size=queue_size,
+            source_name='fetch')
+        pages = iter(self._pipeline)
+        try:
+            for data, _ in pages:
+                self._downloaded_data = data
+                yield data
+        finally:
+            # stops the threads of the pipeline if the pages were abandoned
+            pages.close()
+        self._finish_incremental_download()
 
     def get_downloaded_objects(self):
         """
         If any object have been downloaded, return a list or a dictionary
         containing all downloaded objects as instances of classes Contact, Flow
         or Run (see: rapidpro-python).  Otherwise, return None.
+        Objects stored as CachedJSON (see: get_downloaded_records) are
+        deserialised.
+        """
+        if not self.compact and not self.passthrough:
+            # no object is stored as CachedJSON
+            return self._downloaded_data
+        return _map_objects(_deserialize_record, self._downloaded_data)
+
+    def get_downloaded_records(self):
+        """
+        Return a list or a dictionary containing all downloaded objects as
+        stored by the download task - i.e. in the format of
+        get_downloaded_objects() but with objects stored as CachedJSON if
+        --compact was used (or if found in cache in the passthrough mode).
         """
         return self._downloaded_data
 
+    def get_statistics(self):
+        """
+        Return a dictionary of statistics collected during the download (e.g.
+        the numbers of cache hits and misses or of HTTP connections reused).
+        """
+        statistics = self.session.get_statistics()
+        if self.cache is not None:
+            statistics.update(self.cache.get_statistics())
+        if self._pipeline is not None:
+            statistics.update(self._pipeline.get_statistics())
+        return statistics
+
     def get_downloaded_json_structure(self):
         """
         Return a JSON structure (not a text string) with all downloaded objects
@@ -92,6 +326,10 @@ class DownloadTask(object):
     def _get_endpoint(self, endpoint_selector=None):
         if endpoint_selector is None:
             endpoint_selector = self.endpoint_selector
+        if self._decoding_pool is not None and \
+                endpoint_selector in self.RAW_ENDPOINTS:
+            return functools.partial(self._request_and_decode,
+                                     endpoint_selector)
         if endpoint_selector == '--flow-runs':
             return self.client.get_runs
         elif endpoint_selector == '--flows':
@@ -102,8 +340,312 @@ class DownloadTask(object):
             raise ValueError('Invalid endpoint selector "{}"'.format(
                 endpoint_selector))
 
-    def _download_associated_data(self, flowruns):
+    def _start_decoding(self):
+        if self.decode_workers > 1:
+            self._decoding_pool = multiprocessing.Pool(self.decode_workers)
+
+    def _stop_decoding(self):
+        if self._decoding_pool is not None:
+            self._decoding_pool.terminate()
+            self._decoding_pool = None
+
+    def _request_and_decode(self, endpoint_selector, pager=None, **kwargs):
+        """
+        Request objects like the TembaClient method selected by
+        endpoint_selector but deserialise them on the decoding process pool
+        (in chunks of --decode-chunk-size objects; the order of objects is
+        preserved).
+        """
+        api_endpoint, object_type, parameters = \
+            self.RAW_ENDPOINTS[endpoint_selector]
+        params = self.client._build_params(
+            **{parameters[k]: v for k, v in kwargs.items()})
+        results = self.client._get_multiple(api_endpoint, params, pager)
+        chunk_size = self.decode_chunk_size
+        if len(results) <= chunk_size:
+            # not worth sending to another process
+            return object_type.deserialize_list(results)
+        chunks = [(object_type, results[i:i + chunk_size])
+                  for i in range(0, len(results), chunk_size)]
+        objects = []
+        for chunk in self._decoding_pool.imap(_deserialize_chunk, chunks):
+            objects.extend(chunk)
+        return objects
+
+    def _start_incremental_download(self):
+        """
+        Request only objects newer than the high-water mark recorded in cache
+        (minus the overlap) unless the user gave --after explicitly.
+        """
+        self._high_water_mark = None
+        if not self.incremental or 'after' in self.endpoint_kwargs:
+            return
+        high_water_mark = self.cache.get_high_water_mark(
+            self.endpoint_selector, self.address)
+        if high_water_mark is not None:
+            self.endpoint_kwargs = dict(self.endpoint_kwargs)
+            self.endpoint_kwargs['after'] = temba_client.utils.format_iso8601(
+                high_water_mark - datetime.timedelta(seconds=self.overlap))
+
+    def _is_high_water_mark_tracked(self):
+        """
+        Return True if the most recent of the downloaded objects should be
+        recorded as the high-water mark.  It is not recorded for downloads
+        filtered by UUID as the next incremental download would skip the
+        older objects which did not match the filter.
+        """
+        return self.incremental and 'uuids' not in self.endpoint_kwargs
+
+    def _track_high_water_mark(self, endpoint_data):
+        attr = self.TIMESTAMP_ATTRIBUTES[self.endpoint_selector]
+        with self._lock:
+            for o in endpoint_data:
+                if isinstance(o, rapidpropull.codec.CachedJSON):
+                    continue  # tracked before compacting (see: _compact_page)
+                timestamp = getattr(o, attr)
+                if timestamp is not None and (
+                        self._high_water_mark is None or
+                        timestamp > self._high_water_mark):
+                    self._high_water_mark = timestamp
+
+    def _finish_incremental_download(self):
+        if self._is_high_water_mark_tracked() and \
+                self._high_water_mark is not None:
+            self.cache.update_high_water_mark(
+                self.endpoint_selector, self.address, self._high_water_mark)
+
+    def _get_sharded_endpoint_kwargs(self):
+        """
+        Return a list of endpoint kwargs - one for each of the sub-windows (the
+        most recent first) the requested time window is split into.  Return
+        [self.endpoint_kwargs] if the time window should not be split.
+        """
+        kwargs = self.endpoint_kwargs
+        if self.parallel < 2 or 'after' not in kwargs or\
+                'before' not in kwargs:
+            return [kwargs]
+        try:
+            after = temba_client.utils.parse_iso8601(kwargs['after'])
+            before = temba_client.utils.parse_iso8601(kwargs['before'])
+        except ValueError:
+            return [kwargs]
+        if before <= after:
+            return [kwargs]
+        step = (before - after) / self.parallel
+        shards = []
+        for i in range(self.parallel):
+            shard = dict(kwargs)
+            if i > 0:
+                shard['after'] = temba_client.utils.format_iso8601(
+                    after + step * i - self.SHARD_OVERLAP)
+            if i < self.parallel - 1:
+                shard['before'] = temba_client.utils.format_iso8601(
+                    after + step * (i + 1))
+            shards.append(shard)
+        shards.reverse()
+        return shards
+
+    def _get_unseen_objects(self, objects, seen):
+        """
+        Return a list of those objects which IDs (or UUIDs) are not in the set
+        seen and add their IDs (or UUIDs) to the set.
+        """
+        id_attr = 'id' if self.endpoint_selector == '--flow-runs' else 'uuid'
+        unseen = []
+        for o in objects:
+            object_id = getattr(o, id_attr)
+            if object_id not in seen:
+                seen.add(object_id)
+                unseen.append(o)
+        return unseen
+
+    def _get_endpoint_pages(self):
+        """
+        Yield (page, checkpoint) pairs for all pages of objects matching the
+        endpoint kwargs (see: _get_shard_pages).
+        """
+        endpoint = self._get_endpoint()
+        shards = self._get_sharded_endpoint_kwargs()
+        shard_pages = [self._get_shard_pages(endpoint, s) for s in shards]
+        if len(shard_pages) == 1:
+            for page_and_checkpoint in shard_pages[0]:
+                yield page_and_checkpoint
+        else:
+            seen = set()
+            pages = _iterate_concurrently(shard_pages)
+            try:
+                for page, checkpoint in pages:
+                    yield self._get_unseen_objects(page, seen), checkpoint
+            finally:
+                # stops the threads consuming the shards if closed early
+                pages.close()
+
+    def _get_shard_pages(self, endpoint, kwargs):
+        """
+        Return a generator yielding (page, checkpoint) pairs for all pages of
+        objects matching kwargs.  The checkpoint is None if cache is not used.
+        Otherwise, it is a dictionary of arguments of
+        RapidProCache.save_checkpoint recording the next page to be downloaded
+        (or the completion of the download after the last page) and the upper
+        bound of the modification times of the requested objects.
+
+        Pages are numbered in a listing of objects sorted by their
+        modification times (the most recent first) so objects modified while
+        a download is interrupted would shift the pages not downloaded yet.
+        Unless kwargs give before, objects are therefore requested before the
+        time the download started and a resumed download requests them before
+        the same time.
+        """
+        query = self._get_checkpoint_query(kwargs)
+        page_number = 1
+        upper_bound = None
+        if self.resume:
+            checkpoint = self.cache.get_checkpoint(
+                self.endpoint_selector, self.address, query)
+            if checkpoint is not None:
+                page_number, upper_bound = checkpoint
+        if self.cache and 'before' not in kwargs:
+            if upper_bound is None:
+                upper_bound = datetime.datetime.utcnow().strftime(
+                    self.UPPER_BOUND_FORMAT)
+            kwargs = dict(kwargs, before=upper_bound)
+
+        def get_pages(page_number):
+            for page, has_more in self._request_pages(endpoint, kwargs,
+                                                      page_number):
+                page_number += 1
+                checkpoint = None
+                if self.cache:
+                    checkpoint = {
+                        'endpoint_selector': self.endpoint_selector,
+                        'server': self.address,
+                        'query': query,
+                        'next_page': page_number if has_more else None,
+                        'upper_bound': upper_bound
+                    }
+                yield page, checkpoint
+        return get_pages(page_number)
+
+    def _download_shard(self, endpoint, kwargs):
+        """
+        Return a list of all objects matching kwargs (requested page by page
+        if --concurrent-pages or --compact was used; see: _compact_page).
+        """
+        if self.concurrent_pages < 2 and not self.compact:
+            return self._intern(endpoint(**kwargs))
+        objects = []
+        for page, _ in self._request_pages(endpoint, kwargs, 1):
+            self._intern(page)
+            if self.compact:
+                page = self._compact_page(page)
+            objects.extend(page)
+        return objects
+
+    def _is_interned(self):
+        """
+        Return True if download() should intern the repeated strings of the
+        downloaded objects.  Only objects requested page by page are interned
+        as this lowers the peak memory taken by a download only if the strings
+        of each page are interned before the next page arrives.  Otherwise,
+        the whole shard has been decoded before interning could start and
+        interning costs more time (and memory for the table of strings) than
+        it saves.
+        """
+        return self.concurrent_pages > 1 or self.compact
+
+    def _intern(self, objects):
+        """
+        Make the repeated strings of objects share one instance (if interning
+        is on; see: _is_interned) and return objects.
+        """
+        if self._interner is not None:
+            self._interner.intern_objects(objects)
+        return objects
+
+    def _compact_page(self, page):
+        """
+        Return a page of downloaded objects as compact records (see:
+        CachedJSON).  The high-water mark is tracked first as the records do
+        not carry the timestamps of objects.
+        """
+        if self._is_high_water_mark_tracked():
+            self._track_high_water_mark(page)
+        return [rapidpropull.codec.CachedJSON.from_object(o) for o in page]
+
+    def _request_pages(self, endpoint, kwargs, page_number):
+        """
+        Yield (page, has_more) pairs for the pages of objects matching kwargs
+        starting with page page_number.  Once the first page has arrived and
+        the number of pages is known, the remaining pages are requested by
+        their numbers with up to concurrent_pages requests at a time (and
+        yielded in order).
+        """
+        pager = self.client.pager(start_page=page_number)
+        page = endpoint(pager=pager, **kwargs)
+        has_more = pager.has_more()
+        if has_more and self.concurrent_pages > 1 and page and pager.total:
+            # all pages but the last one are full
+            last_page = int(math.ceil(float(pager.total) / len(page)))
+            yield page, True
+            pages = _map_concurrently(
+                lambda n: endpoint(pager=self.client.pager(start_page=n),
+                                   **kwargs),
+                range(page_number + 1, last_page + 1), self.concurrent_pages)
+            for n, page in enumerate(pages, page_number + 1):
+                yield page, n < last_page
+            return
+        while True:
+            yield page, has_more
+            if not has_more:
+                break
+            page = endpoint(pager=pager, **kwargs)
+            has_more = pager.has_more()
+
+    @staticmethod
+    def _get_checkpoint_query(kwargs):
+        query = json.dumps(kwargs, sort_keys=True).encode('utf-8')
+        return hashlib.sha1(query).hexdigest()
+
+    def _process_endpoint_data(self, endpoint_data):
+        page = self._substitute_page((endpoint_data, None))
+        if self.cache:
+            # objects from cache carry their own copies of repeated strings
+            self._intern(page[0])
+        page = self._associate_page(page)
+        return self._store_page(page)[0]
+
+    # The following methods take and return (data, checkpoint) pairs (see:
+    # _get_shard_pages) so that they can be used as stages of a pipeline.
+
+    def _substitute_page(self, page):
+        endpoint_data, checkpoint = page
+        if self._is_high_water_mark_tracked():
+            # downloaded (not cached) objects carry the latest timestamps
+            self._track_high_water_mark(endpoint_data)
+        if self.cache:
+            self.cache.substitute_cached_for_downloaded(endpoint_data)
+        return page
+
+    def _associate_page(self, page, already_associated=None):
+        endpoint_data, checkpoint = page
+        if not self.selectors_of_requested_associations:
+            return page
+        return (self._download_associated_data(endpoint_data,
+                                               already_associated),
+                checkpoint)
+
+    def _store_page(self, page):
+        data, checkpoint = page
+        if self.cache:
+            if checkpoint is None:
+                self.cache.insert_objects(data)
+            else:
+                self.cache.insert_objects(data, checkpoint=checkpoint)
+        return page
+
+    def _download_associated_data(self, flowruns, already_associated=None):
         all_data = {'runs': flowruns}
+        requests = []
         for endpoint_selector in self.selectors_of_requested_associations:
             container_attr = endpoint_selector.lstrip('-')
             uuid_attr = container_attr.rstrip('s')
@@ -111,11 +653,164 @@ class DownloadTask(object):
             uuids = set()
             for run in flowruns:
                 uuids.add(getattr(run, uuid_attr))
-            if self.cache:
+            if already_associated is not None:
+                seen = already_associated.setdefault(endpoint_selector, set())
+                uuids.difference_update(seen)
+                seen.update(uuids)
+            if self.cache and uuids:
                 from_cache, missing_uuids = self.cache.get_objects(
                     endpoint_selector, uuids)
                 uuids = missing_uuids
                 all_data[container_attr].extend(from_cache)
-            all_data[container_attr].extend(self._get_endpoint(
-                endpoint_selector)(uuids=uuids))
-        self._downloaded_data = all_data
+            # an empty UUID filter would make RapidPro return all objects
+            if uuids:
+                requests.extend(
+                    (endpoint_selector, batch) for batch in
+                    _split_into_batches(uuids, self.ASSOCIATION_BATCH_SIZE))
+        workers = min(self.parallel, len(requests))
+        if workers > 1:
+            pool = ThreadPool(workers)
+            try:
+                results = pool.map(self._download_associated_batch, requests)
+            finally:
+                pool.terminate()
+        else:
+            results = [self._download_associated_batch(r) for r in requests]
+        for (endpoint_selector, _), objects in zip(requests, results):
+            all_data[endpoint_selector.lstrip('-')].extend(objects)
+        return all_data
+
+    def _download_associated_batch(self, request):
+        endpoint_selector, uuids = request
+        return self._get_endpoint(endpoint_selector)(uuids=uuids)
+
+
+def _map_objects(function, data):
+    """
+    Return downloaded data (a list or a dictionary of lists of objects; see:
+    DownloadTask.download) with function applied to each object.
+    """
+    if isinstance(data, list):
+        return [function(o) for o in data]
+    elif isinstance(data, dict):
+        return {k: [function(o) for o in data[k]] for k in data}
+    return data
+
+
+def _deserialize_record(rapidpro_object):
+    """
+    Return a RapidPro object stored as CachedJSON as an instance of its type
+    (or any other object unchanged).
+    """
+    if isinstance(rapidpro_object, rapidpropull.codec.CachedJSON):
+        return rapidpro_object.deserialize()
+    return rapidpro_object
+
+
+def _compact(data):
+    """
+    Convert the objects of downloaded data (see: _map_objects) to compact
+    records (see: CachedJSON) in place.
+    """
+    for objects in data.values() if isinstance(data, dict) else [data]:
+        for i, o in enumerate(objects):
+            objects[i] = rapidpropull.codec.CachedJSON.from_object(o)
+
+
+def _deserialize_chunk(type_and_chunk):
+    """
+    Return a list of objects of a type (e.g. Run) deserialised from a chunk (a
+    list) of their JSON structures (run in decoding processes).
+    """
+    object_type, chunk = type_and_chunk
+    return object_type.deserialize_list(chunk)
+
+
+def _split_into_batches(uuids, batch_size):
+    """
+    Return a list of sets of up to batch_size UUIDs each (in a stable order).
+    """
+    uuids = sorted(uuids)
+    return [set(uuids[i:i + batch_size])
+            for i in range(0, len(uuids), batch_size)]
+
+
+def _map_concurrently(function, items, workers):
+    """
+    Yield function(item) for each of items (in order) calling function on up
+    to workers threads at a time.  At most workers + 1 results are held before
+    being yielded.  Re-raise the first exception raised by function.
+    """
+    pool = ThreadPool(workers)
+    try:
+        pending = collections.deque()
+        for item in items:
+            pending.append(pool.apply_async(function, (item,)))
+            if len(pending) > workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+
+
+def _iterate_concurrently(iterables, max_queued=None, stop_interval=0.01):
+    """
+    Consume each of the iterables on a separate thread and yield their items
+    as soon as they become available (the order of items is preserved only for
+    items coming from the same iterable).  Re-raise the first exception raised
+    by any of the iterables.  Once iteration ends (completed, failed or
+    closed), the threads are stopped (those waiting for the full queue of
+    items give up every stop_interval seconds), the iterables are closed on
+    their threads and the threads are joined.
+    """
+    if max_queued is None:
+        max_queued = 2 * len(iterables)
+    items = queue.Queue(maxsize=max_queued)
+    stop = threading.Event()
+    finished = object()
+
+    def put(item):
+        """Put item to items and return True unless stopped first."""
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=stop_interval)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def consume(iterable):
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                if not put((item, None)):
+                    return
+        except Exception as e:
+            put((None, e))
+        else:
+            put((finished, None))
+        finally:
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                close()
+
+    threads = [threading.Thread(target=consume, args=(iterable,))
+               for iterable in iterables]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        remaining = len(iterables)
+        while remaining:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            elif item is finished:
+                remaining -= 1
+            else:
+                yield item
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,66 @@
+import temba_client.v1.types
+
+import rapidpropull.codec
+
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2016, Tomasz J. Kotarba. All rights reserved.'
+__maintainer__ = 'Tomasz J. Kotarba'
+__email__ = 'tomasz@kotarba.net'
+
+try:
+    # PY2
+    # noinspection PyUnresolvedReferences,PyCompatibility
+    STRING_TYPES = (str, unicode)
+except NameError:
+    # PY3
+    STRING_TYPES = (str,)
+
+
+class Interner(object):
+    """
+    Makes equal strings (e.g. UUIDs of flows and contacts repeated by many
+    flow runs) share one instance.  Unlike the built-in intern, it works with
+    unicode strings on Python 2 and the strings are released together with
+    the interner.
+    """
+    # The attributes of flow runs and of their steps and values holding
+    # strings repeated by many runs.
+    RUN_ATTRIBUTES = ('flow', 'contact')
+    STEP_ATTRIBUTES = ('node', 'type')
+    VALUE_ATTRIBUTES = ('node', 'category', 'label')
+
+    def __init__(self):
+        self._strings = {}
+
+    def __len__(self):
+        return len(self._strings)
+
+    def intern(self, value):
+        """
+        Return the instance of a string equal to value seen first (value is
+        returned unchanged if it is not a string).
+        """
+        if not isinstance(value, STRING_TYPES):
+            return value
+        return self._strings.setdefault(value, value)
+
+    def intern_objects(self, objects):
+        """
+        Intern the repeated strings of those of the objects which are flow
+        runs (see: RUN_ATTRIBUTES; other objects and the steps and values of
+        undecoded lazy flow runs are left unchanged).
+        """
+        for o in objects:
+            if isinstance(o, temba_client.v1.types.Run):
+                self._intern_attributes(o, self.RUN_ATTRIBUTES)
+                if isinstance(o, rapidpropull.codec.LazyObject) and \
+                        not o.is_decoded():
+                    continue  # not worth decoding (the text is compact)
+                for step in o.steps or ():
+                    self._intern_attributes(step, self.STEP_ATTRIBUTES)
+                for value in o.values or ():
+                    self._intern_attributes(value, self.VALUE_ATTRIBUTES)
+
+    def _intern_attributes(self, o, attributes):
+        for name in attributes:
+            setattr(o, name, self.intern(getattr(o, name, None)))
@@ -0,0 +1,223 @@
+import importlib
+import os
+import shutil
+import sys
+import tempfile
+
+import rapidpropull.codec
+
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2016, Tomasz J. Kotarba. All rights reserved.'
+__maintainer__ = 'Tomasz J. Kotarba'
+__email__ = 'tomasz@kotarba.net'
+
+
+class JSONWriter(object):
+    """
+    Writes RapidPro objects (see: rapidpro-python) to a text stream as a single
+    JSON document, one object at a time.  The document is equivalent to the
+    one produced by serialising all objects at once - i.e. a list of objects or
+    a dictionary of lists if associated objects were requested.  E.g.:
+        {"runs": [...], "flows": [...], "contacts": [...]}
+
+    Main objects are written as soon as a page arrives.  Associated objects are
+    spooled to temporary files until finish() is called so that memory usage
+    does not grow with the number of downloaded objects.
+    """
+
+    def __init__(self, stream, selectors_of_associations=()):
+        """
+        Prepare to write to stream the main objects and the objects associated
+        with them by the endpoint selectors selectors_of_associations (e.g.
+        '--flows').
+        """
+        self.stream = stream
+        self._associated = [
+            (s.lstrip('-'), tempfile.TemporaryFile(mode='w+'))
+            for s in selectors_of_associations]
+        self._separators = {k: '' for k, _ in self._associated}
+        self._separator = ''
+        if self._associated:
+            self.stream.write('{"runs": [')
+        else:
+            self.stream.write('[')
+
+    def write_page(self, page):
+        """
+        Write a page of objects - a list or a dictionary of lists (in the
+        format of DownloadTask.get_downloaded_objects()) - and flush the
+        stream.
+        """
+        main_objects = page['runs'] if self._associated else page
+        for o in main_objects:
+            self.stream.write(self._separator + to_json(o))
+            self._separator = ', '
+        for k, spool in self._associated:
+            for o in page[k]:
+                spool.write(self._separators[k] + to_json(o))
+                self._separators[k] = ', '
+        self.stream.flush()
+
+    def finish(self):
+        """Write the associated objects and the end of the JSON document."""
+        self.stream.write(']')
+        for k, spool in self._associated:
+            self.stream.write(', "{}": ['.format(k))
+            spool.seek(0)
+            shutil.copyfileobj(spool, self.stream)
+            self.stream.write(']')
+        if self._associated:
+            self.stream.write('}')
+        self.stream.write('\n')
+        self.stream.flush()
+        self.close()
+
+    def close(self):
+        """Remove the temporary files (without finishing the document)."""
+        for _, spool in self._associated:
+            spool.close()
+
+
+class NDJSONWriter(object):
+    """
+    Writes RapidPro objects (see: rapidpro-python) to a text stream as
+    newline-delimited JSON - i.e. one object per line.  If associated objects
+    were requested, each line is tagged with the type of its object.  E.g.:
+        {"type": "run", "object": {...}}
+        {"type": "flow", "object": {...}}
+
+    All objects are written as soon as a page arrives.
+    """
+
+    def __init__(self, stream, selectors_of_associations=()):
+        """
+        Prepare to write to stream the main objects and the objects associated
+        with them by the endpoint selectors selectors_of_associations (e.g.
+        '--flows').
+        """
+        self.stream = stream
+        self._associated = [s.lstrip('-') for s in selectors_of_associations]
+
+    def write_page(self, page):
+        """
+        Write a page of objects - a list or a dictionary of lists (in the
+        format of DownloadTask.get_downloaded_objects()) - and flush the
+        stream.
+        """
+        if self._associated:
+            for k in ['runs'] + self._associated:
+                tag = '{{"type": "{}", "object": '.format(k.rstrip('s'))
+                for o in page[k]:
+                    self.stream.write(tag + to_json(o) + '}\n')
+        else:
+            for o in page:
+                self.stream.write(to_json(o) + '\n')
+        self.stream.flush()
+
+    def finish(self):
+        """Flush the stream (there is nothing more to be written)."""
+        self.stream.flush()
+
+    def close(self):
+        """Do nothing (there is nothing to be released)."""
+
+
+# Writers of the supported output formats.
+WRITERS = {
+    'json': JSONWriter,
+    'ndjson': NDJSONWriter
+}
+
+# Modules (imported when needed; the first one available is used) providing
+# functions opening files compressed as indicated by their extensions.
+COMPRESSORS = {
+    '.gz': ('gzip',),
+    '.bz2': ('bz2',),
+    '.xz': ('lzma', 'backports.lzma')  # PY3, PY2
+}
+COMPRESSION_UNAVAILABLE = 'Unable to write "{}".  The lzma module (or' \
+                          ' backports.lzma on Python 2) is required.'
+
+
+class OutputFile(object):
+    """
+    A writable text stream writing to a file compressed as indicated by the
+    extension of its path (.gz, .bz2 or .xz; no compression otherwise).
+
+    If rotate_size is given, the output is split into numbered files (e.g.
+    runs.ndjson.gz is written as runs-0001.ndjson.gz, runs-0002.ndjson.gz,
+    ...) and a new file is started once more than rotate_size bytes (before
+    compression) have been written to the current one.  A file is only ever
+    split between two calls to write().
+    """
+
+    def __init__(self, path, rotate_size=None):
+        self.path = path
+        self.rotate_size = rotate_size
+        self.paths = []
+        self._opener = get_opener(path)
+        self._file = None
+        self._written = 0
+        self._open_next_file()
+
+    def write(self, text):
+        """Write text (opening the next file first if required)."""
+        if self.rotate_size is not None and self._written >= self.rotate_size:
+            self._open_next_file()
+        self._file.write(text)
+        self._written += len(text)
+
+    def flush(self):
+        # BZ2File cannot be flushed on PY2
+        if self._file is not None and hasattr(self._file, 'flush'):
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _open_next_file(self):
+        self.close()
+        path = self.path
+        if self.rotate_size is not None:
+            directory, name = os.path.split(self.path)
+            base, dot, extension = name.partition('.')
+            path = os.path.join(directory, '{}-{:04d}{}{}'.format(
+                base, len(self.paths) + 1, dot, extension))
+        if sys.version_info[0] == 2:
+            self._file = self._opener(path, 'wb')
+        else:
+            self._file = self._opener(path, 'wt')
+        self.paths.append(path)
+        self._written = 0
+
+
+def get_opener(path):
+    """
+    Return a function (like open) opening a file compressed as indicated by
+    the extension of its path.  Raise ValueError if the compression is not
+    available.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in COMPRESSORS:
+        return open
+    for module_name in COMPRESSORS[extension]:
+        try:
+            module = importlib.import_module(module_name)
+        except ImportError:
+            continue
+        # there is no bz2.open on PY2
+        return getattr(module, 'open', None) or module.BZ2File
+    raise ValueError(COMPRESSION_UNAVAILABLE.format(path))
+
+
+def to_json(rapidpro_object):
+    """
+    Return the JSON text of a RapidPro object (passed through unchanged if
+    the object is an instance of CachedJSON or an undecoded LazyObject).
+    """
+    if isinstance(rapidpro_object, (rapidpropull.codec.CachedJSON,
+                                    rapidpropull.codec.LazyObject)):
+        return rapidpro_object.to_json()
+    return rapidpropull.codec.dumps(rapidpro_object.serialize())
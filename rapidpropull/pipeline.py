@@ -0,0 +1,276 @@
+import heapq
+import threading
+import time
+try:
+    # PY3
+    # noinspection PyCompatibility
+    import queue
+except ImportError:
+    # PY2
+    # noinspection PyPep8Naming
+    import Queue as queue
+
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2016, Tomasz J. Kotarba. All rights reserved.'
+__maintainer__ = 'Tomasz J. Kotarba'
+__email__ = 'tomasz@kotarba.net'
+
+
+class Stage(object):
+    """
+    A named step of a Pipeline calling function on each item on up to workers
+    threads.  A stage with one worker processes items in order; a stage with
+    more workers processes them in the order they arrive (use it only for
+    functions which do not depend on the order of items).
+    """
+
+    def __init__(self, name, function, workers=1):
+        self.name = name
+        self.function = function
+        self.workers = workers
+
+
+class Pipeline(object):
+    """
+    An iterable passing the items of a source iterable through a sequence of
+    stages and yielding the results in the order of the source.
+
+    The source and each stage run on separate threads connected by queues
+    holding up to queue_size items each so that a slow stage holds back the
+    stages before it (backpressure) instead of letting items pile up in
+    memory.  If queue_size is 0, the source and the stages run one item at a
+    time on the calling thread.  The threads are daemon threads so that a
+    pipeline abandoned before its end does not keep the program running.
+
+    An exception raised by the source or by a stage is re-raised when
+    iteration reaches the item which caused it (items before it are yielded
+    and no item after it is processed by the stage which raised it).  Once
+    iteration ends (completed, failed or closed), the threads are stopped
+    (those waiting for a queue are woken up), the source is closed and the
+    threads are joined.
+    """
+    # How often (in seconds) threads being stopped are woken up again.
+    STOP_INTERVAL = 0.01
+
+    def __init__(self, source, stages, queue_size=1, source_name='source'):
+        self.source = source
+        self.stages = list(stages)
+        self.queue_size = queue_size
+        self.source_name = source_name
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._statistics = {}
+        for name in [source_name] + [s.name for s in self.stages]:
+            self._statistics[name] = {'items': 0, 'seconds': 0.0,
+                                      'max queue depth': 0}
+
+    def __iter__(self):
+        if self.queue_size == 0:
+            return self._run_sequentially()
+        return self._run_concurrently()
+
+    def get_statistics(self):
+        """
+        Return a dictionary with the number of items processed by each stage,
+        the number of items processed per second of its work and the maximum
+        number of items waiting in its output queue.  E.g.:
+            {'fetch stage items': 10, 'fetch stage items per second': 20.0,
+             'fetch stage max queue depth': 1, ...}
+        """
+        statistics = {}
+        with self._lock:
+            for name, stage in self._statistics.items():
+                prefix = '{} stage '.format(name)
+                statistics[prefix + 'items'] = stage['items']
+                statistics[prefix + 'items per second'] = round(
+                    stage['items'] / stage['seconds'], 1) \
+                    if stage['seconds'] else 0.0
+                statistics[prefix + 'max queue depth'] = \
+                    stage['max queue depth']
+        return statistics
+
+    def _run_sequentially(self):
+        items = iter(self.source)
+        try:
+            while True:
+                try:
+                    item = self._timed(self.source_name, next, items)
+                except StopIteration:
+                    return
+                for stage in self.stages:
+                    item = self._timed(stage.name, stage.function, item)
+                yield item
+        finally:
+            _close(items)
+
+    def _run_concurrently(self):
+        self._stop.clear()
+        queues = [queue.Queue(maxsize=self.queue_size)
+                  for _ in range(len(self.stages) + 1)]
+        threads = [threading.Thread(target=self._feed, args=(queues[0],))]
+        for i, stage in enumerate(self.stages):
+            remaining = [stage.workers]
+            reorder = _Reorder() if stage.workers == 1 else None
+            for _ in range(stage.workers):
+                threads.append(threading.Thread(
+                    target=self._work,
+                    args=(stage, queues[i], queues[i + 1], remaining,
+                          reorder)))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        reorder = _Reorder()
+        try:
+            while True:
+                _, item = self._get(queues[-1], reorder)
+                if item is _END:
+                    return
+                elif isinstance(item, _Failure):
+                    raise item.error
+                yield item
+        finally:
+            self._stop_threads(threads, queues)
+
+    def _stop_threads(self, threads, queues):
+        """
+        Make threads stop, wake up those waiting for any of the queues (by
+        discarding queued items and putting the end of items to empty queues)
+        until they have stopped and join them.
+        """
+        self._stop.set()
+        for thread in threads:
+            while thread.is_alive():
+                for q in queues:
+                    try:
+                        while True:
+                            q.get_nowait()
+                    except queue.Empty:
+                        pass
+                    try:
+                        q.put_nowait((None, _END))
+                    except queue.Full:
+                        pass
+                thread.join(self.STOP_INTERVAL)
+
+    def _feed(self, output):
+        """Put the items of the source to output (as (number, item) pairs)."""
+        items = iter(self.source)
+        number = 0
+        try:
+            while not self._stop.is_set():
+                try:
+                    item = self._timed(self.source_name, next, items)
+                except StopIteration:
+                    item = _END
+                except Exception as e:
+                    item = _Failure(e)
+                self._put(output, (number, item), self.source_name)
+                if item is _END or isinstance(item, _Failure):
+                    return
+                number += 1
+        finally:
+            _close(items)
+
+    def _work(self, stage, input_queue, output, remaining, reorder):
+        """
+        Process items from input_queue with stage and put the results to
+        output.  The last of the workers of the stage to finish passes on the
+        end of the items.
+        """
+        while True:
+            number, item = pair = self._get(input_queue, reorder)
+            if self._stop.is_set():
+                return
+            elif item is _END:
+                with self._lock:
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+                if last:
+                    self._put(output, pair, stage.name)
+                else:
+                    # let the other workers of the stage see the end, too
+                    input_queue.put(pair)
+                return
+            if not isinstance(item, _Failure):
+                try:
+                    item = self._timed(stage.name, stage.function, item)
+                except Exception as e:
+                    item = _Failure(e)
+            self._put(output, (number, item), stage.name)
+            if isinstance(item, _Failure):
+                return
+
+    def _get(self, input_queue, reorder=None):
+        """
+        Return the next (number, item) pair from input_queue (in the order of
+        numbers if reorder is given) or (None, _END) once the pipeline is
+        being stopped.
+        """
+        if reorder is None:
+            return input_queue.get()
+        while not reorder.ready():
+            pair = input_queue.get()
+            if self._stop.is_set():
+                return None, _END
+            reorder.push(pair)
+        return reorder.pop()
+
+    def _put(self, output, pair, name):
+        """
+        Put a (number, item) pair to output (for the stage called name).  The
+        statistics are recorded first so that they are complete once the item
+        has been taken from output.
+        """
+        with self._lock:
+            statistics = self._statistics[name]
+            statistics['max queue depth'] = max(
+                statistics['max queue depth'],
+                min(output.qsize() + 1, output.maxsize))
+        output.put(pair)
+
+    def _timed(self, name, function, item):
+        start = time.time()
+        result = function(item)
+        with self._lock:
+            self._statistics[name]['items'] += 1
+            self._statistics[name]['seconds'] += time.time() - start
+        return result
+
+
+class _Reorder(object):
+    """
+    A buffer releasing (number, item) pairs in the order of numbers (which are
+    unique so items are never compared).
+    """
+
+    def __init__(self):
+        self.next_number = 0
+        self._heap = []
+
+    def push(self, pair):
+        heapq.heappush(self._heap, pair)
+
+    def ready(self):
+        return bool(self._heap) and self._heap[0][0] == self.next_number
+
+    def pop(self):
+        self.next_number += 1
+        return heapq.heappop(self._heap)
+
+
+class _Failure(object):
+    """An exception travelling through a pipeline in place of an item."""
+
+    def __init__(self, error):
+        self.error = error
+
+
+def _close(iterator):
+    """Close iterator if it is a generator (or has a close method)."""
+    close = getattr(iterator, 'close', None)
+    if close is not None:
+        close()
+
+
+# The item marking the end of the items of the source.
+_END = object()
@@ -0,0 +1,148 @@
+import contextlib
+import json
+import threading
+
+import requests
+import requests.adapters
+import temba_client.clients
+
+import rapidpropull.throttle
+
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2016, Tomasz J. Kotarba. All rights reserved.'
+__maintainer__ = 'Tomasz J. Kotarba'
+__email__ = 'tomasz@kotarba.net'
+
+# The session used by all RapidPro clients (see: install).
+_session = None
+_default_request = temba_client.clients.request
+
+
+class PooledSession(requests.Session):
+    """
+    A requests session keeping up to pool_size connections to each host open
+    for reuse (unless keep_alive is False) and asking servers to compress
+    responses with gzip (unless gzip is False).  Counts the requests sent and
+    the connections opened to send them.
+
+    Requests are sent through a Throttle sending up to pool_size requests at
+    a time (and at most max_rate requests per second if given) and retrying
+    failed requests up to max_retries times.
+    """
+
+    def __init__(self, pool_size=10, keep_alive=True, gzip=True,
+                 max_rate=None, max_retries=None):
+        super(PooledSession, self).__init__()
+        self.pool_size = pool_size
+        if max_retries is None:
+            max_retries = rapidpropull.throttle.Throttle.DEFAULT_MAX_RETRIES
+        self.throttle = rapidpropull.throttle.Throttle(
+            pool_size, max_rate, max_retries)
+        self._requests = 0
+        self._connections = 0
+        self._lock = threading.Lock()
+        adapter = _CountingAdapter(self._count_connection,
+                                   pool_connections=pool_size,
+                                   pool_maxsize=pool_size)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+        if not keep_alive:
+            self.headers['Connection'] = 'close'
+        if not gzip:
+            self.headers['Accept-Encoding'] = 'identity'
+
+    def request(self, method, url, **kwargs):
+        request = super(PooledSession, self).request
+        return self.throttle.call(lambda: request(method, url, **kwargs))
+
+    def send(self, request, **kwargs):
+        with self._lock:
+            self._requests += 1
+        return super(PooledSession, self).send(request, **kwargs)
+
+    def get_statistics(self):
+        """
+        Return a dictionary with the numbers of HTTP requests sent and of the
+        connections opened and reused to send them (and the statistics of the
+        throttle).
+        """
+        with self._lock:
+            statistics = {'http requests': self._requests,
+                          'http connections opened': self._connections,
+                          'http connections reused': max(
+                              0, self._requests - self._connections)}
+        statistics.update(self.throttle.get_statistics())
+        return statistics
+
+    def _count_connection(self):
+        with self._lock:
+            self._connections += 1
+
+
+class _CountingAdapter(requests.adapters.HTTPAdapter):
+    """
+    An HTTP adapter calling count() whenever a new connection (e.g. a new TCP
+    connection and TLS handshake) is established.
+    """
+
+    def __init__(self, count, **kwargs):
+        self.count = count
+        super(_CountingAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(_CountingAdapter, self).init_poolmanager(*args, **kwargs)
+        pool_classes = self.poolmanager.pool_classes_by_scheme
+        self.poolmanager.pool_classes_by_scheme = {
+            scheme: self._get_counting_pool_class(pool_classes[scheme])
+            for scheme in pool_classes}
+
+    def _get_counting_pool_class(self, pool_class):
+        count = self.count
+
+        class CountingConnection(pool_class.ConnectionCls):
+            def connect(self):
+                count()
+                return super(CountingConnection, self).connect()
+
+        return type(pool_class.__name__, (pool_class,),
+                    {'ConnectionCls': CountingConnection})
+
+
+def install(session):
+    """
+    Make all RapidPro clients (see: rapidpro-python) send their requests with
+    session instead of opening a new connection for every request.  Restore
+    the default behaviour if session is None.
+    """
+    global _session
+    _session = session
+    if session is None:
+        temba_client.clients.request = _default_request
+    else:
+        temba_client.clients.request = _request
+
+
+@contextlib.contextmanager
+def installed(session):
+    """
+    Return a context manager installing session (see: install) for the
+    duration of a with block and restoring the session installed before
+    (or the default behaviour) afterwards.
+    """
+    previous = _session
+    install(session)
+    try:
+        yield session
+    finally:
+        install(previous)
+
+
+def _request(method, url, **kwargs):
+    """
+    Send a request with the installed session (a replacement for
+    temba_client.utils.request - the function all requests of RapidPro clients
+    go through).
+    """
+    if 'data' in kwargs:
+        kwargs['data'] = json.dumps(kwargs['data'])
+    return _session.request(method, url, **kwargs)
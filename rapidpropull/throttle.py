@@ -0,0 +1,144 @@
+import collections
+import random
+import threading
+import time
+
+import requests
+
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2016, Tomasz J. Kotarba. All rights reserved.'
+__maintainer__ = 'Tomasz J. Kotarba'
+__email__ = 'tomasz@kotarba.net'
+
+
+class Throttle(object):
+    """
+    Controls the requests sent to a RapidPro server so that they run as close
+    to its rate limit as possible without failing the download:
+      - at most max_rate requests are started per second (a token bucket
+        holding up to one second worth of tokens; no limit if max_rate is
+        None),
+      - no request is started until the Retry-After period of a rate limited
+        (HTTP 429) response has passed,
+      - up to max_concurrency requests are sent at a time; the limit is halved
+        after each rate limited response and grows back by one after about as
+        many successful responses as the limit (AIMD),
+      - requests failed due to rate limiting, server overload (HTTP 502, 503
+        or 504) or connection errors are retried up to max_retries times after
+        a jittered exponential backoff.
+    """
+    RETRIED_STATUS_CODES = (429, 502, 503, 504)
+    DEFAULT_MAX_RETRIES = 5
+    # The backoff before retry n (counting from 0) is a random number of
+    # seconds between 0 and min(BACKOFF_BASE * 2 ** n, BACKOFF_MAX).
+    BACKOFF_BASE = 0.5
+    BACKOFF_MAX = 60
+
+    def __init__(self, max_concurrency=1, max_rate=None,
+                 max_retries=DEFAULT_MAX_RETRIES):
+        self.max_concurrency = max_concurrency
+        self.max_rate = max_rate
+        self.max_retries = max_retries
+        self.concurrency = float(max_concurrency)
+        self.statistics = collections.Counter()
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self._paused_until = 0
+        self._tokens = max_rate
+        self._refilled_at = time.time()
+
+    def call(self, send):
+        """
+        Call send (a function sending a request and returning its response)
+        once a request may be sent and retry it if needed.  Return the last
+        response or re-raise the last connection error once out of retries.
+        """
+        attempt = 0
+        while True:
+            self._acquire()
+            try:
+                response = send()
+            except requests.exceptions.ConnectionError:
+                self._release()
+                if attempt >= self.max_retries:
+                    raise
+            else:
+                if response.status_code not in self.RETRIED_STATUS_CODES:
+                    self._release(succeeded=True)
+                    return response
+                if response.status_code == 429:
+                    self._release(retry_after=_get_retry_after(response))
+                else:
+                    self._release()
+                if attempt >= self.max_retries:
+                    return response
+            with self._condition:
+                self.statistics['http requests retried'] += 1
+            time.sleep(random.uniform(
+                0, min(self.BACKOFF_BASE * 2 ** attempt, self.BACKOFF_MAX)))
+            attempt += 1
+
+    def get_statistics(self):
+        """
+        Return a dictionary with the numbers of requests retried and rate
+        limited and the current concurrency limit.
+        """
+        with self._condition:
+            statistics = {'http requests retried': 0,
+                          'http requests rate limited': 0}
+            statistics.update(self.statistics)
+            statistics['http concurrency limit'] = int(self.concurrency)
+            return statistics
+
+    def _acquire(self):
+        """Wait until a request may be sent and count it as in flight."""
+        with self._condition:
+            while True:
+                now = time.time()
+                self._refill(now)
+                if self._paused_until > now:
+                    self._condition.wait(self._paused_until - now)
+                elif self._in_flight >= int(self.concurrency):
+                    self._condition.wait()
+                elif self._tokens is not None and self._tokens < 1:
+                    self._condition.wait((1 - self._tokens) / self.max_rate)
+                else:
+                    break
+            self._in_flight += 1
+            if self._tokens is not None:
+                self._tokens -= 1
+
+    def _release(self, succeeded=False, retry_after=None):
+        """
+        Count a request as no longer in flight and adjust the concurrency
+        limit to its outcome (retry_after is given for rate limited requests).
+        """
+        with self._condition:
+            self._in_flight -= 1
+            if retry_after is not None:
+                self.statistics['http requests rate limited'] += 1
+                self.concurrency = max(1.0, self.concurrency / 2)
+                self._paused_until = max(self._paused_until,
+                                         time.time() + retry_after)
+            elif succeeded:
+                self.concurrency = min(float(self.max_concurrency),
+                                       self.concurrency + 1 / self.concurrency)
+            self._condition.notify_all()
+
+    def _refill(self, now):
+        if self._tokens is not None:
+            self._tokens = min(
+                max(1, self.max_rate),
+                self._tokens + (now - self._refilled_at) * self.max_rate)
+        self._refilled_at = now
+
+
+def _get_retry_after(response):
+    """
+    Return the number of seconds to wait given in the Retry-After header of
+    response (0 if missing or not a number of seconds).
+    """
+    try:
+        return max(0.0, float(response.headers.get('Retry-After', 0)))
+    except ValueError:
+        return 0.0
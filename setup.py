@@ -67,7 +67,8 @@ class PyTest(TestCommand):
 
 install_requires = [
     'docopt>=0.6,<1',
-    'rapidpro-python>=2.1.1,<3',
+    # DownloadTask.RAW_ENDPOINTS relies on the private API of TembaClient
+    'rapidpro-python>=2.1.1,<2.2',
     'sqlalchemy>=1.1.3,<2',
 ]
 
@@ -124,7 +125,8 @@ setuptools.setup(
     setup_requires=['behave>=1.2.5,<2'],
     install_requires=install_requires,
     tests_require=tests_require,
-    extras_require={'development': tests_require},
+    extras_require={'development': tests_require,
+                    'fast-json': ['ujson']},
     entry_points={
         'console_scripts': [
             'rapidpro-pull = rapidpropull.cli:main',
@@ -2,20 +2,46 @@
 from itertools import chain, combinations
 import json
 import copy
+import os
+import subprocess
+import sys
+import multiprocessing
+import threading
+import time
+import weakref
 
 import sqlalchemy
 import docopt
+import requests
+import sqlalchemy.event
 import sqlalchemy.exc
 import temba_client.v1.types
-from temba_client.exceptions import TembaConnectionError, TembaTokenError
+import temba_client.utils
+import temba_client.clients
+from temba_client.exceptions import TembaConnectionError, TembaTokenError, \
+    TembaRateExceededError
 import pytest
 from hamcrest import *
 import mock
 import iocapture
+try:
+    # PY3
+    # noinspection PyCompatibility
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    # PY2
+    # noinspection PyCompatibility
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 
 import rapidpropull.cache
 import rapidpropull.cli
+import rapidpropull.codec
 import rapidpropull.download
+import rapidpropull.interning
+import rapidpropull.output
+import rapidpropull.pipeline
+import rapidpropull.session
+import rapidpropull.throttle
 
 from utilities import Auxiliary
 
@@ -342,6 +368,244 @@ class TestArgumentProcessor(Auxiliary):
         assert processed_arguments.get_endpoint_kwargs() == endpoint_kwargs
         assert processed_arguments.get_cache_url() == 'sqlite://'
 
+    def test_get_session_kwargs(self):
+        for selector in rapidpropull.cli.ArgumentProcessor.ENDPOINT_SELECTORS:
+            argv = [selector, '--api-token=a-valid-token']
+            processed_arguments = rapidpropull.cli.ArgumentProcessor(argv)
+            assert processed_arguments.get_session_kwargs() == {}
+            processed_arguments = rapidpropull.cli.ArgumentProcessor(
+                argv + ['--http-pool-size=4', '--no-keep-alive', '--no-gzip',
+                        '--max-rate=20', '--max-retries=0'])
+            assert processed_arguments.get_session_kwargs() == {
+                'pool_size': 4, 'keep_alive': False, 'gzip': False,
+                'max_rate': 20, 'max_retries': 0}
+            processed_arguments = rapidpropull.cli.ArgumentProcessor(
+                argv + ['--max-rate=0'])
+            with pytest.raises(docopt.DocoptExit):
+                processed_arguments.get_session_kwargs()
+
+    def test_get_streaming(self):
+        for selector in rapidpropull.cli.ArgumentProcessor.ENDPOINT_SELECTORS:
+            argv = [selector, '--api-token=a-valid-token']
+            processed_arguments = rapidpropull.cli.ArgumentProcessor(argv)
+            assert not processed_arguments.get_streaming()
+            argv.append('--stream')
+            processed_arguments = rapidpropull.cli.ArgumentProcessor(argv)
+            assert processed_arguments.get_streaming()
+
+    def test_get_parallel(self):
+        for selector in rapidpropull.cli.ArgumentProcessor.ENDPOINT_SELECTORS:
+            argv = [selector, '--api-token=a-valid-token']
+            processed_arguments = rapidpropull.cli.ArgumentProcessor(argv)
+            assert processed_arguments.get_parallel() == 1
+            processed_arguments = rapidpropull.cli.ArgumentProcessor(
+                argv + ['--parallel=4'])
+            assert processed_arguments.get_parallel() == 4
+            for invalid in ('0', '-1', 'many'):
+                processed_arguments = rapidpropull.cli.ArgumentProcessor(
+                    argv + ['--parallel={}'.format(invalid)])
+                with pytest.raises(docopt.DocoptExit) as excinfo:
+                    processed_arguments.get_parallel()
+                assert excinfo.match(
+                    'Invalid value of --parallel "{}"'.format(invalid))
+
+    def test_get_concurrent_pages(self):
+        for selector in rapidpropull.cli.ArgumentProcessor.ENDPOINT_SELECTORS:
+            argv = [selector, '--api-token=a-valid-token']
+            processed_arguments = rapidpropull.cli.ArgumentProcessor(argv)
+            assert processed_arguments.get_concurrent_pages() == 1
+            processed_arguments = rapidpropull.cli.ArgumentProcessor(
+                argv + ['--concurrent-pages=8'])
+            assert processed_arguments.get_concurrent_pages() == 8
+            processed_arguments = rapidpropull.cli.ArgumentProcessor(
+                argv + ['--concurrent-pages=0'])
+            with pytest.raises(docopt.DocoptExit) as excinfo:
+                processed_arguments.get_concurrent_pages()
+            assert excinfo.match('Invalid value of --concurrent-pages "0"')
+
+    def test_get_prefetch(self):
+        for selector in rapidpropull.cli.ArgumentProcessor.ENDPOINT_SELECTORS:
+            argv = [selector, '--api-token=a-valid-token']
+            processed_arguments = rapidpropull.cli.ArgumentProcessor(argv)
+            assert processed_arguments.get_prefetch() == 1
+            processed_arguments = rapidpropull.cli.ArgumentProcessor(
+                argv + ['--prefetch=0'])
+            assert processed_arguments.get_prefetch() == 0
+            processed_arguments = rapidpropull.cli.ArgumentProcessor(
+                argv + ['--prefetch=-1'])
+            with pytest.raises(docopt.DocoptExit) as excinfo:
+                processed_arguments.get_prefetch()
+            assert excinfo.match('Invalid value of --prefetch "-1"')
+
+    def test_get_decode_chunk_size(self):
+        for selector in rapidpropull.cli.ArgumentProcessor.ENDPOINT_SELECTORS:
+            argv = [selector, '--api-token=a-valid-token']
+            processed_arguments = rapidpropull.cli.ArgumentProcessor(argv)
+            assert processed_arguments.get_decode_chunk_size() == 50
+            processed_arguments = rapidpropull.cli.ArgumentProcessor(
+                argv + ['--decode-chunk-size=10'])
+            assert processed_arguments.get_decode_chunk_size() == 10
+            processed_arguments = rapidpropull.cli.ArgumentProcessor(
+                argv + ['--decode-chunk-size=0'])
+            with pytest.raises(docopt.DocoptExit) as excinfo:
+                processed_arguments.get_decode_chunk_size()
+            assert excinfo.match('Invalid value of --decode-chunk-size "0"')
+
+    def test_get_decode_workers(self):
+        for selector in rapidpropull.cli.ArgumentProcessor.ENDPOINT_SELECTORS:
+            argv = [selector, '--api-token=a-valid-token']
+            processed_arguments = rapidpropull.cli.ArgumentProcessor(argv)
+            assert processed_arguments.get_decode_workers() == 1
+            processed_arguments = rapidpropull.cli.ArgumentProcessor(
+                argv + ['--decode-workers=4'])
+            assert processed_arguments.get_decode_workers() == 4
+            processed_arguments = rapidpropull.cli.ArgumentProcessor(
+                argv + ['--decode-workers=0'])
+            with pytest.raises(docopt.DocoptExit) as excinfo:
+                processed_arguments.get_decode_workers()
+            assert excinfo.match('Invalid value of --decode-workers "0"')
+
+    def test_get_compact(self):
+        for selector in rapidpropull.cli.ArgumentProcessor.ENDPOINT_SELECTORS:
+            argv = [selector, '--api-token=a-valid-token']
+            processed_arguments = rapidpropull.cli.ArgumentProcessor(argv)
+            assert not processed_arguments.get_compact()
+            processed_arguments = rapidpropull.cli.ArgumentProcessor(
+                argv + ['--compact'])
+            assert processed_arguments.get_compact()
+            for option in ('--stream', '--resume'):
+                processed_arguments = rapidpropull.cli.ArgumentProcessor(
+                    argv + ['--compact', option])
+                with pytest.raises(docopt.DocoptExit) as excinfo:
+                    processed_arguments.get_compact()
+                assert excinfo.match(
+                    '--compact cannot be used with --stream or --resume.')
+
+    def test_get_incremental_and_overlap(self):
+        for selector in rapidpropull.cli.ArgumentProcessor.ENDPOINT_SELECTORS:
+            argv = [selector, '--api-token=a-valid-token']
+            processed_arguments = rapidpropull.cli.ArgumentProcessor(argv)
+            assert not processed_arguments.get_incremental()
+            assert processed_arguments.get_overlap() == 60
+            processed_arguments = rapidpropull.cli.ArgumentProcessor(
+                argv + ['--incremental'])
+            with pytest.raises(docopt.DocoptExit) as excinfo:
+                processed_arguments.get_incremental()
+            assert excinfo.match('--incremental requires --cache.')
+            processed_arguments = rapidpropull.cli.ArgumentProcessor(
+                argv + ['--incremental', '--overlap=0', '--cache=sqlite://'])
+            assert processed_arguments.get_incremental()
+            assert processed_arguments.get_overlap() == 0
+
+    def test_get_cache_kwargs(self):
+        for selector in rapidpropull.cli.ArgumentProcessor.ENDPOINT_SELECTORS:
+            argv = [selector, '--api-token=a-valid-token', '--cache=sqlite://']
+            processed_arguments = rapidpropull.cli.ArgumentProcessor(argv)
+            assert processed_arguments.get_cache_kwargs() == {}
+            processed_arguments = rapidpropull.cli.ArgumentProcessor(
+                argv + ['--cache-batch-size=10'])
+            assert processed_arguments.get_cache_kwargs() == {'batch_size': 10}
+            processed_arguments = rapidpropull.cli.ArgumentProcessor(
+                argv + ['--cache-lookup-chunk-size=50', '--cache-workers=4'])
+            assert processed_arguments.get_cache_kwargs() == {
+                'lookup_chunk_size': 50, 'lookup_workers': 4}
+            processed_arguments = rapidpropull.cli.ArgumentProcessor(
+                argv + ['--cache-memory-entries=0',
+                        '--cache-memory-bytes=1000'])
+            assert processed_arguments.get_cache_kwargs() == {
+                'memory_entries': 0, 'memory_bytes': 1000}
+            processed_arguments = rapidpropull.cli.ArgumentProcessor(
+                argv + ['--passthrough'])
+            assert processed_arguments.get_cache_kwargs() == {
+                'passthrough': True}
+            processed_arguments = rapidpropull.cli.ArgumentProcessor(
+                [selector, '--api-token=a-valid-token', '--passthrough'])
+            with pytest.raises(docopt.DocoptExit) as excinfo:
+                processed_arguments.get_cache_kwargs()
+            assert excinfo.match('--passthrough requires --cache.')
+            processed_arguments = rapidpropull.cli.ArgumentProcessor(
+                argv + ['--cache-workers=0'])
+            with pytest.raises(docopt.DocoptExit) as excinfo:
+                processed_arguments.get_cache_kwargs()
+            assert excinfo.match('--cache-workers')
+
+    def test_get_output_format(self):
+        for selector in rapidpropull.cli.ArgumentProcessor.ENDPOINT_SELECTORS:
+            argv = [selector, '--api-token=a-valid-token']
+            processed_arguments = rapidpropull.cli.ArgumentProcessor(argv)
+            assert processed_arguments.get_output_format() == 'json'
+            processed_arguments = rapidpropull.cli.ArgumentProcessor(
+                argv + ['--format=ndjson'])
+            assert processed_arguments.get_output_format() == 'ndjson'
+            processed_arguments = rapidpropull.cli.ArgumentProcessor(
+                argv + ['--format=xml'])
+            with pytest.raises(docopt.DocoptExit) as excinfo:
+                processed_arguments.get_output_format()
+            assert excinfo.match(
+                'Invalid value of --format "xml".  One of: json, ndjson')
+
+    def test_get_output_path_and_rotate_size(self):
+        for selector in rapidpropull.cli.ArgumentProcessor.ENDPOINT_SELECTORS:
+            argv = [selector, '--api-token=a-valid-token']
+            processed_arguments = rapidpropull.cli.ArgumentProcessor(argv)
+            assert processed_arguments.get_output_path() is None
+            assert processed_arguments.get_rotate_size() is None
+            processed_arguments = rapidpropull.cli.ArgumentProcessor(
+                argv + ['--output=out.ndjson.gz', '--format=ndjson',
+                        '--rotate-size=1000'])
+            assert processed_arguments.get_output_path() == 'out.ndjson.gz'
+            assert processed_arguments.get_rotate_size() == 1000
+            processed_arguments = rapidpropull.cli.ArgumentProcessor(
+                argv + ['--output=out.json', '--rotate-size=1000'])
+            with pytest.raises(docopt.DocoptExit) as excinfo:
+                processed_arguments.get_rotate_size()
+            assert excinfo.match('--rotate-size requires --format=ndjson.')
+            with mock.patch.dict(rapidpropull.output.COMPRESSORS,
+                                 {'.xz': ('no_such_lzma_module',)}):
+                processed_arguments = rapidpropull.cli.ArgumentProcessor(
+                    argv + ['--output=out.json.xz'])
+                with pytest.raises(docopt.DocoptExit) as excinfo:
+                    processed_arguments.get_output_path()
+                assert excinfo.match('The lzma module')
+
+    def test_get_json_backend(self):
+        for selector in rapidpropull.cli.ArgumentProcessor.ENDPOINT_SELECTORS:
+            argv = [selector, '--api-token=a-valid-token']
+            processed_arguments = rapidpropull.cli.ArgumentProcessor(argv)
+            assert processed_arguments.get_json_backend() == 'auto'
+            processed_arguments = rapidpropull.cli.ArgumentProcessor(
+                argv + ['--json-backend=json'])
+            assert processed_arguments.get_json_backend() == 'json'
+            with mock.patch.dict(rapidpropull.codec.BACKENDS, clear=True):
+                processed_arguments = rapidpropull.cli.ArgumentProcessor(
+                    argv + ['--json-backend=ujson'])
+                with pytest.raises(docopt.DocoptExit) as excinfo:
+                    processed_arguments.get_json_backend()
+                assert excinfo.match('JSON backend "ujson" is not available.')
+
+    def test_get_statistics(self):
+        for selector in rapidpropull.cli.ArgumentProcessor.ENDPOINT_SELECTORS:
+            argv = [selector, '--api-token=a-valid-token']
+            processed_arguments = rapidpropull.cli.ArgumentProcessor(argv)
+            assert not processed_arguments.get_statistics()
+            processed_arguments = rapidpropull.cli.ArgumentProcessor(
+                argv + ['--statistics'])
+            assert processed_arguments.get_statistics()
+
+    def test_get_resume(self):
+        for selector in rapidpropull.cli.ArgumentProcessor.ENDPOINT_SELECTORS:
+            argv = [selector, '--api-token=a-valid-token']
+            processed_arguments = rapidpropull.cli.ArgumentProcessor(argv)
+            assert not processed_arguments.get_resume()
+            processed_arguments = rapidpropull.cli.ArgumentProcessor(
+                argv + ['--resume'])
+            with pytest.raises(docopt.DocoptExit) as excinfo:
+                processed_arguments.get_resume()
+            assert excinfo.match('--resume requires --cache.')
+            processed_arguments = rapidpropull.cli.ArgumentProcessor(
+                argv + ['--resume', '--cache=sqlite://'])
+            assert processed_arguments.get_resume()
+
 
 class TestDownloadTask(Auxiliary):
     # noinspection PyUnusedLocal
@@ -405,6 +669,19 @@ class TestDownloadTask(Auxiliary):
                 rapidprocache_class.assert_called_once_with(cache_url)
                 assert download_task.cache is rapidprocache_class.return_value
 
+    # noinspection PyUnusedLocal
+    @mock.patch('temba_client.v1.TembaClient')
+    def test_cache_kwargs_passed_to_cache_constructor(self,
+                                                      temba_client_class):
+        argv = ['--flow-runs', '--api-token', 'token', '--cache', 'sqlite://',
+                '--cache-batch-size', '10']
+        arguments = rapidpropull.cli.ArgumentProcessor(argv)
+        with mock.patch('rapidpropull.cache.RapidProCache',
+                        autospec=True) as rapidprocache_class:
+            rapidpropull.download.DownloadTask(arguments)
+            rapidprocache_class.assert_called_once_with('sqlite://',
+                                                        batch_size=10)
+
     # noinspection PyUnusedLocal
     @mock.patch('temba_client.v1.TembaClient')
     @mock.patch('rapidpropull.cli.ArgumentProcessor')
@@ -803,6 +1080,717 @@ class TestDownloadTask(Auxiliary):
         assert set(stored_result['contacts']) == expected_contacts
         assert set(stored_result['flows']) == expected_flows
 
+    @staticmethod
+    def _prepare_pages(temba_client_class, endpoint_name, pages):
+        endpoint = getattr(temba_client_class.return_value, endpoint_name)
+        endpoint.side_effect = pages
+        pager = temba_client_class.return_value.pager.return_value
+        pager.has_more.side_effect = [True] * (len(pages) - 1) + [False]
+        return endpoint, pager
+
+    @staticmethod
+    def _prepare_numbered_pages(temba_client_class, endpoint_name, objects,
+                                page_size):
+        """
+        Make the endpoint return pages of objects by page number (like
+        RapidPro API v1) and return a list of the numbers of pages requested.
+        """
+        requested = []
+        last_page = (len(objects) + page_size - 1) // page_size
+
+        def endpoint(pager=None, **kwargs):
+            if pager is None:
+                return objects
+            if pager.next_url:
+                page_number = int(pager.next_url)
+            else:
+                page_number = pager.start_page
+            requested.append(page_number)
+            time.sleep(0.01 * (last_page - page_number))
+            pager.update({'count': len(objects),
+                          'next': str(page_number + 1)
+                          if page_number < last_page else None})
+            return objects[(page_number - 1) * page_size:
+                           page_number * page_size]
+
+        temba_client_class.return_value.pager.side_effect = \
+            temba_client.clients.Pager
+        getattr(temba_client_class.return_value, endpoint_name).side_effect =\
+            endpoint
+        return requested
+
+    @mock.patch('temba_client.v1.TembaClient')
+    def test_session_installed_only_while_downloading(self,
+                                                      temba_client_class):
+        sessions = []
+
+        def get_runs(**kwargs):
+            sessions.append(rapidpropull.session._session)
+            assert temba_client.clients.request is not \
+                temba_client.utils.request
+            return []
+
+        temba_client_class.return_value.get_runs.side_effect = get_runs
+        temba_client_class.return_value.pager.return_value.has_more.\
+            return_value = False
+        argv = ['--flow-runs', '--api-token=token']
+        download_task = rapidpropull.download.DownloadTask(
+            rapidpropull.cli.ArgumentProcessor(argv))
+        another_task = rapidpropull.download.DownloadTask(
+            rapidpropull.cli.ArgumentProcessor(argv))
+        assert temba_client.clients.request is temba_client.utils.request
+        download_task.download()
+        assert temba_client.clients.request is temba_client.utils.request
+        list(another_task.download_pages())
+        assert temba_client.clients.request is temba_client.utils.request
+        assert sessions == [download_task.session, another_task.session]
+
+    @mock.patch('temba_client.v1.TembaClient')
+    def test_download_pages_concurrently(self, temba_client_class):
+        objects = list(range(10))
+        argv = ['--flow-runs', '--api-token=token']
+        for concurrent_pages in (1, 3):
+            requested = self._prepare_numbered_pages(
+                temba_client_class, 'get_runs', objects, page_size=3)
+            download_task = rapidpropull.download.DownloadTask(
+                rapidpropull.cli.ArgumentProcessor(argv + [
+                    '--concurrent-pages={}'.format(concurrent_pages)]))
+            pages = list(download_task.download_pages())
+            # pages are yielded in order (even if they arrive out of order)
+            assert pages == [[0, 1, 2], [3, 4, 5], [6, 7, 8], [9]]
+            assert_that(requested, contains_inanyorder(1, 2, 3, 4))
+            download_task.download()
+            assert download_task.get_downloaded_objects() == objects
+
+    @mock.patch('temba_client.v1.TembaClient')
+    def test_download_pages_prefetched(self, temba_client_class):
+        objects = list(range(10))
+        argv = ['--flow-runs', '--api-token=token']
+        # up to prefetch pages are queued and one more is being downloaded
+        for prefetch, prefetched in ((0, [1]), (1, [1, 2, 3]),
+                                     (2, [1, 2, 3, 4])):
+            requested = self._prepare_numbered_pages(
+                temba_client_class, 'get_runs', objects, page_size=3)
+            download_task = rapidpropull.download.DownloadTask(
+                rapidpropull.cli.ArgumentProcessor(
+                    argv + ['--prefetch={}'.format(prefetch)]))
+            pages = download_task.download_pages()
+            assert next(pages) == [0, 1, 2]
+            # give the prefetching thread time to download further pages
+            time.sleep(0.2)
+            assert requested == prefetched
+            assert list(pages) == [[3, 4, 5], [6, 7, 8], [9]]
+            assert requested == [1, 2, 3, 4]
+
+    @mock.patch('temba_client.v1.TembaClient')
+    def test_download_decoded_on_process_pool(self, temba_client_class):
+        client = temba_client_class.return_value
+        runs = [self.make_flow_run(run=i) for i in range(120)]
+        flows = [self.make_flow() for _ in range(2)]
+        for i, run in enumerate(runs):
+            run.flow = flows[i % 2].uuid
+        results = {'runs': [r.serialize() for r in runs],
+                   'flows': [f.serialize() for f in flows]}
+        client._build_params.side_effect = \
+            temba_client.clients.BaseClient._build_params
+        client._get_multiple.side_effect = \
+            lambda endpoint, params, pager: results[endpoint]
+        client.pager.return_value.has_more.return_value = False
+        argv = ['--flow-runs', '--api-token=token', '--decode-workers=2',
+                '--decode-chunk-size=7', '--after=2016-01-01T00:00:00.000Z',
+                '--with-flows']
+        download_task = rapidpropull.download.DownloadTask(
+            rapidpropull.cli.ArgumentProcessor(argv))
+        with mock.patch('multiprocessing.Pool',
+                        wraps=multiprocessing.Pool) as pool_class:
+            download_task.download()
+            downloaded = download_task.get_downloaded_json_structure()
+            assert downloaded['runs'] == results['runs']
+            assert_that(downloaded['flows'],
+                        contains_inanyorder(*results['flows']))
+            pages = list(download_task.download_pages())
+            assert [r.serialize() for r in pages[0]['runs']] == \
+                results['runs']
+        assert pool_class.call_args_list == [mock.call(2)] * 2
+        assert download_task._decoding_pool is None
+        assert_that(client._get_multiple.call_args_list, has_items(
+            mock.call('runs', {'after': '2016-01-01T00:00:00.000Z'}, None),
+            mock.call('runs', {'after': '2016-01-01T00:00:00.000Z'},
+                      client.pager.return_value)))
+        assert not client.get_runs.called and not client.get_flows.called
+
+    def test_raw_endpoints_match_temba_client(self):
+        # RAW_ENDPOINTS mirrors the private parameter mapping of TembaClient
+        download_task = rapidpropull.download.DownloadTask(
+            rapidpropull.cli.ArgumentProcessor(
+                ['--flow-runs', '--api-token=token']))
+        client = download_task.client
+        methods = {'--flow-runs': client.get_runs,
+                   '--flows': client.get_flows,
+                   '--contacts': client.get_contacts}
+        values = {'uuids': ['uuid1', 'uuid2'],
+                  'before': '2016-02-01T00:00:00.000Z',
+                  'after': '2016-01-01T00:00:00.000Z'}
+        for selector, (_, _, parameters) in \
+                download_task.RAW_ENDPOINTS.items():
+            kwargs = {k: values[k] for k in parameters}
+            with mock.patch.object(client, '_get_multiple',
+                                   return_value=[]) as get_multiple:
+                methods[selector](**kwargs)
+                download_task._request_and_decode(selector, **kwargs)
+            assert get_multiple.call_count == 2
+            assert get_multiple.call_args_list[0] == \
+                get_multiple.call_args_list[1]
+
+    @mock.patch('temba_client.v1.TembaClient')
+    def test_download_compact(self, temba_client_class):
+        client = temba_client_class.return_value
+        runs = [self.make_flow_run(run=i) for i in range(3)]
+        flows = [self.make_flow()]
+        for run in runs:
+            run.flow = flows[0].uuid
+        client.get_runs.return_value = runs
+        client.get_flows.return_value = flows
+        client.pager.return_value.has_more.return_value = False
+        argv = ['--flow-runs', '--api-token=token', '--with-flows',
+                '--compact']
+        download_task = rapidpropull.download.DownloadTask(
+            rapidpropull.cli.ArgumentProcessor(argv))
+        download_task.download()
+        records = download_task.get_downloaded_records()
+        assert_that(records['runs'] + records['flows'], only_contains(
+            instance_of(rapidpropull.codec.CachedJSON)))
+        assert [r.id for r in records['runs']] == [r.id for r in runs]
+        objects = download_task.get_downloaded_objects()
+        assert_that(objects['runs'], only_contains(
+            instance_of(temba_client.v1.types.Run)))
+        assert [r.serialize() for r in objects['runs']] == \
+            [r.serialize() for r in runs]
+        assert [f.serialize() for f in objects['flows']] == \
+            [f.serialize() for f in flows]
+        assert download_task.get_downloaded_json_structure() == {
+            'runs': [r.serialize() for r in runs],
+            'flows': [f.serialize() for f in flows]}
+
+    @mock.patch('temba_client.v1.TembaClient')
+    def test_download_passed_through(self, temba_client_class):
+        runs = [self.make_flow_run(run=i) for i in range(2)]
+        cache = rapidpropull.cache.RapidProCache('sqlite://', passthrough=True)
+        cache.insert_objects([runs[0]])
+        temba_client_class.return_value.get_runs.return_value = runs
+        argv = ['--flow-runs', '--api-token=token', '--cache=sqlite://',
+                '--passthrough']
+        with mock.patch('rapidpropull.cache.RapidProCache',
+                        return_value=cache):
+            download_task = rapidpropull.download.DownloadTask(
+                rapidpropull.cli.ArgumentProcessor(argv))
+        download_task.download()
+        records = download_task.get_downloaded_records()
+        assert isinstance(records[0], rapidpropull.codec.CachedJSON)
+        objects = download_task.get_downloaded_objects()
+        assert_that(objects, only_contains(
+            instance_of(temba_client.v1.types.Run)))
+        assert [r.serialize() for r in objects] == \
+            [r.serialize() for r in runs]
+
+    @mock.patch('temba_client.v1.TembaClient')
+    def test_download_interned(self, temba_client_class):
+        # separately decoded strings are equal but not identical
+        def make_runs(first):
+            return [self.make_flow_run(
+                run=first + i, flow_uuid=u''.join(['flow', '1']),
+                contact=u''.join(['contact', '1'])) for i in range(2)]
+
+        flow_uuids = []
+        runs = []
+        shared = []
+
+        def get_flows(uuids):
+            # interned before associated objects are requested
+            shared.append(all(r.flow is runs[0].flow for r in runs))
+            flow_uuids.extend(uuids)
+            return []
+
+        client = temba_client_class.return_value
+        client.get_flows.side_effect = get_flows
+        # only objects requested page by page are interned
+        for arguments, interned in ((['--concurrent-pages=1'], False),
+                                    (['--concurrent-pages=2'], True),
+                                    (['--compact'], True)):
+            del flow_uuids[:], shared[:]
+            runs[:] = make_runs(0) + make_runs(2)
+            assert runs[0].flow is not runs[1].flow
+            self._prepare_numbered_pages(temba_client_class, 'get_runs', runs,
+                                         page_size=2)
+            download_task = rapidpropull.download.DownloadTask(
+                rapidpropull.cli.ArgumentProcessor(
+                    ['--flow-runs', '--api-token=token', '--with-flows'] +
+                    arguments))
+            with mock.patch('rapidpropull.interning.Interner',
+                            side_effect=rapidpropull.interning.Interner) \
+                    as interner:
+                download_task.download()
+            assert interner.called == interned
+            assert shared == [interned]
+            assert all(r.contact is runs[0].contact for r in runs) == interned
+            assert flow_uuids == ['flow1']
+            assert download_task._interner is None
+
+    @mock.patch('temba_client.v1.TembaClient')
+    def test_download_compact_page_by_page(self, temba_client_class, tmpdir):
+        page_size = 5
+        alive = []  # weak references to the runs of each page
+
+        def get_runs(pager=None, **kwargs):
+            # at most the previous page is still held as RapidPro objects
+            assert sum(r() is not None for r in alive) <= page_size
+            page_number = pager.next_url or 1
+            pager.update({'count': 4 * page_size,
+                          'next': page_number + 1 if page_number < 4 else None})
+            runs = [self.make_flow_run(
+                run=page_number * 100 + i,
+                modified_on='2016-01-0{}T00:00:00.000Z'.format(page_number))
+                for i in range(page_size)]
+            alive.extend(weakref.ref(r) for r in runs)
+            return runs
+
+        client = temba_client_class.return_value
+        client.pager.side_effect = temba_client.clients.Pager
+        client.get_runs.side_effect = get_runs
+        cache_url = 'sqlite:///{}'.format(tmpdir.join('cache.db'))
+        argv = ['--flow-runs', '--api-token=token', '--compact',
+                '--incremental', '--cache={}'.format(cache_url)]
+        download_task = rapidpropull.download.DownloadTask(
+            rapidpropull.cli.ArgumentProcessor(argv))
+        download_task.download()
+        assert client.get_runs.call_count == 4
+        records = download_task.get_downloaded_records()
+        assert len(records) == 4 * page_size
+        assert_that(records, only_contains(
+            instance_of(rapidpropull.codec.CachedJSON)))
+        # the high-water mark is tracked before the pages are compacted
+        assert download_task.cache.get_high_water_mark(
+            '--flow-runs', download_task.address) == \
+            temba_client.utils.parse_iso8601('2016-01-04T00:00:00.000Z')
+
+    @mock.patch('temba_client.v1.TembaClient')
+    def test_download_pages_in_pipeline(self, temba_client_class, tmpdir):
+        cache_url = 'sqlite:///{}'.format(tmpdir.join('cache.db'))
+        objects = [self.make_flow_run(run=i) for i in range(10)]
+        self._prepare_numbered_pages(temba_client_class, 'get_runs', objects,
+                                     page_size=3)
+        argv = ['--flow-runs', '--api-token=token', '--prefetch=2',
+                '--cache={}'.format(cache_url)]
+        download_task = rapidpropull.download.DownloadTask(
+            rapidpropull.cli.ArgumentProcessor(argv))
+        pages = list(download_task.download_pages())
+        assert pages == [objects[0:3], objects[3:6], objects[6:9], objects[9:]]
+        statistics = download_task.get_statistics()
+        for stage in ('fetch', 'substitute', 'store'):
+            assert statistics['{} stage items'.format(stage)] == 4
+            assert statistics['{} stage max queue depth'.format(stage)] <= 2
+        cache = rapidpropull.cache.RapidProCache(cache_url)
+        for run in objects:
+            assert cache.get_flow_run(run.id) is not None
+
+    @mock.patch('temba_client.v1.TembaClient')
+    def test_download_pages_concurrently_from_checkpoint(
+            self, temba_client_class, tmpdir):
+        cache_url = 'sqlite:///{}'.format(tmpdir.join('cache.db'))
+        objects = [self.make_flow_run(run=i) for i in range(10)]
+        self._prepare_numbered_pages(temba_client_class, 'get_runs', objects,
+                                     page_size=3)
+        argv = ['--flow-runs', '--api-token=token', '--concurrent-pages=3',
+                '--cache={}'.format(cache_url)]
+        query = rapidpropull.download.DownloadTask._get_checkpoint_query({})
+        cache = rapidpropull.cache.RapidProCache(cache_url)
+        cache.save_checkpoint('--flow-runs', 'rapidpro.io', query, 2)
+        download_task = rapidpropull.download.DownloadTask(
+            rapidpropull.cli.ArgumentProcessor(argv + ['--resume']))
+        checkpoints = []
+        with mock.patch.object(download_task.cache, 'insert_objects') as insert:
+            pages = list(download_task.download_pages())
+            for call in insert.call_args_list:
+                checkpoints.append(call[1]['checkpoint']['next_page'])
+        assert pages == [objects[3:6], objects[6:9], objects[9:]]
+        assert checkpoints == [3, 4, None]
+
+    @mock.patch('temba_client.v1.TembaClient')
+    def test_download_pages_concurrently_reraises_exceptions(
+            self, temba_client_class):
+        objects = list(range(10))
+        self._prepare_numbered_pages(temba_client_class, 'get_runs', objects,
+                                     page_size=3)
+        endpoint = temba_client_class.return_value.get_runs.side_effect
+
+        def failing_endpoint(pager=None, **kwargs):
+            if pager.start_page == 3:
+                raise TembaConnectionError()
+            return endpoint(pager, **kwargs)
+
+        temba_client_class.return_value.get_runs.side_effect = \
+            failing_endpoint
+        download_task = rapidpropull.download.DownloadTask(
+            rapidpropull.cli.ArgumentProcessor(
+                ['--flow-runs', '--api-token=token', '--concurrent-pages=3']))
+        pages = download_task.download_pages()
+        assert next(pages) == [0, 1, 2]
+        assert next(pages) == [3, 4, 5]
+        with pytest.raises(TembaConnectionError):
+            next(pages)
+
+    @staticmethod
+    def _make_windowed_endpoint(objects):
+        def endpoint(after, before, pager=None):
+            after = temba_client.utils.parse_iso8601(after)
+            before = temba_client.utils.parse_iso8601(before)
+            return [o for o in objects if after <= o.modified_on <= before]
+        return endpoint
+
+    def _make_objects_modified_every_second(self, selector, count):
+        timestamp = '2016-01-01T00:00:{:02d}.000000Z'
+        if selector == '--flow-runs':
+            return [self.make_flow_run(run=i, modified_on=timestamp.format(i))
+                    for i in range(count)]
+        elif selector == '--flows':
+            # flows have no modified_on but it does not matter for the mock
+            return [mock.MagicMock(spec=temba_client.v1.types.Flow,
+                                   uuid='flow{}'.format(i),
+                                   modified_on=temba_client.utils.
+                                   parse_iso8601(timestamp.format(i)))
+                    for i in range(count)]
+        return [self.make_contact(modified_on=timestamp.format(i))
+                for i in range(count)]
+
+    @mock.patch('temba_client.v1.TembaClient')
+    def test_get_sharded_endpoint_kwargs(self, temba_client_class):
+        argv = ['--flow-runs', '--api-token=token', '--parallel=3',
+                '--after=2016-01-01T00:00:00.000000Z',
+                '--before=2016-01-01T00:00:03.000000Z']
+        download_task = rapidpropull.download.DownloadTask(
+            rapidpropull.cli.ArgumentProcessor(argv))
+        assert download_task._get_sharded_endpoint_kwargs() == [
+            {'after': u'2016-01-01T00:00:01.999000',
+             'before': '2016-01-01T00:00:03.000000Z'},
+            {'after': u'2016-01-01T00:00:00.999000',
+             'before': u'2016-01-01T00:00:02.000000'},
+            {'after': '2016-01-01T00:00:00.000000Z',
+             'before': u'2016-01-01T00:00:01.000000'}]
+        # no sharding without a complete (and valid) time window
+        for kwargs in ({'after': '2016-01-01T00:00:00.000000Z'},
+                       {'before': '2016-01-01T00:00:00.000000Z'},
+                       {'after': '2016-01-02T00:00:00.000000Z',
+                        'before': '2016-01-01T00:00:00.000000Z'},
+                       {'after': 'yesterday', 'before': 'today'}):
+            download_task.endpoint_kwargs = kwargs
+            assert download_task._get_sharded_endpoint_kwargs() == [kwargs]
+        download_task.endpoint_kwargs = argv
+        download_task.parallel = 1
+        assert download_task._get_sharded_endpoint_kwargs() == [argv]
+
+    @mock.patch('temba_client.v1.TembaClient')
+    def test_parallel_download(self, temba_client_class):
+        for selector, endpoint_name in (('--flow-runs', 'get_runs'),
+                                        ('--flows', 'get_flows'),
+                                        ('--contacts', 'get_contacts')):
+            objects = self._make_objects_modified_every_second(selector, 10)
+            endpoint = getattr(temba_client_class.return_value, endpoint_name)
+            endpoint.side_effect = self._make_windowed_endpoint(objects)
+            argv = [selector, '--api-token=token', '--parallel=4',
+                    '--after=2016-01-01T00:00:00.000000Z',
+                    '--before=2016-01-01T00:00:09.000000Z']
+            download_task = rapidpropull.download.DownloadTask(
+                rapidpropull.cli.ArgumentProcessor(argv))
+            download_task.download()
+            assert endpoint.call_count == 4
+            downloaded = download_task.get_downloaded_objects()
+            # objects on sub-window boundaries are not duplicated
+            assert len(downloaded) == len(objects)
+            assert_that(downloaded, contains_inanyorder(*objects))
+            endpoint.reset_mock()
+
+    @mock.patch('temba_client.v1.TembaClient')
+    def test_parallel_download_pages(self, temba_client_class):
+        objects = self._make_objects_modified_every_second('--flow-runs', 10)
+        temba_client_class.return_value.get_runs.side_effect = \
+            self._make_windowed_endpoint(objects)
+        temba_client_class.return_value.pager.return_value.has_more.\
+            return_value = False
+        argv = ['--flow-runs', '--api-token=token', '--parallel=3',
+                '--after=2016-01-01T00:00:00.000000Z',
+                '--before=2016-01-01T00:00:09.000000Z']
+        download_task = rapidpropull.download.DownloadTask(
+            rapidpropull.cli.ArgumentProcessor(argv))
+        downloaded = []
+        for page in download_task.download_pages():
+            downloaded.extend(page)
+        assert temba_client_class.return_value.get_runs.call_count == 3
+        assert len(downloaded) == len(objects)
+        assert_that(downloaded, contains_inanyorder(*objects))
+
+    @mock.patch('temba_client.v1.TembaClient')
+    def test_parallel_download_pages_reraises_exceptions(
+            self, temba_client_class):
+        temba_client_class.return_value.get_runs.side_effect = \
+            TembaConnectionError()
+        argv = ['--flow-runs', '--api-token=token', '--parallel=3',
+                '--after=2016-01-01T00:00:00.000000Z',
+                '--before=2016-01-01T00:00:09.000000Z']
+        download_task = rapidpropull.download.DownloadTask(
+            rapidpropull.cli.ArgumentProcessor(argv))
+        with pytest.raises(TembaConnectionError):
+            list(download_task.download_pages())
+
+    def test_iterate_concurrently_stops_threads(self):
+        closed = []
+
+        def pages():
+            try:
+                while True:
+                    yield 'page'
+            finally:
+                closed.append(True)
+
+        def fail():
+            time.sleep(0.05)  # let the queue fill up
+            raise TembaConnectionError()
+            # noinspection PyUnreachableCode
+            yield
+
+        threads = threading.active_count()
+        items = rapidpropull.download._iterate_concurrently([pages(), fail()])
+        with pytest.raises(TembaConnectionError):
+            list(items)
+        assert closed == [True]
+        assert threading.active_count() == threads
+        del closed[:]
+        items = rapidpropull.download._iterate_concurrently(
+            [pages(), pages()])
+        assert next(items) == 'page'
+        time.sleep(0.05)
+        items.close()  # abandoned before the end
+        assert closed == [True, True]
+        assert threading.active_count() == threads
+
+    @mock.patch('temba_client.v1.TembaClient')
+    def test_incremental_download(self, temba_client_class, tmpdir):
+        cache_url = 'sqlite:///{}'.format(tmpdir.join('cache.db'))
+        get_runs = temba_client_class.return_value.get_runs
+        argv = ['--flow-runs', '--api-token=token', '--incremental',
+                '--overlap=10', '--cache={}'.format(cache_url)]
+        # the first incremental download gets everything
+        get_runs.return_value = [
+            self.make_flow_run(run=1, modified_on='2016-01-01T10:00:00.000Z'),
+            self.make_flow_run(run=2, modified_on='2016-01-01T12:00:00.000Z'),
+            self.make_flow_run(run=3, modified_on=None)]
+        download_task = rapidpropull.download.DownloadTask(
+            rapidpropull.cli.ArgumentProcessor(argv))
+        download_task.download()
+        get_runs.assert_called_once_with()
+        # the next one starts where the previous one finished (minus overlap)
+        get_runs.reset_mock()
+        get_runs.return_value = [
+            self.make_flow_run(run=4, modified_on='2016-01-01T11:00:00.000Z')]
+        download_task = rapidpropull.download.DownloadTask(
+            rapidpropull.cli.ArgumentProcessor(argv))
+        download_task.download()
+        get_runs.assert_called_once_with(after=u'2016-01-01T11:59:50.000000')
+        # an older object does not move the high-water mark backwards
+        get_runs.reset_mock()
+        temba_client_class.return_value.pager.return_value.has_more.\
+            return_value = False
+        download_task = rapidpropull.download.DownloadTask(
+            rapidpropull.cli.ArgumentProcessor(argv))
+        list(download_task.download_pages())
+        get_runs.assert_called_once_with(
+            after=u'2016-01-01T11:59:50.000000', before=mock.ANY,
+            pager=temba_client_class.return_value.pager.return_value)
+        # --after given explicitly takes precedence
+        get_runs.reset_mock()
+        download_task = rapidpropull.download.DownloadTask(
+            rapidpropull.cli.ArgumentProcessor(
+                argv + ['--after=2015-01-01T00:00:00.000Z']))
+        download_task.download()
+        get_runs.assert_called_once_with(after='2015-01-01T00:00:00.000Z')
+        # high-water marks are kept separately for each RapidPro server
+        get_runs.reset_mock()
+        download_task = rapidpropull.download.DownloadTask(
+            rapidpropull.cli.ArgumentProcessor(
+                argv + ['--address=another.rapidpro.io']))
+        download_task.download()
+        get_runs.assert_called_once_with()
+
+    @mock.patch('temba_client.v1.TembaClient')
+    def test_incremental_download_filtered_by_uuid(self, temba_client_class,
+                                                   tmpdir):
+        cache_url = 'sqlite:///{}'.format(tmpdir.join('cache.db'))
+        get_flows = temba_client_class.return_value.get_flows
+        argv = ['--flows', '--api-token=token', '--incremental',
+                '--cache={}'.format(cache_url)]
+        flow = self.make_flow(created_on='2016-10-01T00:00:00.000Z')
+        get_flows.return_value = [flow]
+        for download in ('download', 'download_pages'):
+            temba_client_class.return_value.pager.return_value.has_more.\
+                return_value = False
+            download_task = rapidpropull.download.DownloadTask(
+                rapidpropull.cli.ArgumentProcessor(
+                    argv + ['--uuid={}'.format(flow.uuid)]))
+            list(getattr(download_task, download)() or [])
+        # older flows not matching the filter are not skipped
+        get_flows.reset_mock()
+        download_task = rapidpropull.download.DownloadTask(
+            rapidpropull.cli.ArgumentProcessor(argv))
+        download_task.download()
+        get_flows.assert_called_once_with()
+
+    @mock.patch('temba_client.v1.TembaClient')
+    def test_resume_interrupted_download(self, temba_client_class, tmpdir):
+        cache_url = 'sqlite:///{}'.format(tmpdir.join('cache.db'))
+        runs = [self.make_flow_run(run=i) for i in range(1, 6)]
+        client = temba_client_class.return_value
+        client.get_runs.side_effect = [[runs[0]], [runs[1]],
+                                       TembaConnectionError()]
+        client.pager.return_value.has_more.return_value = True
+        argv = ['--flow-runs', '--api-token=token', '--stream',
+                '--cache={}'.format(cache_url)]
+        with iocapture.capture() as captured_out:
+            with pytest.raises(SystemExit):
+                rapidpropull.cli.main(argv)
+            assert 'Unable to connect to host' in captured_out.stderr
+        cache = rapidpropull.cache.RapidProCache(cache_url)
+        assert cache.get_flow_run(runs[1].id) is not None
+        # pinned to the time the download started
+        upper_bounds = {c[1]['before'] for c in client.get_runs.call_args_list}
+        assert len(upper_bounds) == 1
+        # the interrupted download is continued from the third page (with the
+        # same upper bound so that objects modified since do not shift pages)
+        client.reset_mock()
+        client.get_runs.side_effect = [[runs[2]], [runs[3], runs[4]]]
+        client.pager.return_value.has_more.side_effect = [True, False]
+        with iocapture.capture() as captured_out:
+            rapidpropull.cli.main(argv[:2] + ['--resume'] + argv[3:])
+            result = json.loads(captured_out.stdout)
+        client.pager.assert_called_once_with(start_page=3)
+        assert {c[1]['before'] for c in client.get_runs.call_args_list} == \
+            upper_bounds
+        assert result == [r.serialize() for r in runs[2:]]
+        for run in runs:
+            assert cache.get_flow_run(run.id) is not None
+        # a completed download leaves no checkpoint behind
+        client.reset_mock()
+        client.get_runs.side_effect = [runs]
+        client.pager.return_value.has_more.side_effect = [False]
+        download_task = rapidpropull.download.DownloadTask(
+            rapidpropull.cli.ArgumentProcessor(argv + ['--resume']))
+        assert list(download_task.download_pages()) == [runs]
+        client.pager.assert_called_once_with(start_page=1)
+
+    @mock.patch('temba_client.v1.TembaClient')
+    def test_download_pages(self, temba_client_class):
+        for selector, endpoint_name in (('--flow-runs', 'get_runs'),
+                                        ('--flows', 'get_flows'),
+                                        ('--contacts', 'get_contacts')):
+            pages = [[object(), object()], [object()], [object()]]
+            download_task = self.make_download_task(selector, None,
+                                                    temba_client_class)
+            endpoint, pager = self._prepare_pages(temba_client_class,
+                                                  endpoint_name, pages)
+            result = []
+            for page in download_task.download_pages():
+                result.append(page)
+                # only the current page is retained by the download task
+                assert download_task.get_downloaded_objects() is page
+            assert result == pages
+            assert endpoint.call_count == len(pages)
+            endpoint.assert_called_with(pager=pager,
+                                        **download_task.endpoint_kwargs)
+
+    @mock.patch('rapidpropull.cache.RapidProCache', autospec=True)
+    @mock.patch('temba_client.v1.TembaClient')
+    def test_download_pages_uses_cache_for_each_page(
+            self, temba_client_class, rapidprocache_class):
+        pages = [[object(), object()], [object()]]
+        download_task = self.make_download_task(
+            '--flow-runs', None, temba_client_class,
+            optional_argv=['--cache', 'sqlite://'])
+        self._prepare_pages(temba_client_class, 'get_runs', pages)
+        cache = rapidprocache_class.return_value
+        checkpoint = {
+            'endpoint_selector': '--flow-runs',
+            'server': 'rapidpro.io',
+            'query': download_task._get_checkpoint_query(
+                download_task.endpoint_kwargs),
+            'upper_bound': None  # --before given
+        }
+        next_pages = iter([2, None])
+        for page in download_task.download_pages():
+            cache.substitute_cached_for_downloaded.assert_called_with(page)
+            checkpoint['next_page'] = next(next_pages)
+            cache.insert_objects.assert_called_with(page,
+                                                    checkpoint=checkpoint)
+        assert cache.substitute_cached_for_downloaded.call_count == 2
+        assert cache.insert_objects.call_count == 2
+
+    @mock.patch('temba_client.v1.TembaClient')
+    def test_download_pages_yields_associations_once(self, temba_client_class):
+        runs = [mock.MagicMock(spec=temba_client.v1.types.Run, id=i,
+                               flow='flow{}'.format(i % 2),
+                               contact='contact{}'.format(i // 2))
+                for i in range(4)]
+        pages = [runs[:2], runs[2:]]
+        self._prepare_pages(temba_client_class, 'get_runs', pages)
+        client = temba_client_class.return_value
+        client.get_flows.side_effect = lambda uuids: sorted(uuids)
+        client.get_contacts.side_effect = lambda uuids: sorted(uuids)
+        argv = ['--api-token=a-token', '--flow-runs', '--with-flows',
+                '--with-contacts']
+        download_task = rapidpropull.download.DownloadTask(
+            rapidpropull.cli.ArgumentProcessor(argv))
+        result = list(download_task.download_pages())
+        assert result == [
+            {'runs': runs[:2], 'flows': ['flow0', 'flow1'],
+             'contacts': ['contact0']},
+            {'runs': runs[2:], 'flows': [], 'contacts': ['contact1']}]
+        # flows already yielded are not requested again
+        client.get_flows.assert_called_once_with(uuids={'flow0', 'flow1'})
+
+    @mock.patch('rapidpropull.download.DownloadTask.ASSOCIATION_BATCH_SIZE', 2)
+    @mock.patch('temba_client.v1.TembaClient')
+    def test_download_associations_in_concurrent_batches(self,
+                                                         temba_client_class):
+        runs = [mock.MagicMock(spec=temba_client.v1.types.Run, id=i,
+                               flow='flow{}'.format(i),
+                               contact='contact{}'.format(i))
+                for i in range(5)]
+        client = temba_client_class.return_value
+        client.get_runs.return_value = runs
+        contacts_requested = threading.Event()
+
+        def get_flows(uuids):
+            # flows are only returned once contacts have been requested, too
+            assert contacts_requested.wait(5)
+            return sorted(uuids)
+
+        def get_contacts(uuids):
+            contacts_requested.set()
+            return sorted(uuids)
+
+        client.get_flows.side_effect = get_flows
+        client.get_contacts.side_effect = get_contacts
+        argv = ['--api-token=a-token', '--flow-runs', '--with-flows',
+                '--with-contacts', '--parallel=4']
+        download_task = rapidpropull.download.DownloadTask(
+            rapidpropull.cli.ArgumentProcessor(argv))
+        download_task.download()
+        assert download_task.get_downloaded_objects() == {
+            'runs': runs,
+            'flows': ['flow{}'.format(i) for i in range(5)],
+            'contacts': ['contact{}'.format(i) for i in range(5)]}
+        assert_that(client.get_flows.call_args_list, contains_inanyorder(
+            mock.call(uuids={'flow0', 'flow1'}),
+            mock.call(uuids={'flow2', 'flow3'}), mock.call(uuids={'flow4'})))
+        assert client.get_contacts.call_count == 3
+
 
 class TestRapidProCache(Auxiliary):
     @staticmethod
@@ -816,8 +1804,8 @@ class TestRapidProCache(Auxiliary):
                     insert, {
                         'run': object_to_insert.id,
                         'json': json.dumps(object_to_insert.serialize()),
-                        'contact': object_to_insert.contact,
-                        'flow': object_to_insert.flow
+                        'contact_uuid': object_to_insert.contact,
+                        'flow_uuid': object_to_insert.flow
                     }
                 )
             elif isinstance(object_to_insert, temba_client.v1.types.Flow):
@@ -908,6 +1896,94 @@ class TestRapidProCache(Auxiliary):
         assert contact.columns['uuid'].type.length == 36
         assert 'json' in contact.columns
         assert isinstance(contact.columns['json'].type, sqlalchemy.Text)
+        # table 'sync_state'
+        assert 'sync_state' in cache.database.tables
+        sync_state = cache.database.tables['sync_state']
+        assert sync_state.columns['endpoint'].primary_key
+        assert sync_state.columns['server'].primary_key
+        assert 'high_water_mark' in sync_state.columns
+        # indexed columns extracted from the JSON of objects
+        inspector = sqlalchemy.inspect(cache.database.bind)
+        for table_name, columns in (
+                ('flowrun', ['flow_uuid', 'contact_uuid', 'created_on',
+                             'modified_on', 'completed']),
+                ('flow', ['created_on']), ('contact', ['modified_on'])):
+            assert_that(
+                [i['column_names'] for i in inspector.get_indexes(table_name)],
+                contains_inanyorder(*[[c] for c in columns]))
+
+    def test_extracted_columns_stored(self):
+        cache = rapidpropull.cache.RapidProCache('sqlite://')
+        run = self.make_flow_run(created_on='2016-01-02T00:00:00.000Z',
+                                 modified_on='2016-01-03T00:00:00.000Z',
+                                 completed=True)
+        flow = self.make_flow(created_on='2016-01-01T00:00:00.000Z')
+        cache.insert_objects([run, rapidpropull.codec.CachedJSON.from_object(
+            flow)])
+        flowrun = cache.database.tables['flowrun']
+        row = cache.database.bind.execute(flowrun.select()).fetchone()
+        assert (row.created_on, row.modified_on, row.completed) == \
+            (run.serialize()['created_on'], run.serialize()['modified_on'],
+             True)
+        row = cache.database.bind.execute(
+            cache.database.tables['flow'].select()).fetchone()
+        assert row.created_on == flow.serialize()['created_on']
+
+    def test_insert_objects_decodes_no_json_text(self):
+        cache = rapidpropull.cache.RapidProCache('sqlite://', memory_entries=0)
+        runs = [self.make_flow_run(run=i, completed=True) for i in range(3)]
+        cache.insert_objects(runs[:2])
+        cached, _ = cache.get_objects('--flow-runs', {0, 1})
+        compact = rapidpropull.codec.CachedJSON.from_object(runs[2])
+        with mock.patch('rapidpropull.codec.loads') as loads:
+            # cached objects are not serialised again and new compact records
+            # carry the values of their extracted columns
+            cache.insert_objects(cached + [compact])
+        assert not loads.called
+        assert not any(o.is_decoded() for o in cached)
+        flowrun = cache.database.tables['flowrun']
+        row = cache.database.bind.execute(
+            flowrun.select().where(flowrun.c.run == 2)).fetchone()
+        assert (row.json, row.modified_on, row.completed) == \
+            (compact.json, runs[2].serialize()['modified_on'], True)
+
+    def test_existing_database_migrated(self, tmpdir):
+        cache_url = 'sqlite:///{}'.format(tmpdir.join('cache.db'))
+        run = self.make_flow_run(created_on='2016-01-02T00:00:00.000Z',
+                                 completed=False)
+        contact = self.make_contact(modified_on='2016-01-01T00:00:00.000Z')
+        engine = sqlalchemy.create_engine(cache_url)
+        engine.execute('CREATE TABLE flowrun (run INTEGER PRIMARY KEY,'
+                       ' json TEXT, flow_uuid VARCHAR(36),'
+                       ' contact_uuid VARCHAR(36))')
+        engine.execute('CREATE TABLE contact (uuid VARCHAR(36) PRIMARY KEY,'
+                       ' json TEXT)')
+        engine.execute('INSERT INTO flowrun VALUES (?, ?, ?, ?)', run.id,
+                       json.dumps(run.serialize()), run.flow, run.contact)
+        engine.execute('INSERT INTO contact VALUES (?, ?)', contact.uuid,
+                       json.dumps(contact.serialize()))
+        engine.execute('CREATE TABLE checkpoint (endpoint VARCHAR(16),'
+                       ' server VARCHAR(255), query VARCHAR(40),'
+                       ' next_page INTEGER,'
+                       ' PRIMARY KEY (endpoint, server, query))')
+        engine.execute('INSERT INTO checkpoint VALUES (?, ?, ?, ?)',
+                       '--flow-runs', 'rapidpro.io', 'q', 2)
+        engine.dispose()
+        for _ in range(2):  # migrating a migrated database changes nothing
+            cache = rapidpropull.cache.RapidProCache(cache_url)
+            rows = cache.database.bind.execute(
+                'SELECT created_on, modified_on, completed FROM flowrun'
+                ' WHERE flow_uuid = ?', run.flow).fetchall()
+            assert rows == [(run.serialize()['created_on'], None, 0)]
+            rows = cache.database.bind.execute(
+                'SELECT modified_on FROM contact').fetchall()
+            assert rows == [(contact.serialize()['modified_on'],)]
+            inspector = sqlalchemy.inspect(cache.database.bind)
+            assert len(inspector.get_indexes('flowrun')) == 5
+            assert cache.get_flow_run(run.id).serialize() == run.serialize()
+            assert cache.get_checkpoint(
+                '--flow-runs', 'rapidpro.io', 'q') == (2, None)
+            cache.database.bind.dispose()
 
     def test_get_flow_run(self):
         cache_url = 'sqlite://'
@@ -1010,6 +2086,28 @@ class TestRapidProCache(Auxiliary):
         assert cache.get_contact(contact0.uuid).name == expected_contact0_name
         assert cache.get_flow(flow0.uuid).name == expected_flow0_name
 
+    def test_insert_objects_in_batches(self):
+        cache = rapidpropull.cache.RapidProCache('sqlite://', batch_size=2)
+        assert rapidpropull.cache.RapidProCache('sqlite://').batch_size == \
+            rapidpropull.cache.RapidProCache.DEFAULT_BATCH_SIZE
+        runs = [self.make_flow_run(run=i) for i in range(5)]
+        flows = [self.make_flow() for _ in range(2)]
+        cache.insert_objects([runs[0]])
+        statements = []
+        sqlalchemy.event.listen(
+            cache.database.bind, 'before_cursor_execute',
+            lambda conn, cursor, statement, *args: statements.append(
+                statement.split()[0]))
+        # duplicates in input and objects already cached are skipped
+        cache.insert_objects({'runs': runs + [runs[4]], 'flows': flows})
+        # one SELECT and one (multi-row) INSERT per batch: 1 batch of flows
+        # and 3 batches of runs
+        assert statements == ['SELECT', 'INSERT'] * 4
+        for run in runs:
+            assert cache.get_flow_run(run.id).serialize() == run.serialize()
+        for flow in flows:
+            assert cache.get_flow(flow.uuid).serialize() == flow.serialize()
+
     def test_get_objects(self):
         for endpoint_selector in\
                 rapidpropull.cli.ArgumentProcessor.ENDPOINT_SELECTORS:
@@ -1044,6 +2142,11 @@ class TestRapidProCache(Auxiliary):
             objects, missing_uuids = cache.get_objects(endpoint_selector,
                                                        uuids.union(not_cached))
             assert missing_uuids == not_cached
+            # read without decoding until an attribute needs it
+            assert_that(objects, only_contains(instance_of(
+                rapidpropull.codec.LazyObject)))
+            assert not any(o.is_decoded() for o in objects)
+            assert {getattr(o, id_attr) for o in objects} == uuids
             expected_objects = [o.serialize() for o in cached]
             fetched_objects = [o.serialize() for o in objects]
             assert_that(fetched_objects, contains_inanyorder(*expected_objects))
@@ -1081,6 +2184,208 @@ class TestRapidProCache(Auxiliary):
         cache.substitute_cached_for_downloaded(downloaded)
         assert [o.serialize() for o in downloaded] == expected
 
+    def test_high_water_mark(self):
+        cache = rapidpropull.cache.RapidProCache('sqlite://')
+        earlier = temba_client.utils.parse_iso8601('2016-01-01T10:00:00.000Z')
+        later = temba_client.utils.parse_iso8601('2016-01-01T12:00:00.000Z')
+        for selector in rapidpropull.cli.ArgumentProcessor.ENDPOINT_SELECTORS:
+            assert cache.get_high_water_mark(selector, 'rapidpro.io') is None
+            cache.update_high_water_mark(selector, 'rapidpro.io', earlier)
+            assert cache.get_high_water_mark(selector, 'rapidpro.io') == \
+                earlier
+            cache.update_high_water_mark(selector, 'rapidpro.io', later)
+            cache.update_high_water_mark(selector, 'rapidpro.io', earlier)
+            assert cache.get_high_water_mark(selector, 'rapidpro.io') == later
+            assert cache.get_high_water_mark(selector, 'other.io') is None
+        invalid_selector = '--unsupported-selector'
+        with pytest.raises(ValueError) as excinfo:
+            cache.get_high_water_mark(invalid_selector, 'rapidpro.io')
+        excinfo.match(cache.INVALID_ENDPOINT_SELECTOR.format(invalid_selector))
+
+    def test_checkpoints(self):
+        cache = rapidpropull.cache.RapidProCache('sqlite://')
+        for selector in rapidpropull.cli.ArgumentProcessor.ENDPOINT_SELECTORS:
+            assert cache.get_checkpoint(selector, 'rapidpro.io', 'q1') is None
+            cache.save_checkpoint(selector, 'rapidpro.io', 'q1', 2)
+            cache.save_checkpoint(selector, 'rapidpro.io', 'q2', 7,
+                                  '2016-01-01T00:00:00.000000Z')
+            assert cache.get_checkpoint(selector, 'rapidpro.io', 'q1') == \
+                (2, None)
+            cache.save_checkpoint(selector, 'rapidpro.io', 'q1', 3)
+            assert cache.get_checkpoint(selector, 'rapidpro.io', 'q1') == \
+                (3, None)
+            assert cache.get_checkpoint(selector, 'other.io', 'q1') is None
+            cache.save_checkpoint(selector, 'rapidpro.io', 'q1', None)
+            assert cache.get_checkpoint(selector, 'rapidpro.io', 'q1') is None
+            assert cache.get_checkpoint(selector, 'rapidpro.io', 'q2') == \
+                (7, '2016-01-01T00:00:00.000000Z')
+
+    def test_insert_objects_with_checkpoint_in_one_transaction(self):
+        cache = rapidpropull.cache.RapidProCache('sqlite://')
+        run0 = self.make_flow_run()
+        checkpoint = {'endpoint_selector': '--flow-runs',
+                      'server': 'rapidpro.io', 'query': 'q', 'next_page': 2}
+        with pytest.raises(TypeError):
+            cache.insert_objects([run0, object()], checkpoint=checkpoint)
+        assert cache.get_flow_run(run0.id) is None
+        assert cache.get_checkpoint('--flow-runs', 'rapidpro.io', 'q') is None
+        cache.insert_objects([run0], checkpoint=checkpoint)
+        assert cache.get_flow_run(run0.id) is not None
+        assert cache.get_checkpoint('--flow-runs', 'rapidpro.io', 'q') == \
+            (2, None)
+
+    def test_substitute_cached_for_downloaded_in_chunks(self):
+        cache = rapidpropull.cache.RapidProCache('sqlite://',
+                                                 lookup_chunk_size=2)
+        runs = [self.make_flow_run(run=i) for i in range(5)]
+        contacts = [self.make_contact() for _ in range(2)]
+        cached = [copy.copy(runs[i]) for i in (0, 3, 4)] + [
+            copy.copy(contacts[1])]
+        for o in cached:
+            o.completed = True
+            self._insert_into_cache(cache, o)
+        statements = []
+        sqlalchemy.event.listen(
+            cache.database.bind, 'before_cursor_execute',
+            lambda conn, cursor, statement, *args: statements.append(
+                statement))
+        # the same object may appear more than once
+        downloaded = runs + contacts + [runs[4]]
+        cache.substitute_cached_for_downloaded(downloaded)
+        # 3 chunks of run IDs and 1 chunk of contact UUIDs
+        assert len(statements) == 4
+        expected = [cached[0], runs[1], runs[2], cached[1], cached[2],
+                    contacts[0], cached[3], cached[2]]
+        assert [o.serialize() for o in downloaded] == \
+            [o.serialize() for o in expected]
+        assert cache.statistics == {'flowrun cache hits': 3,
+                                    'flowrun cache misses': 2,
+                                    'contact cache hits': 1,
+                                    'contact cache misses': 1}
+
+    def test_get_objects_in_chunks(self, tmpdir):
+        cache_url = 'sqlite:///' + str(tmpdir.join('cache.db'))
+        contacts = [self.make_contact() for _ in range(7)]
+        self._insert_into_cache(rapidpropull.cache.RapidProCache(cache_url),
+                                contacts[:5])
+        uuids = set(c.uuid for c in contacts)
+        for workers in (1, 3):
+            cache = rapidpropull.cache.RapidProCache(
+                cache_url, lookup_chunk_size=2, lookup_workers=workers)
+            statements = []
+            sqlalchemy.event.listen(
+                cache.database.bind, 'before_cursor_execute',
+                lambda conn, cursor, statement, *args: statements.append(
+                    statement))
+            objects, missing_uuids = cache.get_objects('--contacts', uuids)
+            assert len(statements) == 4
+            assert missing_uuids == set(c.uuid for c in contacts[5:])
+            assert_that([o.serialize() for o in objects], contains_inanyorder(
+                *[c.serialize() for c in contacts[:5]]))
+            assert cache.statistics == {'contact cache hits': 5,
+                                        'contact cache misses': 2}
+
+    def test_lookups_counted_on_concurrent_threads(self, tmpdir):
+        cache = rapidpropull.cache.RapidProCache(
+            'sqlite:///{}'.format(tmpdir.join('cache.db')), memory_entries=0)
+        flow = self.make_flow()
+        cache.insert_objects([flow])
+
+        def look_up():
+            for _ in range(50):
+                cache.get_objects('--flows', {flow.uuid, 'missing'})
+
+        threads = [threading.Thread(target=look_up) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert cache.get_statistics()['flow cache hits'] == 200
+        assert cache.get_statistics()['flow cache misses'] == 200
+
+    def test_get_objects_in_memory_database_not_looked_up_concurrently(self):
+        cache = rapidpropull.cache.RapidProCache(
+            'sqlite://', lookup_chunk_size=1, lookup_workers=4)
+        flows = [self.make_flow() for _ in range(3)]
+        self._insert_into_cache(cache, flows)
+        with mock.patch('rapidpropull.cache.ThreadPool') as thread_pool:
+            objects, missing_uuids = cache.get_objects(
+                '--flows', set(f.uuid for f in flows))
+        assert not thread_pool.called
+        assert not missing_uuids
+        assert len(objects) == 3
+
+    def test_objects_remembered_in_memory(self):
+        cache = rapidpropull.cache.RapidProCache('sqlite://')
+        flow = self.make_flow()
+        contact = self.make_contact()
+        self._insert_into_cache(cache, flow)
+        statements = []
+        sqlalchemy.event.listen(
+            cache.database.bind, 'before_cursor_execute',
+            lambda conn, cursor, statement, *args: statements.append(
+                statement))
+        for _ in range(3):
+            assert cache.get_flow(flow.uuid).serialize() == flow.serialize()
+        # only the first lookup goes to the database
+        assert len(statements) == 1
+        cache.insert_objects([contact, copy.copy(flow)])
+        del statements[:]
+        assert cache.get_contact(contact.uuid).serialize() == \
+            contact.serialize()
+        objects, missing_uuids = cache.get_objects('--flows', {flow.uuid})
+        assert [o.serialize() for o in objects] == [flow.serialize()]
+        assert not missing_uuids
+        assert statements == []
+        assert cache.get_statistics() == {
+            'flow cache hits': 1, 'flow cache misses': 0,
+            'memory cache hits': 4, 'memory cache misses': 1,
+            'memory cache hit rate': '80.0%'}
+
+    def test_objects_not_remembered_if_memory_disabled(self):
+        cache = rapidpropull.cache.RapidProCache('sqlite://',
+                                                 memory_entries=0)
+        contact = self.make_contact()
+        cache.insert_objects([contact])
+        assert len(cache.memory) == 0
+        assert cache.get_contact(contact.uuid).serialize() == \
+            contact.serialize()
+        assert cache.statistics['contact cache hits'] == 1
+
+    def test_passthrough(self):
+        cache = rapidpropull.cache.RapidProCache('sqlite://', passthrough=True)
+        flow = self.make_flow()
+        contact = self.make_contact()
+        run = self.make_flow_run(flow_uuid=flow.uuid, contact=contact.uuid)
+        self._insert_into_cache(cache, [flow, contact, run])
+        downloaded = [copy.copy(run), self.make_flow_run()]
+        with mock.patch('temba_client.v1.types.TembaObject.deserialize') as \
+                deserialize:
+            cache.substitute_cached_for_downloaded(downloaded)
+            objects, _ = cache.get_objects('--contacts', {contact.uuid})
+            cached_flow = cache.get_flow(flow.uuid)
+            # cached objects are inserted as they are (i.e. skipped)
+            cache.insert_objects(downloaded + objects)
+        assert not deserialize.called
+        cached_run = downloaded[0]
+        assert isinstance(cached_run, rapidpropull.codec.CachedJSON)
+        assert cached_run.type is temba_client.v1.types.Run
+        assert (cached_run.id, cached_run.flow, cached_run.contact) == \
+            (run.id, flow.uuid, contact.uuid)
+        assert json.loads(cached_run.to_json()) == run.serialize()
+        assert objects[0].uuid == contact.uuid
+        assert objects[0].serialize() == contact.serialize()
+        assert cached_flow.to_json() == json.dumps(flow.serialize())
+        assert len(cache.memory) == 4
+
+    def test_cached_json_deserialize(self):
+        contact = self.make_contact()
+        cached = rapidpropull.codec.CachedJSON(
+            temba_client.v1.types.Contact, json.dumps(contact.serialize()),
+            uuid=contact.uuid)
+        assert isinstance(cached.deserialize(), temba_client.v1.types.Contact)
+        assert cached.deserialize().serialize() == contact.serialize()
+
     def test_substitute_cached_for_downloaded_unsupported_type(self):
         cache_url = 'sqlite://'
         cache = rapidpropull.cache.RapidProCache(cache_url)
@@ -1090,7 +2395,568 @@ class TestRapidProCache(Auxiliary):
         excinfo.match(cache.INVALID_TYPE.format(type(unsupported_object)))
 
 
+class TestLRUCache(object):
+    def test_get_and_put(self):
+        lru = rapidpropull.cache.LRUCache()
+        assert lru.get('a') is None
+        assert lru.get('a', 'default') == 'default'
+        lru.put('a', 1)
+        lru.put('a', 2)
+        assert lru.get('a') == 2
+        assert len(lru) == 1
+        assert lru.get_statistics() == {
+            'memory cache hits': 1, 'memory cache misses': 2,
+            'memory cache hit rate': '33.3%'}
+
+    def test_least_recently_used_entries_discarded(self):
+        lru = rapidpropull.cache.LRUCache(max_entries=2)
+        lru.put('a', 1)
+        lru.put('b', 2)
+        lru.get('a')
+        lru.put('c', 3)
+        assert lru.get('b') is None
+        assert lru.get('a') == 1
+        assert lru.get('c') == 3
+
+    def test_entries_discarded_by_size(self):
+        lru = rapidpropull.cache.LRUCache(max_bytes=10)
+        lru.put('a', 1, size=4)
+        lru.put('b', 2, size=4)
+        lru.put('c', 3, size=4)
+        assert lru.get('a') is None
+        assert len(lru) == 2
+        lru.put('b', 2, size=1)
+        lru.put('d', 4, size=5)
+        assert len(lru) == 3
+        lru.put('e', 5, size=11)
+        assert len(lru) == 0
+
+
+class TestJSONWriter(Auxiliary):
+    def test_write_list(self):
+        stream = mock.MagicMock()
+        written = []
+        stream.write.side_effect = written.append
+        runs = [self.make_flow_run(run=i) for i in range(3)]
+        writer = rapidpropull.output.JSONWriter(stream)
+        writer.write_page(runs[:2])
+        # objects are written (and flushed) as soon as a page arrives
+        assert stream.flush.call_count == 1
+        assert json.loads(''.join(written) + ']') == \
+            [r.serialize() for r in runs[:2]]
+        writer.write_page([])
+        writer.write_page(runs[2:])
+        writer.finish()
+        assert ''.join(written).endswith('\n')
+        assert json.loads(''.join(written)) == [r.serialize() for r in runs]
+
+    def test_write_empty_list(self):
+        stream = mock.MagicMock()
+        written = []
+        stream.write.side_effect = written.append
+        rapidpropull.output.JSONWriter(stream).finish()
+        assert ''.join(written) == '[]\n'
+
+    def test_write_associations(self):
+        stream = mock.MagicMock()
+        written = []
+        stream.write.side_effect = written.append
+        flows = [self.make_flow() for _ in range(3)]
+        contacts = [self.make_contact()]
+        runs = [self.make_flow_run(run=i) for i in range(2)]
+        writer = rapidpropull.output.JSONWriter(stream,
+                                                ('--contacts', '--flows'))
+        writer.write_page({'runs': runs[:1], 'flows': flows[:2],
+                           'contacts': contacts})
+        writer.write_page({'runs': runs[1:], 'flows': flows[2:],
+                           'contacts': []})
+        # associated objects are only written when the document is finished
+        assert flows[0].uuid not in ''.join(written)
+        writer.finish()
+        assert json.loads(''.join(written)) == {
+            'runs': [r.serialize() for r in runs],
+            'flows': [f.serialize() for f in flows],
+            'contacts': [c.serialize() for c in contacts]}
+
+
+class TestNDJSONWriter(Auxiliary):
+    def test_write_lines(self):
+        stream = mock.MagicMock()
+        written = []
+        stream.write.side_effect = written.append
+        runs = [self.make_flow_run(run=i) for i in range(3)]
+        writer = rapidpropull.output.NDJSONWriter(stream)
+        writer.write_page(runs[:2])
+        assert stream.flush.call_count == 1
+        writer.write_page(runs[2:])
+        writer.finish()
+        lines = ''.join(written).splitlines()
+        assert [json.loads(l) for l in lines] == [r.serialize() for r in runs]
+
+    def test_write_tagged_lines(self):
+        stream = mock.MagicMock()
+        written = []
+        stream.write.side_effect = written.append
+        flow = self.make_flow()
+        contact = self.make_contact()
+        run = self.make_flow_run()
+        writer = rapidpropull.output.NDJSONWriter(stream,
+                                                  ('--contacts', '--flows'))
+        writer.write_page({'runs': [run], 'flows': [flow],
+                           'contacts': [contact]})
+        writer.finish()
+        lines = ''.join(written).splitlines()
+        assert [json.loads(l) for l in lines] == [
+            {'type': 'run', 'object': run.serialize()},
+            {'type': 'contact', 'object': contact.serialize()},
+            {'type': 'flow', 'object': flow.serialize()}]
+
+
+class TestOutputFile(object):
+    @staticmethod
+    def _read(path):
+        opener = rapidpropull.output.get_opener(path)
+        f = opener(path, 'rb')
+        try:
+            return f.read().decode('utf-8')
+        finally:
+            f.close()
+
+    def test_compression_chosen_by_extension(self, tmpdir):
+        extensions = ['', '.gz', '.bz2']
+        try:
+            rapidpropull.output.get_opener('out.json.xz')
+            extensions.append('.xz')
+        except ValueError:
+            pass
+        for extension in extensions:
+            path = str(tmpdir.join('out.json' + extension))
+            output = rapidpropull.output.OutputFile(path)
+            output.write('[1, ')
+            output.write('2]\n')
+            output.close()
+            assert output.paths == [path]
+            assert self._read(path) == '[1, 2]\n'
+        with open(str(tmpdir.join('out.json.gz')), 'rb') as f:
+            assert f.read(2) == b'\x1f\x8b'
+
+    def test_rotation(self, tmpdir):
+        path = str(tmpdir.join('runs.ndjson.gz'))
+        output = rapidpropull.output.OutputFile(path, rotate_size=10)
+        for i in range(5):
+            output.write('{"i": %d}\n' % i)  # 9 bytes each
+        output.close()
+        assert output.paths == [str(tmpdir.join(name)) for name in (
+            'runs-0001.ndjson.gz', 'runs-0002.ndjson.gz',
+            'runs-0003.ndjson.gz')]
+        assert [self._read(p) for p in output.paths] == [
+            '{"i": 0}\n{"i": 1}\n', '{"i": 2}\n{"i": 3}\n', '{"i": 4}\n']
+
+
+class TestCodec(Auxiliary):
+    def teardown_method(self, method):
+        rapidpropull.codec.set_backend()
+
+    def test_set_backend(self):
+        rapidpropull.codec.set_backend('json')
+        assert rapidpropull.codec.backend == 'json'
+        assert rapidpropull.codec.loads(
+            rapidpropull.codec.dumps({'a': [1, 'b']})) == {'a': [1, 'b']}
+        rapidpropull.codec.set_backend('auto')
+        assert rapidpropull.codec.backend == \
+            list(rapidpropull.codec.BACKENDS)[0]
+        with pytest.raises(ValueError) as excinfo:
+            rapidpropull.codec.set_backend('unknown')
+        assert excinfo.match('JSON backend "unknown" is not available.')
+
+    def test_cached_json_from_object(self):
+        run, flow = self.make_flow_run(), self.make_flow()
+        record = rapidpropull.codec.CachedJSON.from_object(run)
+        assert (record.type, record.id, record.flow, record.contact) == \
+            (temba_client.v1.types.Run, run.id, run.flow, run.contact)
+        assert record.serialize() == run.serialize()
+        assert record.deserialize().serialize() == run.serialize()
+        assert rapidpropull.codec.CachedJSON.from_object(record) is record
+        record = rapidpropull.codec.CachedJSON.from_object(flow)
+        assert (record.type, record.uuid) == \
+            (temba_client.v1.types.Flow, flow.uuid)
+        assert not hasattr(record, '__dict__')
+        with pytest.raises(AttributeError):
+            record.flow
+
+    def test_lazy_object(self):
+        value_set = {u'node': u'node1', u'category': {u'base': u'Yes'},
+                     u'text': u'y', u'rule_value': u'y', u'label': u'Answer',
+                     u'value': u'y', u'time': None}
+        run = self.make_flow_run(values=[value_set])
+        lazy = rapidpropull.codec.LazyRun(
+            json.dumps(run.serialize()), id=run.id, flow=run.flow,
+            contact=run.contact)
+        assert isinstance(lazy, temba_client.v1.types.Run)
+        with mock.patch.object(rapidpropull.codec.LazyRun.TYPE, 'deserialize',
+                               wraps=rapidpropull.codec.LazyRun.TYPE
+                               .deserialize) as deserialize:
+            assert (lazy.id, lazy.flow, lazy.contact) == \
+                (run.id, run.flow, run.contact)
+            assert lazy.serialize() == run.serialize()
+            assert rapidpropull.output.to_json(lazy) == \
+                json.dumps(run.serialize())
+            assert rapidpropull.codec.CachedJSON.from_object(lazy).json == \
+                json.dumps(run.serialize())
+            assert not lazy.is_decoded() and not deserialize.called
+            assert lazy.values[0].label == u'Answer'
+            assert lazy.is_decoded() and deserialize.call_count == 1
+        lazy.completed = True
+        assert lazy.serialize() == dict(run.serialize(), completed=True)
+        assert json.loads(rapidpropull.output.to_json(lazy)) == \
+            lazy.serialize()
+        flow = self.make_flow()
+        lazy = rapidpropull.codec.LazyFlow(json.dumps(flow.serialize()),
+                                           uuid=flow.uuid)
+        assert lazy.name == flow.name
+        assert lazy.serialize() == flow.serialize()
+
+    def test_backend_used_by_cache_and_output(self):
+        dumps = mock.MagicMock(side_effect=json.dumps)
+        loads = mock.MagicMock(side_effect=json.loads)
+        with mock.patch.dict(rapidpropull.codec.BACKENDS,
+                             {'fake': (dumps, loads)}):
+            rapidpropull.codec.set_backend('fake')
+            cache = rapidpropull.cache.RapidProCache('sqlite://')
+            contact = self.make_contact()
+            cache.insert_objects([contact])
+            assert dumps.call_count == 1
+            # a copy remembered in memory is only decoded on first access
+            cached = cache.get_contact(contact.uuid)
+            assert loads.call_count == 0
+            assert cached.name == contact.name
+            assert loads.call_count == 1
+            assert rapidpropull.output.to_json(contact) == \
+                json.dumps(contact.serialize())
+            assert dumps.call_count == 2
+
+
+class TestInterner(Auxiliary):
+    def test_intern(self):
+        interner = rapidpropull.interning.Interner()
+        first, second = u''.join(['a', 'b']), u''.join(['a', 'b'])
+        assert interner.intern(first) is first
+        assert interner.intern(second) is first
+        assert interner.intern(None) is None
+        assert interner.intern(1) == 1
+        assert len(interner) == 1
+
+    def test_intern_objects(self):
+        step = {u'node': u''.join(['node', '1']), u'type': u'A',
+                u'text': None, u'value': None, u'arrived_on': None,
+                u'left_on': None}
+        runs = [self.make_flow_run(flow_uuid=u''.join(['flow', '1']),
+                                   steps=[dict(step)]) for _ in range(2)]
+        flow = self.make_flow()
+        name = flow.name
+        interner = rapidpropull.interning.Interner()
+        interner.intern_objects(runs + [flow])
+        assert runs[0].flow is runs[1].flow
+        assert runs[0].steps[0].node is runs[1].steps[0].node
+        assert [r.serialize()['flow_uuid'] for r in runs] == ['flow1'] * 2
+        assert flow.name is name
+        assert interner.intern(u'flow1') is runs[0].flow
+
+
+class _KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = b'{"results": []}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestPooledSession(object):
+    @pytest.fixture
+    def server_url(self):
+        server = HTTPServer(('127.0.0.1', 0), _KeepAliveHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        yield 'http://127.0.0.1:{}/'.format(server.server_address[1])
+        server.shutdown()
+        server.server_close()
+
+    def test_connections_reused(self, server_url):
+        session = rapidpropull.session.PooledSession()
+        for _ in range(3):
+            session.get(server_url).raise_for_status()
+        session.close()
+        assert_that(session.get_statistics(), has_entries({
+            'http requests': 3, 'http connections opened': 1,
+            'http connections reused': 2}))
+
+    def test_connections_not_kept_alive(self, server_url):
+        session = rapidpropull.session.PooledSession(keep_alive=False,
+                                                     gzip=False)
+        assert session.headers['Accept-Encoding'] == 'identity'
+        for _ in range(2):
+            session.get(server_url).raise_for_status()
+        session.close()
+        assert_that(session.get_statistics(), has_entries({
+            'http requests': 2, 'http connections opened': 2,
+            'http connections reused': 0}))
+
+    def test_requests_throttled(self, server_url):
+        session = rapidpropull.session.PooledSession(max_retries=0)
+        with mock.patch.object(session.throttle, 'call') as call:
+            call.return_value.status_code = 200
+            assert session.get(server_url) is call.return_value
+        session.close()
+
+    def test_install(self):
+        session = mock.MagicMock()
+        rapidpropull.session.install(session)
+        try:
+            temba_client.clients.request('post', 'url', data={'a': 1})
+            session.request.assert_called_once_with('post', 'url',
+                                                    data='{"a": 1}')
+        finally:
+            rapidpropull.session.install(None)
+        assert temba_client.clients.request is temba_client.utils.request
+
+
+    def test_installed(self):
+        first, second = mock.MagicMock(), mock.MagicMock()
+        with rapidpropull.session.installed(first):
+            with rapidpropull.session.installed(second):
+                temba_client.clients.request('get', 'url')
+            temba_client.clients.request('get', 'url')
+        assert temba_client.clients.request is temba_client.utils.request
+        second.request.assert_called_once_with('get', 'url')
+        first.request.assert_called_once_with('get', 'url')
+
+class TestThrottle(object):
+    @staticmethod
+    def make_response(status_code, retry_after=None):
+        response = mock.MagicMock(status_code=status_code, headers={})
+        if retry_after is not None:
+            response.headers['Retry-After'] = retry_after
+        return response
+
+    def make_throttle(self, **kwargs):
+        throttle = rapidpropull.throttle.Throttle(**kwargs)
+        throttle.BACKOFF_BASE = 0
+        return throttle
+
+    def test_retries_failed_requests(self):
+        throttle = self.make_throttle(max_concurrency=4)
+        responses = [self.make_response(503), self.make_response(429, '0'),
+                     self.make_response(200)]
+        send = mock.MagicMock(side_effect=[
+            requests.exceptions.ConnectionError()] + responses)
+        assert throttle.call(send) is responses[-1]
+        assert send.call_count == 4
+        assert throttle.get_statistics() == {
+            'http requests retried': 3, 'http requests rate limited': 1,
+            'http concurrency limit': 2}
+
+    def test_gives_up_after_max_retries(self):
+        throttle = self.make_throttle(max_retries=2)
+        response = self.make_response(429)
+        send = mock.MagicMock(return_value=response)
+        assert throttle.call(send) is response
+        assert send.call_count == 3
+        send = mock.MagicMock(
+            side_effect=requests.exceptions.ConnectionError())
+        with pytest.raises(requests.exceptions.ConnectionError):
+            throttle.call(send)
+        assert send.call_count == 3
+        send = mock.MagicMock(return_value=self.make_response(404))
+        throttle.call(send)
+        assert send.call_count == 1
+
+    def test_backoff_is_jittered_and_exponential(self):
+        throttle = rapidpropull.throttle.Throttle(max_retries=3)
+        send = mock.MagicMock(return_value=self.make_response(502))
+        with mock.patch('time.sleep') as sleep, \
+                mock.patch('random.uniform', return_value=0.1) as uniform:
+            throttle.call(send)
+        assert uniform.call_args_list == [
+            mock.call(0, 0.5), mock.call(0, 1.0), mock.call(0, 2.0)]
+        assert sleep.call_args_list == [mock.call(0.1)] * 3
+
+    def test_concurrency_decreased_and_increased(self):
+        throttle = self.make_throttle(max_concurrency=8)
+        throttle.call(mock.MagicMock(side_effect=[
+            self.make_response(429, '0'), self.make_response(429, '0'),
+            self.make_response(200)]))
+        assert throttle.get_statistics()['http concurrency limit'] == 2
+        for _ in range(3):
+            throttle.call(mock.MagicMock(
+                return_value=self.make_response(200)))
+        assert throttle.get_statistics()['http concurrency limit'] == 3
+        for _ in range(100):
+            throttle.call(mock.MagicMock(
+                return_value=self.make_response(200)))
+        assert throttle.get_statistics()['http concurrency limit'] == 8
+
+    def test_concurrent_requests_limited(self):
+        throttle = self.make_throttle(max_concurrency=2)
+        lock = threading.Lock()
+        in_flight = [0, 0]  # current, maximum
+
+        def send():
+            with lock:
+                in_flight[0] += 1
+                in_flight[1] = max(in_flight)
+            time.sleep(0.01)
+            with lock:
+                in_flight[0] -= 1
+            return self.make_response(200)
+
+        threads = [threading.Thread(target=throttle.call, args=(send,))
+                   for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert in_flight[1] == 2
+
+    def test_retry_after_honoured(self):
+        throttle = self.make_throttle()
+        send = mock.MagicMock(side_effect=[self.make_response(429, '0.2'),
+                                           self.make_response(200)])
+        start = time.time()
+        throttle.call(send)
+        assert time.time() - start >= 0.2
+
+    def test_max_rate(self):
+        throttle = self.make_throttle(max_rate=50)
+        send = mock.MagicMock(return_value=self.make_response(200))
+        start = time.time()
+        for _ in range(60):
+            throttle.call(send)
+        assert time.time() - start >= 0.18
+
+
+class TestPipeline(object):
+    @staticmethod
+    def make_pipeline(source, queue_size=1, workers=1):
+        def slow_square(x):
+            # later items are processed faster (i.e. may overtake earlier ones)
+            time.sleep(0.001 * (20 - x % 20))
+            return x * x
+        return rapidpropull.pipeline.Pipeline(source, [
+            rapidpropull.pipeline.Stage('add', lambda x: x + 1),
+            rapidpropull.pipeline.Stage('square', slow_square, workers)],
+            queue_size=queue_size)
+
+    def test_items_processed_in_order(self):
+        for queue_size, workers in ((0, 1), (1, 1), (2, 4)):
+            pipeline = self.make_pipeline(range(50), queue_size, workers)
+            assert list(pipeline) == [(x + 1) ** 2 for x in range(50)]
+            statistics = pipeline.get_statistics()
+            for stage in ('source', 'add', 'square'):
+                assert statistics['{} stage items'.format(stage)] == 50
+                assert statistics[
+                    '{} stage max queue depth'.format(stage)] <= queue_size
+            assert statistics['square stage items per second'] > 0
+        assert list(self.make_pipeline([])) == []
+
+    def test_backpressure(self):
+        consumed = []
+
+        def source():
+            for x in range(100):
+                consumed.append(x)
+                yield x
+
+        items = iter(self.make_pipeline(source(), queue_size=2))
+        assert next(items) == 1
+        time.sleep(0.2)
+        # 2 items in each of 3 queues and 1 item held by each stage
+        assert len(consumed) <= 1 + 3 * 2 + 2 + 1
+        assert list(items) == [(x + 1) ** 2 for x in range(1, 100)]
+
+    def test_exceptions_reraised_in_order(self):
+        processed = []
+
+        def source():
+            for x in range(3):
+                yield x
+            raise ValueError('source')
+
+        def fail_on_two(x):
+            if x == 2:
+                raise ValueError('stage')
+            processed.append(x)
+            return x
+
+        for queue_size in (0, 1):
+            items = iter(rapidpropull.pipeline.Pipeline(
+                source(), [rapidpropull.pipeline.Stage('s', lambda x: x)],
+                queue_size=queue_size))
+            assert [next(items) for _ in range(3)] == [0, 1, 2]
+            with pytest.raises(ValueError) as excinfo:
+                next(items)
+            assert excinfo.match('source')
+            del processed[:]
+            items = iter(rapidpropull.pipeline.Pipeline(
+                range(10), [rapidpropull.pipeline.Stage('s', fail_on_two)],
+                queue_size=queue_size))
+            assert [next(items) for _ in range(2)] == [0, 1]
+            with pytest.raises(ValueError) as excinfo:
+                next(items)
+            assert excinfo.match('stage')
+            time.sleep(0.05)
+            assert processed == [0, 1]
+
+
+    def test_threads_stopped(self):
+        closed = []
+
+        def source():
+            try:
+                for x in range(100):
+                    yield x
+            finally:
+                closed.append(True)
+
+        def fail(x):
+            raise ValueError('stage')
+
+        threads = threading.active_count()
+        for workers in (1, 3):
+            del closed[:]
+            items = iter(self.make_pipeline(source(), 1, workers))
+            assert next(items) == 1
+            time.sleep(0.05)  # let the queues fill up
+            items.close()  # abandoned before the end
+            assert closed == [True]
+            assert threading.active_count() == threads
+        items = iter(rapidpropull.pipeline.Pipeline(
+            source(), [rapidpropull.pipeline.Stage('s', fail)]))
+        with pytest.raises(ValueError):
+            next(items)
+        assert threading.active_count() == threads
+
 class TestMain(Auxiliary):
+    def test_sqlalchemy_imported_only_if_cache_used(self):
+        script = (
+            'import sys, rapidpropull.cli, rapidpropull.download\n'
+            'for argv in ([], ["--cache=sqlite://"]):\n'
+            '    rapidpropull.download.DownloadTask(\n'
+            '        rapidpropull.cli.ArgumentProcessor(\n'
+            '            ["--flows", "--api-token=token"] + argv))\n'
+            '    print("sqlalchemy" in sys.modules)\n')
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.check_output([sys.executable, '-c', script],
+                                         cwd=root)
+        assert output.split() == [b'False', b'True']
+
     # noinspection PyBroadException,PyUnusedLocal
     @mock.patch('rapidpropull.download.DownloadTask')
     @mock.patch('rapidpropull.cli.ArgumentProcessor')
@@ -1126,6 +2992,172 @@ class TestMain(Auxiliary):
                 result = json.loads(captured_out.stdout)
             assert_that(result, equal_to(expected_json))
 
+    @mock.patch('temba_client.v1.TembaClient')
+    def test_print_out_compact_download_as_json(self, temba_client_class):
+        runs = [self.make_flow_run(run=i) for i in range(3)]
+        temba_client_class.return_value.get_runs.return_value = runs
+        temba_client_class.return_value.pager.return_value.has_more.\
+            return_value = False
+        for format_option in ('--format=json', '--format=ndjson'):
+            outputs = []
+            for argv in ([], ['--compact']):
+                with iocapture.capture() as captured_out:
+                    with mock.patch('rapidpropull.codec.CachedJSON.'
+                                    'deserialize') as deserialize:
+                        rapidpropull.cli.main(
+                            ['--flow-runs', '--api-token', 'a-token',
+                             format_option] + argv)
+                    outputs.append(captured_out.stdout)
+                # printed without converting records back to objects
+                assert not deserialize.called
+            assert outputs[0] == outputs[1]
+
+    @mock.patch('temba_client.v1.TembaClient')
+    def test_print_out_parallel_download_as_json(self, temba_client_class):
+        expected_download = [self.make_flow_run(run=i) for i in range(2)]
+        temba_client_class.return_value.get_runs.return_value = \
+            expected_download
+        argv = ['--flow-runs', '--api-token', 'a-token', '--parallel=3',
+                '--after=2016-01-01T00:00:00.000000Z',
+                '--before=2016-01-01T00:00:03.000000Z']
+        with iocapture.capture() as captured_out:
+            rapidpropull.cli.main(argv)
+            result = json.loads(captured_out.stdout)
+        # the same objects returned for all sub-windows are printed once
+        assert result == [r.serialize() for r in expected_download]
+        assert temba_client_class.return_value.get_runs.call_count == 3
+
+    @mock.patch('temba_client.v1.TembaClient')
+    def test_print_out_pages_as_json(self, temba_client_class):
+        selectors = ['--flow-runs', '--flows', '--contacts']
+        token = 'a-valid-rapidpro-token'
+        expected_download = [self.make_serializable(i) for i in range(3)]
+        expected_json = [s.serialize() for s in expected_download]
+        client = temba_client_class.return_value
+        for endpoint_selector in selectors:
+            for endpoint in (client.get_runs, client.get_flows,
+                             client.get_contacts):
+                endpoint.side_effect = [expected_download[:2],
+                                        expected_download[2:]]
+            client.pager.return_value.has_more.side_effect = [True, False]
+            with iocapture.capture() as captured_out:
+                rapidpropull.cli.main([endpoint_selector, '--api-token', token,
+                                       '--stream'])
+                result = json.loads(captured_out.stdout)
+            assert_that(result, equal_to(expected_json))
+
+    @mock.patch('temba_client.v1.TembaClient')
+    def test_print_out_pages_with_associations_as_json(self,
+                                                       temba_client_class):
+        flows = [self.make_flow() for _ in range(2)]
+        contacts = [self.make_contact() for _ in range(2)]
+        runs = [self.make_flow_run(run=i, flow_uuid=flows[i % 2].uuid,
+                                   contact=contacts[i // 2].uuid)
+                for i in range(4)]
+        client = temba_client_class.return_value
+        client.get_runs.side_effect = [runs[:2], runs[2:]]
+        client.pager.return_value.has_more.side_effect = [True, False]
+        client.get_flows.side_effect = lambda uuids: [
+            f for f in flows if f.uuid in uuids]
+        client.get_contacts.side_effect = lambda uuids: [
+            c for c in contacts if c.uuid in uuids]
+        argv = ['--flow-runs', '--api-token', 'a-token', '--with-flows',
+                '--with-contacts', '--stream']
+        with iocapture.capture() as captured_out:
+            rapidpropull.cli.main(argv)
+            result = json.loads(captured_out.stdout)
+        assert result == {'runs': [r.serialize() for r in runs],
+                          'flows': [f.serialize() for f in flows],
+                          'contacts': [c.serialize() for c in contacts]}
+
+    @mock.patch('temba_client.v1.TembaClient')
+    def test_print_out_cached_objects_passed_through(self, temba_client_class):
+        flows = [self.make_flow() for _ in range(2)]
+        runs = [self.make_flow_run(run=i, flow_uuid=flows[i % 2].uuid)
+                for i in range(3)]
+        cache = rapidpropull.cache.RapidProCache('sqlite://', passthrough=True)
+        cache.insert_objects([runs[0], flows[0]])
+        client = temba_client_class.return_value
+        client.get_runs.return_value = runs
+        client.get_flows.side_effect = lambda uuids: [
+            f for f in flows if f.uuid in uuids]
+        expected = {'runs': [r.serialize() for r in runs],
+                    'flows': [f.serialize() for f in flows]}
+        for streaming in ([], ['--stream']):
+            argv = ['--flow-runs', '--api-token', 'a-token', '--with-flows',
+                    '--cache=sqlite://', '--passthrough'] + streaming
+            client.pager.return_value.has_more.return_value = False
+            with mock.patch('rapidpropull.cache.RapidProCache',
+                            return_value=cache):
+                with iocapture.capture() as captured_out:
+                    rapidpropull.cli.main(argv)
+                    result = json.loads(captured_out.stdout)
+            assert_that(result['runs'], contains_inanyorder(*expected['runs']))
+            assert_that(result['flows'],
+                        contains_inanyorder(*expected['flows']))
+
+    @mock.patch('temba_client.v1.TembaClient')
+    def test_print_out_ndjson(self, temba_client_class):
+        flows = [self.make_flow() for _ in range(2)]
+        runs = [self.make_flow_run(run=i, flow_uuid=flows[i % 2].uuid)
+                for i in range(4)]
+        client = temba_client_class.return_value
+        client.get_runs.side_effect = lambda **kwargs: runs
+        client.get_flows.side_effect = lambda uuids: [
+            f for f in flows if f.uuid in uuids]
+        argv = ['--flow-runs', '--api-token', 'a-token', '--format=ndjson']
+        with iocapture.capture() as captured_out:
+            rapidpropull.cli.main(argv)
+            lines = captured_out.stdout.splitlines()
+        assert [json.loads(l) for l in lines] == [r.serialize() for r in runs]
+        with iocapture.capture() as captured_out:
+            rapidpropull.cli.main(argv + ['--with-flows'])
+            lines = captured_out.stdout.splitlines()
+        assert [json.loads(l) for l in lines] == \
+            [{'type': 'run', 'object': r.serialize()} for r in runs] + \
+            [{'type': 'flow', 'object': f.serialize()} for f in flows]
+
+    @mock.patch('temba_client.v1.TembaClient')
+    def test_write_output_to_compressed_file(self, temba_client_class,
+                                             tmpdir):
+        runs = [self.make_flow_run(run=i) for i in range(3)]
+        temba_client_class.return_value.get_runs.return_value = runs
+        path = str(tmpdir.join('runs.json.bz2'))
+        with iocapture.capture() as captured_out:
+            rapidpropull.cli.main(['--flow-runs', '--api-token', 'a-token',
+                                   '--output', path])
+            assert captured_out.stdout == ''
+        f = rapidpropull.output.get_opener(path)(path, 'rb')
+        try:
+            assert json.loads(f.read().decode('utf-8')) == \
+                [r.serialize() for r in runs]
+        finally:
+            f.close()
+
+    @mock.patch('temba_client.v1.TembaClient')
+    def test_print_out_statistics(self, temba_client_class):
+        runs = [self.make_flow_run(run=i) for i in range(3)]
+        cache = rapidpropull.cache.RapidProCache('sqlite://')
+        temba_client_class.return_value.get_runs.return_value = runs
+        argv = ['--flow-runs', '--api-token', 'a-token', '--cache=sqlite://',
+                '--statistics']
+        with mock.patch('rapidpropull.cache.RapidProCache',
+                        return_value=cache):
+            with iocapture.capture() as captured_out:
+                rapidpropull.cli.main(argv)
+                stderr = captured_out.stderr
+        assert stderr == 'flowrun cache hits: 0\n' \
+                         'flowrun cache misses: 3\n' \
+                         'http concurrency limit: 10\n' \
+                         'http connections opened: 0\n' \
+                         'http connections reused: 0\n' \
+                         'http requests: 0\n' \
+                         'http requests rate limited: 0\n' \
+                         'http requests retried: 0\n' \
+                         'memory cache hit rate: 0.0%\n' \
+                         'memory cache hits: 0\n' \
+                         'memory cache misses: 3\n'
+
     @mock.patch('temba_client.v1.TembaClient')
     def test_handles_temba_connection_errors(self, temba_client_class):
         """
@@ -1184,6 +3216,21 @@ class TestMain(Auxiliary):
                     result = captured_out.stderr
                 assert error_message in result
 
+    @mock.patch('temba_client.v1.TembaClient')
+    def test_handles_temba_rate_exceeded_errors(self, temba_client_class):
+        """
+        It catches TembaRateExceededError (raised once out of retries), prints
+        a relevant message and exits with exit status different than 0.
+        """
+        temba_client_class.return_value.get_runs.side_effect = \
+            TembaRateExceededError(60)
+        with iocapture.capture() as captured_out:
+            with pytest.raises(SystemExit) as e:
+                rapidpropull.cli.main(['--flow-runs', '--api-token', 'token'])
+            stderr = captured_out.stderr
+        assert e.value.code == 1
+        assert 'Rate limit of the host exceeded' in stderr
+
     @mock.patch('temba_client.v1.TembaClient')
     def test_does_not_catch_unknown_exceptions_from_temba(
             self, temba_client_class):